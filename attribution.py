@@ -0,0 +1,528 @@
+#================================
+# SuperLearner attributions
+#================================
+# Per-site and global feature
+# attributions (Shapley values)
+# of the stacked model, computed
+# per base learner and combined
+# through the stacking weights:
+#   phi_stack = sum_k w_k phi_k
+# so that for every site
+#   base + sum_j phi_j = prediction.
+#
+# Unlike FPI, most learners are
+# attributed analytically instead
+# of by repeated predicts:
+# + tree ensembles (etr, rf,
+#   decision trees): exact
+#   path-dependent TreeSHAP, all
+#   leaves of all trees at once
+# + xgb: the booster's own exact
+#   TreeSHAP (pred_contribs)
+# + linear family (ridge, lasso,
+#   enet, huber, linear, also with
+#   PolynomialFeatures) and other
+#   learners that are linear in
+#   their scaled inputs (pls,
+#   linear kernel SVR/NuSVR):
+#   exact Shapley values of each
+#   monomial with the features
+#   independent (linear SHAP for
+#   degree 1), with expectations
+#   over the training inputs
+# + anything else (e.g. NuSVR with
+#   a nonlinear kernel, KNN, MLP):
+#   sampling Shapley with
+#   --n_samples feature orders and
+#   training sites as background.
+#
+# Learners whose target transform
+# (TransformedTargetRegressor) is
+# not affine are attributed in the
+# transformed target space and the
+# attributions are rescaled to the
+# output space by
+#   (y - base)/(y_t - base_t),
+# which keeps them additive.
+#
+# Outputs (in model_dir):
+# sl_attributions.csv: per site,
+#   the base value and one column
+#   per feature for the stack
+# sl_attributions_<learner>.csv:
+#   the same per learner, with
+#   --per_learner True
+# sl_attributions_global.csv: mean
+#   |phi| over the sites of each
+#   feature, for the stack and
+#   each learner
+#
+# Command line execution:
+# python -m attribution
+# --model_dir ./model_dir
+# --num_inputs 25
+# --predict_var <target name>
+# --predict_data ./path/to/predict_data
+# (optional) --n_samples 10
+# (optional) --seed 0
+# (optional) --per_learner True
+# (optional) --chunk_size 10000
+#================================
+
+# Dependencies
+import argparse
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+from sklearn.cross_decomposition import PLSRegression
+from sklearn.ensemble import ExtraTreesRegressor
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.svm import SVR
+from sklearn.svm import NuSVR
+from sklearn.svm import LinearSVR
+from sklearn.tree import DecisionTreeRegressor
+import stream
+from compile_linear import CompiledPolynomial
+from compile_linear import compile_linear_learner
+from compile_linear import compose_affine
+from compile_linear import unwrap_learner
+from compile_trees import XGB_IDENTITY_OBJECTIVES
+from scenario import PER_FEATURE_TRANSFORMS
+from stacking import StackedPredictor
+
+# Upper bound on the number of elements in the intermediate
+# arrays; sets how many sites are attributed at once.
+CHUNK_ELEMENTS = 2**22
+
+# Tree ensembles attributed with TreeSHAP.
+TREE_MODELS = (ExtraTreesRegressor, RandomForestRegressor, DecisionTreeRegressor)
+
+# Core estimators that are affine in their inputs but are not
+# compiled by compile_linear.py.
+AFFINE_MODELS = (PLSRegression, LinearSVR)
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def product_game_shapley(value, present, absent):
+    # Shapley values of the product games
+    #   v(S) = value * prod_{j in S} present_j * prod_{j not in S} absent_j
+    # over d players (a tree leaf and the unique features on its
+    # path, or a monomial and its features), for G games and N
+    # sites: present (G, d, N), absent (G, d, N) or (G, d, 1).
+    # For player i,
+    #   phi_i = value*(present_i - absent_i)*
+    #           integral_0^1 prod_{j!=i} (absent_j*(1-t) + present_j*t) dt
+    # and the integrand is a polynomial of degree d-1, so
+    # Gauss-Legendre with ceil(d/2) nodes is exact.
+    d = present.shape[1]
+    nodes, weights = np.polynomial.legendre.leggauss((d + 1)//2)
+    t = (nodes + 1)/2
+    factor = absent[:, :, None, :]*(1 - t)[None, None, :, None] + present[:, :, None, :]*t[None, None, :, None]
+    # Products over the other players: exclusive prefix times
+    # exclusive suffix products.
+    ones = np.ones_like(factor[:, :1])
+    prefix = np.concatenate((ones, np.cumprod(factor[:, :-1], axis=1)), axis=1)
+    suffix = np.concatenate((np.cumprod(factor[:, :0:-1], axis=1)[:, ::-1], ones), axis=1)
+    integral = np.einsum('gdkn,k->gdn', prefix*suffix, weights/2)
+    return value[:, None, None]*(present - absent)*integral
+
+def leaf_game_shapley(value, follows, absent):
+    # product_game_shapley for tree leaves, where present is 0/1
+    # (follows: does the site satisfy the player's splits) and
+    # 0 < absent < 1. Then every factor is positive, so the
+    # products over the other players are the product over all
+    # players R divided by the player's own factor, and
+    #   1/factor_i = follows_i/A_i + (1 - follows_i)/D_i
+    # with A = absent*(1-t) + t and D = absent*(1-t). The
+    # integrals reduce to batched matmuls over the quadrature
+    # nodes instead of per-player products.
+    d = absent.shape[1]
+    nodes, weights = np.polynomial.legendre.leggauss((d + 1)//2)
+    t = (nodes + 1)/2
+    q = weights/2
+    D = absent[:, :, None]*(1 - t)
+    A = D + t
+    log_D = np.log(D)
+    # R[g, k, n] = prod_j factor_j at node k
+    R = np.exp(log_D.sum(axis=1)[:, :, None] +
+               np.matmul(np.transpose(np.log(A) - log_D, (0, 2, 1)), follows))
+    follow_values = np.matmul((value[:, None]*(1 - absent))[:, :, None]*(q/A), R)
+    other_values = np.matmul((-value[:, None]*absent)[:, :, None]*(q/D), R)
+    # follows*follow_values + (1 - follows)*other_values, in place
+    follow_values -= other_values
+    follow_values *= follows
+    follow_values += other_values
+    return follow_values
+
+def chunk_rows(n_elements_per_row):
+    return max(1, CHUNK_ELEMENTS//max(1, n_elements_per_row))
+
+def feature_map(feature, n_features):
+    # (G*d, n_features) matrix that adds the players' values into
+    # their features.
+    mapping = np.zeros((feature.size, n_features))
+    mapping[np.arange(feature.size), np.ravel(feature)] = 1.0
+    return mapping
+
+#----------------------------------------------------------
+# TreeSHAP
+#----------------------------------------------------------
+def forest_leaf_games(trees, n_features):
+    # Leaf games of all trees of an ensemble (the prediction is
+    # the mean over trees), grouped by the number d of unique
+    # features on the leaf's path. For each leaf: value, and per
+    # unique feature the fraction of training cover that follows
+    # the path (absent) and the splits that a site must satisfy
+    # to follow it (present).
+    leaves = {}
+    for tree in trees:
+        tree_ = tree.tree_
+        cover = tree_.weighted_n_node_samples
+        stack = [(0, {})]
+        while len(stack) > 0:
+            node, path = stack.pop()
+            left, right = tree_.children_left[node], tree_.children_right[node]
+            if left == -1:
+                leaves.setdefault(len(path), []).append((tree_.value[node, 0, 0]/len(trees), path))
+                continue
+            feature, threshold = int(tree_.feature[node]), tree_.threshold[node]
+            for child, is_left in ((left, True), (right, False)):
+                child_path = dict(path)
+                fraction, splits = child_path.get(feature, (1.0, ()))
+                child_path[feature] = (fraction*cover[child]/cover[node], splits + ((threshold, is_left),))
+                stack.append((child, child_path))
+
+    games = []
+    base = 0.0
+    for d, bucket in sorted(leaves.items()):
+        value = np.array([leaf_value for leaf_value, _ in bucket])
+        if d == 0:
+            base += value.sum()
+            continue
+        feature = np.array([list(path.keys()) for _, path in bucket], dtype=np.int64)
+        absent = np.array([[fraction for fraction, _ in path.values()] for _, path in bucket])
+        base += np.sum(value*np.prod(absent, axis=1))
+        # Splits of the players (player m = leaf*d + slot), by rank
+        # along the path: every player has a first split, players
+        # whose feature is split again on the path have more.
+        splits = [path[ff][1] for (_, path), leaf_features in zip(bucket, feature) for ff in leaf_features]
+        flat_feature = np.ravel(feature)
+        ranked_splits = []
+        for rank in range(max(len(player_splits) for player_splits in splits)):
+            players = np.array([mm for mm, player_splits in enumerate(splits) if len(player_splits) > rank])
+            ranked_splits.append((
+                players,
+                flat_feature[players],
+                np.array([splits[mm][rank][0] for mm in players]),
+                np.array([splits[mm][rank][1] for mm in players])))
+        games.append({
+            'd': d,
+            'value': value,
+            'feature': feature,
+            'absent': absent,
+            'splits': ranked_splits,
+            'mapping': feature_map(feature, n_features)})
+    return games, base
+
+def tree_shap(games, X):
+    # (n_sites, n_features) TreeSHAP values. Splits compare the
+    # float32 inputs, as sklearn trees do.
+    X = np.asarray(X, dtype=np.float32)
+    phi = np.zeros(X.shape, dtype=np.float64)
+    for game in games:
+        n_games, d = game['feature'].shape
+        rows = chunk_rows(n_games*d)
+        for start in range(0, X.shape[0], rows):
+            X_chunk = X[start:start+rows]
+            # (sites, players): does the site satisfy all the
+            # player's splits
+            _, feature, threshold, is_left = game['splits'][0]
+            follows = (X_chunk[:, feature] <= threshold) == is_left
+            for players, feature, threshold, is_left in game['splits'][1:]:
+                follows[:, players] &= (X_chunk[:, feature] <= threshold) == is_left
+            follows = np.ascontiguousarray(follows.T, dtype=np.float64)
+            values = leaf_game_shapley(game['value'], follows.reshape(n_games, d, -1), game['absent'])
+            phi[start:start+rows] += values.reshape(n_games*d, -1).T @ game['mapping']
+    return phi
+
+#----------------------------------------------------------
+# Polynomial (linear) SHAP
+#----------------------------------------------------------
+def polynomial_games(poly, background):
+    # Monomial games of a CompiledPolynomial, grouped by the number
+    # of distinct features in the monomial, with the expected
+    # value of each factor over the background (training) inputs.
+    n_features = poly.n_features_in_
+    z_background = background*poly.a + poly.b
+    terms = {}
+    for row, coef in zip(poly.index, poly.coef):
+        features, powers = np.unique(row[row != n_features], return_counts=True)
+        terms.setdefault(len(features), []).append((coef, features, powers))
+
+    games = []
+    base = poly.intercept
+    for d, bucket in sorted(terms.items()):
+        coef = np.array([term[0] for term in bucket])
+        feature = np.array([term[1] for term in bucket], dtype=np.int64)
+        power = np.array([term[2] for term in bucket])
+        absent = np.mean(z_background[:, feature]**power, axis=0)
+        base += np.sum(coef*np.prod(absent, axis=1))
+        games.append({
+            'd': d,
+            'value': coef,
+            'feature': feature,
+            # row of z**power in the table built by polynomial_shap
+            'column': (power - 1)*n_features + feature,
+            'absent': absent[:, :, None],
+            'mapping': feature_map(feature, n_features)})
+    return games, base
+
+def polynomial_shap(games, poly, X):
+    z = np.asarray(X, dtype=np.float64)*poly.a + poly.b
+    phi = np.zeros(z.shape)
+    # Powers of the scaled inputs, (degree*n_features, n_sites)
+    z_powers = [z.T]
+    for power in range(1, poly.degree):
+        z_powers.append(z_powers[-1]*z.T)
+    z_powers = np.concatenate(z_powers, axis=0)
+    for game in games:
+        n_games, d = game['feature'].shape
+        rows = chunk_rows(n_games*d*((d + 1)//2))
+        for start in range(0, z.shape[0], rows):
+            present = z_powers[:, start:start+rows][game['column']]
+            values = product_game_shapley(game['value'], present, game['absent'])
+            phi[start:start+rows] += values.reshape(n_games*d, -1).T @ game['mapping']
+    return phi
+
+def affine_polynomial(steps, core, background):
+    # CompiledPolynomial (degree 1, no target transform) of a
+    # learner that is affine in its inputs, from predictions at
+    # the background mean and one step along each feature.
+    def raw_predict(X):
+        for step in steps:
+            X = step.transform(X)
+        return np.ravel(core.predict(X))
+    center = np.mean(background, axis=0)
+    scale = np.std(background, axis=0)
+    scale[scale == 0] = 1.0
+    probes = np.vstack((center, center + np.diag(scale)))
+    Y = raw_predict(probes)
+    coef = (Y[1:] - Y[0])/scale
+    n_features = len(center)
+    return CompiledPolynomial(np.ones(n_features), np.zeros(n_features),
+                              np.arange(n_features, dtype=np.int32).reshape(-1, 1),
+                              coef, float(Y[0] - coef @ center))
+
+#----------------------------------------------------------
+# Sampling Shapley
+#----------------------------------------------------------
+def sampling_shap(predict, X, background, n_samples, rng):
+    # Shapley values estimated from n_samples feature orders
+    # (each order is followed by its reverse): for each site, the
+    # features are switched one at a time from a random background
+    # site to the site's own values. The base is the mean
+    # prediction at the background sites drawn, so
+    # base + sum(phi) is the prediction exactly. The inputs keep
+    # their dtype, since some learners (e.g. KNN after a float32
+    # MinMaxScaler) predict differently in float32.
+    X = np.asarray(X)
+    n_sites, n_features = X.shape
+    phi = np.zeros(X.shape, dtype=np.float64)
+    base = np.zeros(n_sites)
+    for sample in range(n_samples):
+        if sample % 2 == 0:
+            order = rng.permutation(n_features)
+        else:
+            order = order[::-1]
+        current = background[rng.integers(len(background), size=n_sites)].copy()
+        path = np.empty((n_features + 1, n_sites, n_features), dtype=X.dtype)
+        path[0] = current
+        for kk, feature in enumerate(order):
+            current[:, feature] = X[:, feature]
+            path[kk + 1] = current
+        Y = np.reshape(predict(path.reshape(-1, n_features)), (n_features + 1, n_sites))
+        phi[:, order] += (Y[1:] - Y[:-1]).T
+        base += Y[0]
+    return phi/n_samples, base/n_samples
+
+#----------------------------------------------------------
+def to_output_space(phi, base, transformer):
+    # Rescale attributions from the transformed target space to the
+    # output space (see header); base may be a scalar or per site.
+    if transformer is None:
+        return phi, base
+    def inverse(Y):
+        # The inverse may modify its input (e.g. clipping).
+        return np.ravel(transformer.inverse_transform(np.array(Y, dtype=np.float64).reshape(-1, 1)))
+    base = np.full(phi.shape[0], base, dtype=np.float64)
+    raw = base + phi.sum(axis=1)
+    y, y_base = inverse(raw), inverse(base)
+    delta = raw - base
+    # Local slope where the prediction is at the base value.
+    step = 1e-6*np.maximum(1.0, np.abs(base))
+    slope = (inverse(base + step) - inverse(base - step))/(2*step)
+    small = np.abs(delta) < step
+    ratio = np.where(small, slope, (y - y_base)/np.where(small, 1.0, delta))
+    return phi*ratio[:, None], y_base
+
+class LearnerAttribution:
+    # Attributions of one fitted base learner: .method is 'tree',
+    # 'xgb', 'linear' or 'sampling', .attribute(X) returns
+    # (phi, base) in the learner's output space.
+    def __init__(self, model, background, n_samples=10, seed=0):
+        self.model = model
+        self.background = np.asarray(background, dtype=np.float64)
+        self.n_samples = n_samples
+        self.rng = np.random.default_rng(seed)
+        self.steps, core, self.transformer = unwrap_learner(model)
+        per_feature = all(isinstance(step, PER_FEATURE_TRANSFORMS) for step in self.steps)
+
+        self.method = 'sampling'
+        if per_feature and isinstance(core, TREE_MODELS):
+            trees = core.estimators_ if hasattr(core, 'estimators_') else [core]
+            self.games, self.base = forest_leaf_games(trees, self.background.shape[1])
+            self.method = 'tree'
+        elif per_feature and hasattr(core, 'get_booster') and core.get_params().get('objective') in XGB_IDENTITY_OBJECTIVES:
+            self.booster = core.get_booster()
+            self.method = 'xgb'
+        else:
+            poly = compile_linear_learner(model)
+            if poly is not None:
+                self.transformer = poly.target_inverse
+            elif compose_affine(self.steps, self.background.shape[1]) is not None and (
+                    isinstance(core, AFFINE_MODELS) or
+                    (isinstance(core, (SVR, NuSVR)) and core.kernel == 'linear')):
+                poly = affine_polynomial(self.steps, core, self.background)
+            if poly is not None:
+                self.poly = poly
+                self.games, self.base = polynomial_games(poly, self.background)
+                self.method = 'linear'
+
+    def transform(self, X):
+        for step in self.steps:
+            X = step.transform(X)
+        return X
+
+    def attribute(self, X):
+        if self.method == 'sampling':
+            return sampling_shap(self.model.predict, X, self.background, self.n_samples, self.rng)
+        if self.method == 'tree':
+            phi, base = tree_shap(self.games, self.transform(X)), self.base
+        elif self.method == 'xgb':
+            import xgboost
+            contributions = self.booster.predict(xgboost.DMatrix(
+                self.transform(X), feature_names=self.booster.feature_names), pred_contribs=True)
+            phi, base = contributions[:, :-1].astype(np.float64), contributions[:, -1].astype(np.float64)
+        else:
+            phi, base = polynomial_shap(self.games, self.poly, X), self.base
+        return to_output_space(phi, base, self.transformer)
+
+class StackedAttribution:
+    # Attributions of a StackedPredictor with a linear final
+    # estimator (e.g. NNLS) and of its weighted learners.
+    def __init__(self, predictor, background, n_samples=10, seed=0):
+        if not predictor.linear:
+            raise ValueError('Attributions need a linear final estimator (e.g. NNLS weights)')
+        self.predictor = predictor
+        self.background = np.asarray(background, dtype=np.float64)
+        self.names = [predictor.names[ii] for ii in predictor.active]
+        self.weights = predictor.weights[predictor.active]
+        self.learners = [LearnerAttribution(predictor.stacked.estimators_[ii], background,
+                                            n_samples=n_samples, seed=[seed, ii])
+                         for ii in predictor.active]
+
+    def attribute(self, X):
+        # {'stack': (phi, base), learner name: (phi, base)}
+        X = np.asarray(X)
+        out = {}
+        phi = np.zeros(X.shape, dtype=np.float64)
+        base = np.full(X.shape[0], self.predictor.intercept, dtype=np.float64)
+        for name, weight, learner in zip(self.names, self.weights, self.learners):
+            out[name] = learner.attribute(X)
+            phi += weight*out[name][0]
+            base += weight*out[name][1]
+        if self.predictor.passthrough:
+            center = np.mean(self.background, axis=0)
+            phi += (X - center)*self.predictor.passthrough_weights
+            base += center @ self.predictor.passthrough_weights
+        out['stack'] = (phi, base)
+        return out
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner attribution arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    predict_var = args.predict_var
+    num_inputs = int(args.num_inputs)
+    predict_data_csv = args.predict_data+'.csv'
+    predict_data_ixy = args.predict_data+'.ixy'
+    n_samples = int(getattr(args, 'n_samples', None) or 10)
+    seed = int(getattr(args, 'seed', None) or 0)
+    per_learner = str(getattr(args, 'per_learner', None)) in ('True', 'true')
+    chunk_size = int(getattr(args, 'chunk_size', None) or 10000)
+
+    sys.path.append(model_dir)
+    with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+        superlearner = pickle.load(file_object)
+    predictor = StackedPredictor(superlearner[predict_var])
+
+    # Background: the training and test inputs.
+    background = pd.concat((pd.read_csv(model_dir+'/train.csv'), pd.read_csv(model_dir+'/test.csv')),
+                           axis=0).values[:, :num_inputs].astype(np.float64)
+    attribution = StackedAttribution(predictor, background, n_samples=n_samples, seed=seed)
+    for name, weight, learner in zip(attribution.names, attribution.weights, attribution.learners):
+        print(name+' (weight '+str(round(weight, 4))+'): '+learner.method)
+
+    #===========================================================
+    # Per-site attributions, in chunks
+    #===========================================================
+    feature_names = list(pd.read_csv(predict_data_csv, nrows=0).columns)
+    outputs = ['stack'] + (attribution.names if per_learner else [])
+    abs_total = {name: np.zeros(len(feature_names)) for name in ['stack'] + attribution.names}
+    n_sites = 0
+    first = True
+    fill_values = stream.column_means(predict_data_csv, chunk_size)
+    for X, output_df in stream.iter_chunks(predict_data_csv, predict_data_ixy, chunk_size, fill_values):
+        results = attribution.attribute(X)
+        n_sites += X.shape[0]
+        for name, (phi, base) in results.items():
+            abs_total[name] += np.abs(phi).sum(axis=0)
+        for name in outputs:
+            phi, base = results[name]
+            site_df = output_df.copy()
+            site_df['base'] = base
+            site_df = pd.concat((site_df.reset_index(drop=True),
+                                 pd.DataFrame(phi, columns=feature_names)), axis=1)
+            output_file = model_dir+'/sl_attributions.csv' if name == 'stack' else model_dir+'/sl_attributions_'+name+'.csv'
+            stream.append_csv(site_df, output_file, first)
+        first = False
+        print('Attributed '+str(n_sites)+' sites')
+
+    #===========================================================
+    # Global attributions: mean |phi| over the sites
+    #===========================================================
+    global_df = pd.DataFrame({name: total/max(n_sites, 1) for name, total in abs_total.items()},
+                             index=pd.Index(feature_names, name='Feature'))
+    global_df = global_df.sort_values('stack', ascending=False)
+    print(global_df['stack'])
+    global_df.to_csv(model_dir+'/sl_attributions_global.csv')
+
+    print("Done!")
@@ -0,0 +1,508 @@
+#================================
+# SuperLearner linear compiler
+#================================
+# Fold the fitted linear-family
+# submodels (ridge, lasso, enet,
+# huber, linear) into compact
+# polynomial evaluators.
+#
+# At prediction time, each of
+# these submodels runs
+# scaler -> PolynomialFeatures ->
+# linear model -> inverse target
+# transform as separate passes
+# that each allocate a wide
+# intermediate array. Since the
+# scalers and the linear model
+# are affine, the whole pipeline
+# is a single polynomial in the
+# scaled inputs:
+#   y = sum_m c_m * prod_j z_j^p_mj + c_0
+# with z = a*x + b. The target
+# MinMaxScaler inverse is folded
+# into the c_m, zero coefficients
+# (e.g. Lasso) are dropped and
+# several learners that share the
+# same input scaling are merged
+# (weighted by the NNLS stacking
+# weights) into one evaluation.
+#
+# The folded polynomial matches the
+# pipeline on float64 inputs. On
+# float32 inputs (as in predict.py)
+# the pipeline scales, expands and
+# sums in float32, and for poorly
+# conditioned fits (e.g. linear on
+# degree 3 features) the rounding
+# moves the predictions far more
+# than any folding error, so float32
+# inputs are instead replayed step
+# by step in the pipeline's dtypes
+# and order. Such fits are not
+# reproducible to better than that
+# rounding even by sklearn: its
+# float32 sum depends on the number
+# of rows in the batch.
+#
+# Command line execution:
+# python -m compile_linear
+# --model_dir ./model_dir
+# --num_inputs 25
+# (optional) --predict_var <target name>
+#================================
+
+# Dependencies
+import argparse
+import pickle
+import sys
+import time
+import numpy as np
+import pandas as pd
+from sklearn.compose import TransformedTargetRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.preprocessing import MaxAbsScaler
+from sklearn.preprocessing import PolynomialFeatures
+from sklearn.linear_model import LinearRegression
+from sklearn.linear_model import Ridge
+from sklearn.linear_model import Lasso
+from sklearn.linear_model import ElasticNet
+from sklearn.linear_model import HuberRegressor
+
+# Core estimators that can be folded into a polynomial.
+LINEAR_MODELS = (LinearRegression, Ridge, Lasso, ElasticNet, HuberRegressor)
+
+# Upper bound on the number of elements in the per-chunk
+# intermediate arrays; sets how many rows are evaluated at once.
+CHUNK_ELEMENTS = 2**22
+
+# Use dense Horner evaluation when the coefficient tensors are
+# at most this many times larger than the number of nonzero
+# terms, otherwise gather only the nonzero monomials.
+DENSE_FACTOR = 16
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def affine_params(scaler):
+    # Return (a, b) such that scaler.transform(x) == x*a + b
+    # for a fitted per-feature affine scaler, or None if the
+    # transform is not affine (e.g. PowerTransformer, or a
+    # MinMaxScaler with clip). Fitted StandardScalers have mean_
+    # even with with_mean=False, so the flags decide, as in
+    # StandardScaler.transform.
+    if isinstance(scaler, StandardScaler):
+        n = scaler.n_features_in_
+        a = 1.0/scaler.scale_ if scaler.with_std else np.ones(n)
+        b = -scaler.mean_*a if scaler.with_mean else np.zeros(n)
+        return np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    if isinstance(scaler, MinMaxScaler):
+        if scaler.clip:
+            return None
+        return scaler.scale_.astype(np.float64), scaler.min_.astype(np.float64)
+    if isinstance(scaler, MaxAbsScaler):
+        return 1.0/scaler.scale_.astype(np.float64), np.zeros(scaler.n_features_in_)
+    return None
+
+def scaler_ops(scaler):
+    # Return the in-place operations that scaler.transform applies,
+    # in sklearn's order, so they can be replayed in float32 with
+    # exactly the same rounding. None if not a supported scaler
+    # (a MinMaxScaler with clip is not replayed). Fitted
+    # StandardScalers have mean_ even with with_mean=False, so the
+    # flags decide, as in StandardScaler.transform.
+    if isinstance(scaler, StandardScaler):
+        ops = []
+        if scaler.with_mean:
+            ops.append(('sub', scaler.mean_))
+        if scaler.with_std:
+            ops.append(('div', scaler.scale_))
+        return ops
+    if isinstance(scaler, MinMaxScaler):
+        if scaler.clip:
+            return None
+        return [('mul', scaler.scale_), ('add', scaler.min_)]
+    if isinstance(scaler, MaxAbsScaler):
+        return [('div', scaler.scale_)]
+    return None
+
+def inverse_scaler_ops(scaler):
+    # Operations applied by scaler.inverse_transform.
+    if isinstance(scaler, StandardScaler):
+        ops = []
+        if scaler.with_std:
+            ops.append(('mul', scaler.scale_))
+        if scaler.with_mean:
+            ops.append(('add', scaler.mean_))
+        return ops
+    if isinstance(scaler, MinMaxScaler):
+        return [('sub', scaler.min_), ('div', scaler.scale_)]
+    if isinstance(scaler, MaxAbsScaler):
+        return [('mul', scaler.scale_)]
+    return None
+
+def apply_ops(X, ops):
+    # Replay a list of in-place operations on X.
+    for op, values in ops:
+        values = np.asarray(values)
+        if op == 'sub':
+            X -= values
+        elif op == 'div':
+            X /= values
+        elif op == 'mul':
+            X *= values
+        elif op == 'add':
+            X += values
+    return X
+
+def unwrap_learner(model):
+    # Split a fitted submodel, optionally wrapped in a
+    # TransformedTargetRegressor and/or a Pipeline, into its
+    # input steps, core estimator and target transformer.
+    transformer = None
+    if isinstance(model, TransformedTargetRegressor):
+        transformer = model.transformer_
+        model = model.regressor_
+    if isinstance(model, Pipeline):
+        steps = [step for _, step in model.steps if step not in (None, 'passthrough')]
+    else:
+        steps = [model]
+    return steps[:-1], steps[-1], transformer
+
+def compose_affine(steps, n_features):
+    # Collapse a sequence of affine scalers into a single (a, b).
+    # Returns None if any step is not an affine scaler.
+    a = np.ones(n_features)
+    b = np.zeros(n_features)
+    for step in steps:
+        params = affine_params(step)
+        if params is None:
+            return None
+        a, b = a*params[0], b*params[0] + params[1]
+    return a, b
+
+def powers_to_index(powers, n_features):
+    # Convert PolynomialFeatures.powers_ (n_terms, n_features)
+    # into an (n_terms, degree) array of feature indices where
+    # each feature is repeated by its power. Unused slots point
+    # at n_features, which is a column of ones at evaluation.
+    degree = max(int(powers.sum(axis=1).max()), 1)
+    index = np.full((powers.shape[0], degree), n_features, dtype=np.int32)
+    for tt, row in enumerate(powers):
+        features = np.repeat(np.arange(n_features), row)
+        index[tt, :len(features)] = features
+    return index
+
+#=======================================
+# Compiled forms
+#=======================================
+
+class CompiledPolynomial:
+    # A single polynomial evaluation
+    #   y = inverse(sum_m coef_m * prod_k z[:, index_mk] + intercept)
+    # with z = x*a + b. If the target transform was affine it has
+    # already been folded into coef/intercept and inverse is None.
+    #
+    # Dense polynomials (e.g. ridge) are evaluated in Horner form
+    # with one coefficient tensor per degree, so the innermost
+    # level is a single BLAS matmul; sparse ones (e.g. lasso)
+    # gather only their nonzero monomials.
+    #
+    # replay: optional dict with the pipeline's input ops,
+    # PolynomialFeatures, coef and intercept (in the estimator's
+    # dtype) and target transformer, used for float32 inputs (see
+    # predict_float32).
+    def __init__(self, a, b, index, coef, intercept, target_inverse=None, replay=None):
+        self.replay = replay
+        self.a = a
+        self.b = b
+        self.index = index
+        self.coef = coef
+        self.intercept = intercept
+        self.target_inverse = target_inverse
+        self.n_features_in_ = len(a)
+        self.degree = index.shape[1]
+
+        p = self.n_features_in_
+        dense_size = sum(p**d for d in range(1, self.degree + 1))
+        self.tensors = None
+        if len(coef) > 0 and dense_size <= DENSE_FACTOR*len(coef):
+            self.tensors = [np.zeros((p,)*d) for d in range(1, self.degree + 1)]
+            for row, c in zip(index, coef):
+                features = tuple(int(ii) for ii in row if ii != p)
+                self.tensors[len(features) - 1][features] += c
+
+    @property
+    def n_terms(self):
+        return len(self.coef)
+
+    def _evaluate_dense(self, z):
+        # Horner: contract the highest-degree tensor with z, add the
+        # next lower tensor, contract again, ... down to degree 1.
+        n, p = z.shape
+        acc = None
+        for tensor in reversed(self.tensors):
+            if acc is None:
+                acc = z @ tensor.reshape(-1, p).T
+            else:
+                acc += tensor.reshape(-1)
+                acc = np.einsum('nip,np->ni', acc.reshape(n, -1, p), z)
+        return acc[:, 0] + self.intercept
+
+    def _evaluate_sparse(self, z):
+        zext = np.empty((z.shape[0], z.shape[1] + 1))
+        zext[:, :-1] = z
+        zext[:, -1] = 1.0
+        terms = zext[:, self.index[:, 0]]
+        for kk in range(1, self.degree):
+            terms *= zext[:, self.index[:, kk]]
+        return terms @ self.coef + self.intercept
+
+    def _chunk_size(self):
+        if self.tensors is not None:
+            width = self.n_features_in_**(self.degree - 1)
+        else:
+            width = max(self.n_terms, self.n_features_in_)
+        return max(1, CHUNK_ELEMENTS//width)
+
+    def predict_float32(self, X):
+        # The pipeline on float32 inputs: the scalers replayed in
+        # float32, the fitted PolynomialFeatures and the sum over
+        # all terms, zeros included, in one matmul over the whole
+        # batch, so the float32 rounding is the same.
+        replay = self.replay
+        Z = apply_ops(np.array(X, dtype=np.float32), replay['input_ops'])
+        if replay['poly'] is not None:
+            Z = replay['poly'].transform(Z)
+        Y = Z @ replay['coef'] + replay['intercept']
+        if replay['transformer'] is not None:
+            Y = np.squeeze(replay['transformer'].inverse_transform(Y.reshape(-1, 1)), axis=1)
+        return Y
+
+    def predict(self, X, chunk_size=None):
+        X = np.asarray(X)
+        if X.dtype == np.float32 and self.replay is not None:
+            return self.predict_float32(X)
+        Y = np.empty(X.shape[0])
+        if chunk_size is None:
+            chunk_size = self._chunk_size()
+        for start in range(0, X.shape[0], chunk_size):
+            z = X[start:start+chunk_size]*self.a + self.b
+            if self.tensors is not None:
+                Y[start:start+chunk_size] = self._evaluate_dense(z)
+            else:
+                Y[start:start+chunk_size] = self._evaluate_sparse(z)
+        if self.target_inverse is not None:
+            Y = np.squeeze(self.target_inverse.inverse_transform(Y.reshape(-1, 1)), axis=1)
+        return Y
+
+class CompiledLinearBlend:
+    # Weighted sum of compiled polynomials, i.e. the contribution
+    # of all compiled linear learners to the NNLS stacked output.
+    def __init__(self, parts, names, learners=None):
+        # parts: list of (weight, CompiledPolynomial), possibly
+        # merged; learners: the unmerged list, for float32 inputs
+        # (merging changes the float32 rounding).
+        self.parts = parts
+        self.names = names
+        self.learners = learners if learners is not None else parts
+
+    @property
+    def n_terms(self):
+        return sum(part.n_terms for _, part in self.parts)
+
+    def predict(self, X, chunk_size=None):
+        Y = np.zeros(np.shape(X)[0])
+        parts = self.learners if np.asarray(X).dtype == np.float32 else self.parts
+        for weight, part in parts:
+            Y += weight*part.predict(X, chunk_size=chunk_size)
+        return Y
+
+#=======================================
+# Compiler
+#=======================================
+
+def compile_linear_learner(model):
+    # Compile one fitted submodel. Returns None if the submodel
+    # is not a linear-family pipeline that can be folded.
+    steps, core, transformer = unwrap_learner(model)
+    if not isinstance(core, LINEAR_MODELS):
+        return None
+
+    # Optional PolynomialFeatures must be the last input step;
+    # everything before it must be an affine scaler.
+    poly = None
+    if len(steps) > 0 and isinstance(steps[-1], PolynomialFeatures):
+        poly = steps[-1]
+        steps = steps[:-1]
+    n_features = steps[0].n_features_in_ if len(steps) > 0 else (
+        poly.n_features_in_ if poly is not None else core.n_features_in_)
+    affine = compose_affine(steps, n_features)
+    if affine is None:
+        return None
+    a, b = affine
+
+    if poly is not None:
+        index = powers_to_index(poly.powers_, n_features)
+    else:
+        index = np.arange(n_features, dtype=np.int32).reshape(-1, 1)
+
+    input_ops = []
+    for step in steps:
+        input_ops.extend(scaler_ops(step))
+    replay = {
+        'input_ops': input_ops,
+        'poly': poly,
+        'coef': np.ravel(core.coef_),
+        'intercept': np.ravel(core.intercept_)[0],
+        'transformer': transformer}
+
+    coef = np.ravel(core.coef_).astype(np.float64)
+    intercept = float(np.ravel(core.intercept_)[0])
+
+    # The constant monomial (all slots pointing at the column of
+    # ones) is merged into the intercept.
+    bias = np.all(index == n_features, axis=1)
+    intercept += coef[bias].sum()
+    keep = np.logical_and(np.logical_not(bias), coef != 0.0)
+    index = index[keep]
+    coef = coef[keep]
+
+    # Fold an affine target transform: y_s = y*ta + tb.
+    target_inverse = None
+    if transformer is not None:
+        target_affine = affine_params(transformer)
+        if target_affine is None:
+            target_inverse = transformer
+        else:
+            ta, tb = target_affine[0][0], target_affine[1][0]
+            coef = coef/ta
+            intercept = (intercept - tb)/ta
+
+    return CompiledPolynomial(a, b, index, coef, intercept, target_inverse, replay=replay)
+
+def merge_polynomials(parts):
+    # Merge weighted compiled polynomials that share the same input
+    # scaling and have no remaining target transform into a single
+    # polynomial over the union of their monomials. Returns a new
+    # list of (weight, CompiledPolynomial).
+    merged = []
+    unmerged = []
+    for weight, part in parts:
+        if part.target_inverse is not None:
+            unmerged.append((weight, part))
+            continue
+        for group in merged:
+            if np.allclose(group['a'], part.a) and np.allclose(group['b'], part.b):
+                break
+        else:
+            group = {'a': part.a, 'b': part.b, 'terms': {}, 'intercept': 0.0,
+                     'width': part.index.shape[1]}
+            merged.append(group)
+        group['width'] = max(group['width'], part.index.shape[1])
+        group['intercept'] += weight*part.intercept
+        for row, coef in zip(part.index, part.coef):
+            key = tuple(sorted(int(ii) for ii in row if ii != len(part.a)))
+            group['terms'][key] = group['terms'].get(key, 0.0) + weight*coef
+
+    out = []
+    for group in merged:
+        n_features = len(group['a'])
+        keys = [key for key, coef in group['terms'].items() if coef != 0.0]
+        index = np.full((len(keys), group['width']), n_features, dtype=np.int32)
+        for tt, key in enumerate(keys):
+            index[tt, :len(key)] = key
+        coef = np.array([group['terms'][key] for key in keys], dtype=np.float64)
+        out.append((1.0, CompiledPolynomial(group['a'], group['b'], index, coef, group['intercept'])))
+    return out + unmerged
+
+def compile_superlearner(stacked):
+    # Compile all linear-family learners of a fitted
+    # StackingRegressor. Returns a dict with the compiled
+    # learners by name and, if the final estimator exposes NNLS
+    # weights, a blend of their weighted contribution.
+    names = [name for name, est in stacked.estimators if est != 'drop']
+    learners = {}
+    for name, model in zip(names, stacked.estimators_):
+        compiled = compile_linear_learner(model)
+        if compiled is not None:
+            learners[name] = compiled
+
+    blend = None
+    weights = getattr(stacked.final_estimator_, 'weights_', None)
+    if weights is not None:
+        parts = [(weights[names.index(name)], compiled)
+                 for name, compiled in learners.items()
+                 if weights[names.index(name)] != 0.0]
+        blend = CompiledLinearBlend(merge_polynomials(parts),
+                                    [name for name in learners if weights[names.index(name)] != 0.0],
+                                    learners=parts)
+    return {'learners': learners, 'blend': blend}
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner compile_linear arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    num_inputs = int(args.num_inputs)
+
+    sys.path.append(model_dir)
+    with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+        superlearner = pickle.load(file_object)
+
+    if getattr(args, 'predict_var', None) is not None:
+        onames = [args.predict_var]
+    else:
+        onames = list(superlearner.keys())
+
+    # Check the compiled forms against sklearn on the training data.
+    train_df = pd.read_csv(model_dir+'/train.csv').astype(np.float32)
+    X_train = train_df.values[:, :num_inputs]
+
+    # Use the importable module's classes so that the pickle
+    # loads from other scripts (not as __main__.CompiledPolynomial).
+    import compile_linear
+
+    compiled_all = {}
+    for oname in onames:
+        print('Compiling linear learners for output: '+oname, flush=True)
+        stacked = superlearner[oname]
+        compiled = compile_linear.compile_superlearner(stacked)
+        compiled_all[oname] = compiled
+
+        for name, learner in compiled['learners'].items():
+            model_object = stacked.named_estimators_[name]
+            tic = time.perf_counter()
+            Y_ref = model_object.predict(X_train)
+            t_ref = time.perf_counter() - tic
+            tic = time.perf_counter()
+            Y_fast = learner.predict(X_train)
+            t_fast = time.perf_counter() - tic
+            print('{}: {} terms, max abs diff {:.3e}, sklearn {:.4f} s, compiled {:.4f} s'.format(
+                name, learner.n_terms, np.max(np.abs(Y_ref - Y_fast)), t_ref, t_fast))
+
+        if compiled['blend'] is not None:
+            print('Blend of '+str(compiled['blend'].names)+' in '+
+                  str(len(compiled['blend'].parts))+' evaluation(s), '+
+                  str(compiled['blend'].n_terms)+' terms')
+
+    with open(model_dir+'/compiled_linear.pkl', 'wb') as output:
+        pickle.dump(compiled_all, output, pickle.HIGHEST_PROTOCOL)
+
+    print("Done!")
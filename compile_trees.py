@@ -0,0 +1,501 @@
+#================================
+# SuperLearner tree compiler
+#================================
+# Export the fitted tree-ensemble
+# submodels (etr, xgb) into a
+# flat, array-backed node layout
+# with a vectorized batch
+# traversal predictor.
+#
+# HPO can push n_estimators up to
+# 10000, which makes the pickled
+# sklearn/xgboost objects huge and
+# slow to load, and predict() pays
+# Python overhead per tree. Here,
+# all trees of a learner are
+# concatenated into a handful of
+# arrays:
+#   feature      int32
+#   threshold    float32 (go left if x <= threshold)
+#   child        int32 (left child; the right
+#                child is child + 1 and
+#                leaves point to themselves)
+#   default_left uint8 (direction for NaN)
+#   value        float32 (leaf values)
+#   roots        int32 (first node of each tree)
+# that are saved as .npy files and
+# loaded back with mmap, so loading
+# is effectively free. Prediction
+# walks all trees for a block of
+# rows at once, one tree level per
+# step, dropping (row, tree) pairs
+# that have reached a leaf.
+#
+# The NumPy traversal pays off for
+# small batches (serve.py queries,
+# small scenario or FPI batches),
+# where the original predictors are
+# dominated by per-call overhead.
+# It does not for bulk batches:
+# the compiled sklearn/xgboost
+# traversal is faster there (10585
+# sites, 100 trees: etr 0.11 s vs
+# 0.53 s flat, xgb 0.025 s vs
+# 0.11 s), with a break even of
+# about 200 rows for both. Each
+# learner is therefore also saved
+# on its own (native.pkl), and a
+# loaded forest unpickles it on
+# its first batch of
+# NATIVE_MIN_ROWS rows or more and
+# hands those batches to it. A
+# copy of the stacked model
+# without the flattened learners
+# (stacked.pkl) lets stacking.py
+# build the predictor without
+# unpickling SuperLearners.pkl, so
+# only the load time, and the
+# small-batch speed, improve;
+# bulk throughput is that of the
+# original learners.
+#
+# Command line execution:
+# python -m compile_trees
+# --model_dir ./model_dir
+# --num_inputs 25
+# (optional) --predict_var <target name>
+# (optional) --predict_data /path/to/predict_data (no extension)
+#================================
+
+# Dependencies
+import argparse
+import copy
+import json
+import os
+import pickle
+import sys
+import time
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import ExtraTreesRegressor
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.tree import DecisionTreeRegressor
+from compile_linear import unwrap_learner
+from compile_linear import scaler_ops
+from compile_linear import inverse_scaler_ops
+from compile_linear import apply_ops
+
+# Upper bound on (rows x trees) traversed at once.
+CHUNK_ELEMENTS = 2**22
+
+# Batches with at least this many rows are predicted by the
+# original learner (native.pkl) if it was saved.
+NATIVE_MIN_ROWS = 200
+
+# sklearn tree ensembles that can be flattened.
+SKLEARN_FORESTS = (ExtraTreesRegressor, RandomForestRegressor)
+
+# XGBoost objectives whose prediction is the raw margin.
+XGB_IDENTITY_OBJECTIVES = (
+    'reg:squarederror', 'reg:linear', 'reg:absoluteerror',
+    'reg:pseudohubererror', 'reg:quantileerror')
+
+ARRAY_NAMES = ['feature', 'threshold', 'child', 'default_left', 'value', 'roots']
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def float32_at_or_below(values):
+    # Largest float32 <= each value, so that for float32 inputs
+    # x <= value  <=>  x <= float32_at_or_below(value).
+    values = np.asarray(values, dtype=np.float64)
+    out = values.astype(np.float32)
+    above = out.astype(np.float64) > values
+    out[above] = np.nextafter(out[above], np.float32(-np.inf))
+    return out
+
+#=======================================
+# Flat forest
+#=======================================
+
+class FlatForest:
+    # Array-backed tree ensemble:
+    #   prediction = offset + scale * sum_trees leaf_value
+    # evaluated on inputs transformed by input_ops, with the
+    # target inverse given by target_ops (affine) or by a
+    # target_inverse transformer (non-affine).
+    def __init__(self, arrays, max_depth, scale, offset,
+                 input_ops=None, target_ops=None, target_inverse=None):
+        for name in ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+        self.max_depth = int(max_depth)
+        self.scale = float(scale)
+        self.offset = float(offset)
+        self.input_ops = input_ops if input_ops is not None else []
+        self.target_ops = target_ops if target_ops is not None else []
+        self.target_inverse = target_inverse
+        self.path = None
+        self.native = None
+        self.has_native = False
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    def __reduce__(self):
+        # A forest loaded from disk pickles as its path, so sending
+        # it to worker processes copies neither the arrays nor the
+        # original learner, which each worker loads when needed.
+        if self.path is not None:
+            return (load_flat_forest, (self.path,))
+        return object.__reduce__(self)
+
+    def native_learner(self):
+        # The original learner, unpickled on first use.
+        if self.native is None and self.has_native:
+            with open(os.path.join(self.path, 'native.pkl'), 'rb') as file_object:
+                self.native = pickle.load(file_object)
+        return self.native
+
+    def apply(self, X):
+        # Leaf index of every (row, tree) pair. Leaves have an
+        # infinite threshold and point to themselves, so a pair that
+        # reached its leaf stays put; once enough pairs are done the
+        # active set is compacted.
+        n_rows = X.shape[0]
+        X_flat = np.ascontiguousarray(X, dtype=np.float32).ravel()
+        has_missing = np.isnan(X_flat).any()
+        leaves = np.tile(np.asarray(self.roots), n_rows)
+        active = np.arange(n_rows*self.n_trees)
+        row_start = np.repeat(np.arange(n_rows)*X.shape[1], self.n_trees)
+        node = leaves.copy()
+        for _ in range(self.max_depth):
+            x = X_flat[row_start + self.feature[node]]
+            go_right = x > self.threshold[node]
+            if has_missing:
+                missing = np.isnan(x)
+                go_right[missing] = self.default_left[node[missing]] == 0
+            new_node = self.child[node] + go_right
+            done = new_node == node
+            n_done = np.count_nonzero(done)
+            if 4*n_done > len(node):
+                leaves[active[done]] = node[done]
+                keep = np.logical_not(done)
+                active = active[keep]
+                row_start = row_start[keep]
+                new_node = new_node[keep]
+            node = new_node
+            if len(node) == 0:
+                break
+        leaves[active] = node
+        return leaves.reshape(n_rows, self.n_trees)
+
+    def predict_raw(self, X, chunk_size=None):
+        # Sum of leaf values, scaled and offset; X already transformed.
+        if chunk_size is None:
+            chunk_size = max(1, CHUNK_ELEMENTS//max(self.n_trees, 1))
+        Y = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], chunk_size):
+            leaves = self.apply(X[start:start+chunk_size])
+            Y[start:start+chunk_size] = self.value[leaves].sum(axis=1, dtype=np.float64)
+        return self.offset + self.scale*Y
+
+    def predict(self, X, chunk_size=None):
+        native = self.native_learner() if X.shape[0] >= NATIVE_MIN_ROWS else None
+        if native is not None:
+            return np.ravel(native.predict(X))
+        return self.predict_flat(X, chunk_size=chunk_size)
+
+    def predict_flat(self, X, chunk_size=None):
+        X = apply_ops(np.array(X, dtype=np.float32), self.input_ops)
+        Y = self.predict_raw(X, chunk_size=chunk_size).reshape(-1, 1)
+        if self.target_inverse is not None:
+            Y = self.target_inverse.inverse_transform(Y)
+        else:
+            Y = apply_ops(Y, self.target_ops)
+        return np.squeeze(Y, axis=1)
+
+def _layout_tree(left, right):
+    # Renumber one tree breadth-first so that the two children of
+    # every internal node are adjacent. Returns the old node id at
+    # each new position, the new child array (leaves point to
+    # themselves) and the depth of the tree.
+    order = [np.array([0])]
+    frontier = order[0]
+    depth = 0
+    while True:
+        internal = frontier[left[frontier] >= 0]
+        if len(internal) == 0:
+            break
+        frontier = np.stack([left[internal], right[internal]], axis=1).ravel()
+        order.append(frontier)
+        depth += 1
+    order = np.concatenate(order)
+    new_id = np.empty(len(left), dtype=np.int64)
+    new_id[order] = np.arange(len(order))
+    child = np.where(left[order] >= 0, new_id[np.maximum(left[order], 0)], np.arange(len(order)))
+    return order, child, depth
+
+def _concatenate_trees(trees):
+    # trees: list of dicts of per-tree arrays with local node ids
+    # and -1 for the children of leaves.
+    arrays = {name: [] for name in ['feature', 'threshold', 'child', 'default_left', 'value']}
+    roots = []
+    offset = 0
+    max_depth = 0
+    for tree in trees:
+        order, child, depth = _layout_tree(tree['left'], tree['right'])
+        leaf = tree['left'][order] < 0
+        arrays['feature'].append(np.where(leaf, 0, tree['feature'][order]))
+        arrays['threshold'].append(np.where(leaf, np.float32(np.inf), tree['threshold'][order]))
+        arrays['child'].append(child + offset)
+        arrays['default_left'].append(np.where(leaf, 1, tree['default_left'][order]))
+        arrays['value'].append(np.where(leaf, tree['value'][order], 0.0))
+        roots.append(offset)
+        offset += len(order)
+        max_depth = max(max_depth, depth)
+    dtypes = {'feature': np.int32, 'threshold': np.float32, 'child': np.int32,
+              'default_left': np.uint8, 'value': np.float32}
+    arrays = {name: np.concatenate(values).astype(dtypes[name]) for name, values in arrays.items()}
+    arrays['roots'] = np.array(roots, dtype=np.int32)
+    return arrays, max_depth
+
+def flatten_sklearn_forest(forest):
+    # ExtraTreesRegressor/RandomForestRegressor (or a single tree).
+    estimators = forest.estimators_ if isinstance(forest, SKLEARN_FORESTS) else [forest]
+    trees = []
+    for estimator in estimators:
+        tree = estimator.tree_
+        default_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=np.uint8))
+        trees.append({
+            'feature': tree.feature,
+            'threshold': float32_at_or_below(tree.threshold),
+            'left': tree.children_left,
+            'right': tree.children_right,
+            'default_left': np.asarray(default_left),
+            'value': tree.value[:, 0, 0]})
+    arrays, max_depth = _concatenate_trees(trees)
+    return arrays, max_depth, 1.0/len(estimators), 0.0
+
+def flatten_xgb_booster(booster):
+    # XGBoost gbtree with an identity-link objective. The JSON
+    # model holds the float32 split conditions exactly; xgboost
+    # goes left if x < split, which for float32 x is the same as
+    # x <= the next float32 below split.
+    model = json.loads(booster.save_raw(raw_format='json'))['learner']
+    if model['gradient_booster']['name'] != 'gbtree':
+        return None
+    if model['objective']['name'] not in XGB_IDENTITY_OBJECTIVES:
+        return None
+    base_score = float(model['learner_model_param']['base_score'])
+    tree_list = model['gradient_booster']['model']['trees']
+    best_iteration = booster.attr('best_iteration')
+    if best_iteration is not None:
+        n_parallel = int(model['gradient_booster']['model']['gbtree_model_param'].get('num_parallel_tree', 1))
+        tree_list = tree_list[:(int(best_iteration) + 1)*n_parallel]
+
+    trees = []
+    for tree_json in tree_list:
+        left = np.asarray(tree_json['left_children'], dtype=np.int64)
+        split = np.asarray(tree_json['split_conditions'], dtype=np.float32)
+        trees.append({
+            'feature': np.asarray(tree_json['split_indices']),
+            'threshold': np.nextafter(split, np.float32(-np.inf)),
+            'left': left,
+            'right': np.asarray(tree_json['right_children'], dtype=np.int64),
+            'default_left': np.asarray(tree_json['default_left']),
+            'value': split})
+    arrays, max_depth = _concatenate_trees(trees)
+    return arrays, max_depth, 1.0, base_score
+
+#=======================================
+# Compiler
+#=======================================
+
+def compile_tree_learner(model):
+    # Compile one fitted submodel whose core estimator is a tree
+    # ensemble. Returns None if the submodel cannot be flattened.
+    steps, core, transformer = unwrap_learner(model)
+
+    if isinstance(core, SKLEARN_FORESTS + (DecisionTreeRegressor,)):
+        flat = flatten_sklearn_forest(core)
+    elif hasattr(core, 'get_booster'):
+        flat = flatten_xgb_booster(core.get_booster())
+    else:
+        return None
+    if flat is None:
+        return None
+
+    input_ops = []
+    for step in steps:
+        ops = scaler_ops(step)
+        if ops is None:
+            return None
+        input_ops.extend(ops)
+
+    target_ops = None
+    target_inverse = None
+    if transformer is not None:
+        target_ops = inverse_scaler_ops(transformer)
+        if target_ops is None:
+            target_inverse = transformer
+
+    arrays, max_depth, scale, offset = flat
+    return FlatForest(arrays, max_depth, scale, offset,
+                      input_ops=input_ops, target_ops=target_ops,
+                      target_inverse=target_inverse)
+
+def save_flat_forest(forest, path, native=None):
+    # native: the original learner, saved for the bulk batches.
+    os.makedirs(path, exist_ok=True)
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(path, name+'.npy'), np.ascontiguousarray(getattr(forest, name)))
+    meta = {
+        'max_depth': forest.max_depth,
+        'scale': forest.scale,
+        'offset': forest.offset,
+        'input_ops': [(op, list(map(float, values))) for op, values in forest.input_ops],
+        'target_ops': [(op, list(map(float, values))) for op, values in forest.target_ops]}
+    with open(os.path.join(path, 'meta.json'), 'w') as json_file:
+        json.dump(meta, json_file, indent = 4)
+    if forest.target_inverse is not None:
+        with open(os.path.join(path, 'target_inverse.pkl'), 'wb') as output:
+            pickle.dump(forest.target_inverse, output, pickle.HIGHEST_PROTOCOL)
+    if native is not None:
+        with open(os.path.join(path, 'native.pkl'), 'wb') as output:
+            pickle.dump(native, output, pickle.HIGHEST_PROTOCOL)
+    forest.path = path
+    forest.has_native = native is not None
+
+def load_flat_forest(path, mmap=True):
+    arrays = {
+        name: np.load(os.path.join(path, name+'.npy'), mmap_mode='r' if mmap else None)
+        for name in ARRAY_NAMES}
+    with open(os.path.join(path, 'meta.json')) as json_file:
+        meta = json.load(json_file)
+    target_inverse = None
+    if os.path.exists(os.path.join(path, 'target_inverse.pkl')):
+        with open(os.path.join(path, 'target_inverse.pkl'), 'rb') as file_object:
+            target_inverse = pickle.load(file_object)
+    forest = FlatForest(
+        arrays, meta['max_depth'], meta['scale'], meta['offset'],
+        input_ops=[(op, np.array(values)) for op, values in meta['input_ops']],
+        target_ops=[(op, np.array(values)) for op, values in meta['target_ops']],
+        target_inverse=target_inverse)
+    forest.path = path
+    forest.has_native = os.path.exists(os.path.join(path, 'native.pkl'))
+    return forest
+
+def compile_superlearner_trees(stacked, out_dir=None):
+    # Compile all tree-ensemble learners of a fitted
+    # StackingRegressor, optionally saving each one under
+    # out_dir/<learner name>, with the original learner, and the
+    # stacked model without them as out_dir/stacked.pkl.
+    # Returns {name: FlatForest}.
+    names = [name for name, est in stacked.estimators if est != 'drop']
+    learners = {}
+    for name, model in zip(names, stacked.estimators_):
+        compiled = compile_tree_learner(model)
+        if compiled is None:
+            continue
+        if out_dir is not None:
+            save_flat_forest(compiled, os.path.join(out_dir, name), native=model)
+        learners[name] = compiled
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, 'stacked.pkl'), 'wb') as output:
+            pickle.dump(strip_learners(stacked, learners), output, pickle.HIGHEST_PROTOCOL)
+    return learners
+
+def strip_learners(stacked, names):
+    # Shallow copy of a fitted StackingRegressor whose learners in
+    # names are replaced by None (they are predicted by their
+    # compiled forms).
+    stripped = copy.copy(stacked)
+    all_names = [name for name, est in stacked.estimators if est != 'drop']
+    stripped.estimators_ = [None if name in names else model
+                            for name, model in zip(all_names, stacked.estimators_)]
+    stripped.named_estimators_ = copy.copy(stacked.named_estimators_)
+    for name in names:
+        stripped.named_estimators_[name] = None
+    return stripped
+
+def load_stripped_stacked(out_dir):
+    # The stacked model saved by compile_superlearner_trees, or
+    # None for a model dir compiled before it was saved.
+    if not os.path.isfile(os.path.join(out_dir, 'stacked.pkl')):
+        return None
+    with open(os.path.join(out_dir, 'stacked.pkl'), 'rb') as file_object:
+        return pickle.load(file_object)
+
+def load_superlearner_trees(out_dir, mmap=True):
+    # Load all learners saved by compile_superlearner_trees.
+    learners = {}
+    if os.path.isdir(out_dir):
+        for name in sorted(os.listdir(out_dir)):
+            if os.path.exists(os.path.join(out_dir, name, 'meta.json')):
+                learners[name] = load_flat_forest(os.path.join(out_dir, name), mmap=mmap)
+    return learners
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner compile_trees arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    num_inputs = int(args.num_inputs)
+
+    sys.path.append(model_dir)
+    with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+        superlearner = pickle.load(file_object)
+
+    if getattr(args, 'predict_var', None) is not None:
+        onames = [args.predict_var]
+    else:
+        onames = list(superlearner.keys())
+
+    # Check the compiled forms against the original learners.
+    if getattr(args, 'predict_data', None) is not None:
+        predict_df = pd.read_csv(args.predict_data+'.csv').astype(np.float32)
+        predict_df.fillna(predict_df.mean(),inplace=True)
+        X_check = predict_df.values
+    else:
+        train_df = pd.read_csv(model_dir+'/train.csv').astype(np.float32)
+        X_check = train_df.values[:, :num_inputs]
+
+    for oname in onames:
+        print('Compiling tree learners for output: '+oname, flush=True)
+        stacked = superlearner[oname]
+        out_dir = model_dir+'/compiled_trees/'+oname
+        compile_superlearner_trees(stacked, out_dir=out_dir)
+
+        for name, forest in load_superlearner_trees(out_dir).items():
+            model_object = stacked.named_estimators_[name]
+            tic = time.perf_counter()
+            Y_ref = model_object.predict(X_check)
+            t_ref = time.perf_counter() - tic
+            tic = time.perf_counter()
+            Y_fast = forest.predict_flat(X_check)
+            t_fast = time.perf_counter() - tic
+            print('{}: {} trees, {} nodes, max abs diff {:.3e}, original {:.4f} s, flat {:.4f} s'.format(
+                name, forest.n_trees, forest.n_nodes, np.max(np.abs(Y_ref - Y_fast)), t_ref, t_fast))
+
+    print("Done!")
@@ -0,0 +1,223 @@
+#================================
+# SuperLearner distillation
+#================================
+# Distill an ensemble of trained
+# SuperLearner instances into one
+# compact surrogate model.
+#
+# Global maps average num_inst
+# SuperLearners, each stacking up
+# to 15 submodels, so every
+# prediction site costs hundreds
+# of model evaluations. Here the
+# ensemble mean is computed once
+# over the training/testing data
+# and the (unlabeled) prediction
+# sites, and a single histogram
+# gradient boosting model is fit
+# to reproduce it. A held-out set
+# of rows measures how closely the
+# surrogate follows the ensemble
+# (fidelity), reported separately
+# for the labeled and prediction
+# site rows.
+#
+# The surrogate is written to
+# <output_dir>/surrogate.pkl and
+# can be used by predict.py with
+# --surrogate <output_dir>/surrogate.pkl
+#
+# Command line execution:
+# python -m distill
+# --model_dirs ./ml_models/sl_0,./ml_models/sl_1
+# --predict_var <target name>
+# --num_inputs 25
+# --predict_data ./path/to/predict_data
+# --output_dir ./surrogate
+# (optional) --max_sites 200000
+# (optional) --max_iter 500
+# (optional) --holdout 0.2
+# (optional) --seed 42
+#================================
+
+# Dependencies
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_absolute_error
+from sklearn.metrics import mean_squared_error
+from sklearn.metrics import r2_score
+from stacking import StackedPredictor
+
+# Number of rows sent through the SuperLearners at once.
+CHUNK_ROWS = 50000
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def load_superlearners(model_dirs):
+    # Load SuperLearners.pkl from each instance directory. The
+    # directory must be on the path to unpickle the conf module.
+    superlearners = []
+    for model_dir in model_dirs:
+        sys.path.append(model_dir)
+        with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+            superlearners.append(pickle.load(file_object))
+    return superlearners
+
+def ensemble_mean(superlearners, predict_var, X):
+    # Mean prediction of all SuperLearner instances, in row chunks
+    # to bound the memory used by the submodels.
+    predictors = [StackedPredictor(superlearner[predict_var]) for superlearner in superlearners]
+    Y = np.zeros(X.shape[0])
+    for start in range(0, X.shape[0], CHUNK_ROWS):
+        X_chunk = X[start:start+CHUNK_ROWS]
+        for predictor in predictors:
+            Y[start:start+CHUNK_ROWS] += np.squeeze(predictor.predict(X_chunk))
+    return Y/len(superlearners)
+
+def fidelity(Y_ensemble, Y_surrogate):
+    # How closely the surrogate reproduces the ensemble.
+    return {
+        'n': int(len(Y_ensemble)),
+        'r2': float(r2_score(Y_ensemble, Y_surrogate)),
+        'rmse': float(np.sqrt(mean_squared_error(Y_ensemble, Y_surrogate))),
+        'mae': float(mean_absolute_error(Y_ensemble, Y_surrogate)),
+        'max_abs_error': float(np.max(np.abs(Y_ensemble - Y_surrogate)))}
+
+def load_surrogate(path, predict_var=None, feature_names=None):
+    # Load a surrogate written by this script, checking that it
+    # was distilled for the requested output variable and, if
+    # given, for the same input columns in the same order.
+    with open(path, 'rb') as file_object:
+        surrogate = pickle.load(file_object)
+    if predict_var is not None and surrogate['predict_var'] != predict_var:
+        raise ValueError('Surrogate '+path+' was distilled for '+
+                         surrogate['predict_var']+', not '+predict_var)
+    if feature_names is not None and list(feature_names) != list(surrogate['feature_names']):
+        missing = [name for name in surrogate['feature_names'] if name not in feature_names]
+        extra = [name for name in feature_names if name not in surrogate['feature_names']]
+        raise ValueError('Surrogate '+path+' was distilled for other input columns'+
+                         (' (missing: '+', '.join(missing)+')' if missing else '')+
+                         (' (unexpected: '+', '.join(extra)+')' if extra else '')+
+                         ('' if missing or extra else ' (same columns in a different order)'))
+    return surrogate
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner distill arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dirs = args.model_dirs.split(',')
+    predict_var = args.predict_var
+    num_inputs = int(args.num_inputs)
+    output_dir = args.output_dir
+    max_sites = int(getattr(args, 'max_sites', None) or 200000)
+    max_iter = int(getattr(args, 'max_iter', None) or 500)
+    holdout = float(getattr(args, 'holdout', None) or 0.2)
+    seed = int(getattr(args, 'seed', None) or 42)
+    rng = np.random.default_rng(seed)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    superlearners = load_superlearners(model_dirs)
+    print('Loaded '+str(len(superlearners))+' SuperLearner instances')
+
+    #===========================================================
+    # Assemble the distillation inputs: all labeled rows (the
+    # train/test split differs between instances, so use the
+    # first instance's train.csv + test.csv) plus a subsample
+    # of the prediction sites.
+    #===========================================================
+    labeled_df = pd.concat(
+        (pd.read_csv(model_dirs[0]+'/train.csv'),
+         pd.read_csv(model_dirs[0]+'/test.csv')),axis=0).astype(np.float32)
+    feature_names = list(labeled_df.columns[:num_inputs])
+    X_labeled = labeled_df.values[:, :num_inputs]
+
+    predict_df = pd.read_csv(args.predict_data+'.csv').astype(np.float32)
+    predict_df.fillna(predict_df.mean(),inplace=True)
+    X_sites = predict_df.values
+    if X_sites.shape[0] > max_sites:
+        X_sites = X_sites[np.sort(rng.choice(X_sites.shape[0], max_sites, replace=False))]
+
+    X = np.concatenate((X_labeled, X_sites), axis=0)
+    is_site = np.concatenate((np.zeros(len(X_labeled), dtype=bool), np.ones(len(X_sites), dtype=bool)))
+    print('Distilling on '+str(len(X_labeled))+' labeled rows and '+str(len(X_sites))+' prediction sites')
+
+    tic = time.perf_counter()
+    Y = ensemble_mean(superlearners, predict_var, X)
+    t_ensemble = time.perf_counter() - tic
+
+    #===========================================================
+    # Fit the surrogate and measure its fidelity on held-out rows
+    #===========================================================
+    test_mask = rng.random(len(X)) < holdout
+    train_mask = np.logical_not(test_mask)
+
+    surrogate_model = HistGradientBoostingRegressor(
+        max_iter=max_iter,
+        learning_rate=0.05,
+        max_leaf_nodes=63,
+        min_samples_leaf=5,
+        early_stopping=True,
+        validation_fraction=0.1,
+        n_iter_no_change=20,
+        random_state=seed)
+    surrogate_model.fit(X[train_mask], Y[train_mask])
+
+    tic = time.perf_counter()
+    Y_surrogate = surrogate_model.predict(X)
+    t_surrogate = time.perf_counter() - tic
+
+    report = {
+        'model_dirs': model_dirs,
+        'predict_var': predict_var,
+        'n_iter': int(surrogate_model.n_iter_),
+        'holdout': fidelity(Y[test_mask], Y_surrogate[test_mask]),
+        'holdout_labeled': fidelity(Y[test_mask & ~is_site], Y_surrogate[test_mask & ~is_site]),
+        'holdout_sites': fidelity(Y[test_mask & is_site], Y_surrogate[test_mask & is_site]),
+        'train': fidelity(Y[train_mask], Y_surrogate[train_mask]),
+        'seconds_per_row_ensemble': t_ensemble/len(X),
+        'seconds_per_row_surrogate': t_surrogate/len(X)}
+
+    for key in ['holdout', 'holdout_labeled', 'holdout_sites']:
+        print('{}: R2 {:.4f}, RMSE {:.4g}, max abs error {:.4g}'.format(
+            key, report[key]['r2'], report[key]['rmse'], report[key]['max_abs_error']))
+    print('Speedup over ensemble: {:.1f}x'.format(t_ensemble/t_surrogate))
+
+    with open(output_dir+'/surrogate_fidelity.json', 'w') as json_file:
+        json.dump(report, json_file, indent = 4)
+
+    # The surrogate is pure sklearn, so it unpickles without the
+    # conf modules on the path.
+    surrogate = {
+        'model': surrogate_model,
+        'predict_var': predict_var,
+        'feature_names': feature_names,
+        'model_dirs': model_dirs,
+        'fidelity': report['holdout']}
+    with open(output_dir+'/surrogate.pkl', 'wb') as output:
+        pickle.dump(surrogate, output, pickle.HIGHEST_PROTOCOL)
+
+    print("Done!")
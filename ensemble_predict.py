@@ -0,0 +1,130 @@
+#================================
+# SuperLearner ensemble predict
+#================================
+# Make predictions with all the
+# SuperLearner instances of an
+# ensemble (ml_models/sl_<i>) in
+# one pass over the inputs.
+#
+# Instead of running predict.py
+# in every instance directory and
+# merging N prediction files
+# afterwards, the prediction
+# inputs are read once, in chunks,
+# and each chunk is sent through
+# every instance's model. The
+# single output file holds the
+# ensemble mean and standard
+# deviation at each site and,
+# optionally, the prediction of
+# each instance.
+#
+# Command line execution:
+# python -m ensemble_predict
+# --model_dirs "./ml_models/sl_*"
+#   (or a comma separated list of dirs)
+# --predict_var <target name>
+# --predict_data ./path/to/predict_data
+# --output_file ./sl_ensemble_predictions.csv
+# (optional) --per_instance True
+# (optional) --chunk_size 100000
+# (optional) --n_jobs 1
+#================================
+
+# Dependencies
+import argparse
+import glob
+import os
+import re
+import numpy as np
+import stream
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def natural_key(path):
+    # Sort sl_2 before sl_10.
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+def expand_model_dirs(spec):
+    # Comma separated list of dirs and/or glob patterns.
+    model_dirs = []
+    for item in spec.split(','):
+        if glob.has_magic(item):
+            model_dirs += sorted(
+                [path for path in glob.glob(item) if os.path.isfile(path+'/SuperLearners.pkl')],
+                key=natural_key)
+        else:
+            model_dirs.append(item)
+    if len(model_dirs) == 0:
+        raise ValueError('No SuperLearner model directories match '+spec)
+    return model_dirs
+
+def instance_names(model_dirs):
+    # Column suffix for each instance; the directory name, unless
+    # directory names repeat.
+    names = [os.path.basename(os.path.normpath(model_dir)) for model_dir in model_dirs]
+    if len(set(names)) < len(names):
+        names = ['sl_'+str(ii) for ii in range(len(model_dirs))]
+    return names
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner ensemble_predict arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dirs = expand_model_dirs(args.model_dirs)
+    predict_var = args.predict_var
+    predict_data_csv = args.predict_data+'.csv'
+    predict_data_ixy = args.predict_data+'.ixy'
+    output_file = args.output_file
+    per_instance = str(getattr(args, 'per_instance', None)) in ('True', 'true')
+    chunk_size = int(getattr(args, 'chunk_size', None) or 100000)
+    n_jobs = int(getattr(args, 'n_jobs', None) or 1)
+    if n_jobs < 0:
+        n_jobs = stream.default_n_jobs()
+
+    names = instance_names(model_dirs)
+    print("Predicting "+predict_var+" with "+str(len(model_dirs))+" SuperLearner instances:")
+    print(model_dirs)
+
+    #===========================================================
+    # Stream the inputs through every instance
+    #===========================================================
+    fill_values = stream.column_means(predict_data_csv, chunk_size)
+    chunks = stream.iter_chunks(predict_data_csv, predict_data_ixy, chunk_size, fill_values)
+    results = stream.ordered_map(
+        stream.predict_ensemble_chunk,
+        chunks,
+        n_jobs=n_jobs,
+        initializer=stream.init_ensemble_worker,
+        initargs=(model_dirs, predict_var))
+
+    first = True
+    n_rows = 0
+    for Y_instances, output_df in results:
+        output_df[predict_var] = np.mean(Y_instances, axis=0)
+        output_df[predict_var+'.std'] = np.std(Y_instances, axis=0)
+        if per_instance:
+            for name, Y_predict in zip(names, Y_instances):
+                output_df[predict_var+'.'+name] = Y_predict
+        stream.append_csv(output_df, output_file, first)
+        first = False
+        n_rows += len(output_df)
+
+    print("Wrote "+str(n_rows)+" sites to "+output_file)
+    print("Done!")
@@ -27,6 +27,61 @@
 # could still be avaiable
 # to the model via a
 # separate correlated feature.
+#
+# The permutations of the stacked
+# model and all submodels are
+# spread over --n_jobs workers
+# (--prefer processes or threads)
+# and seeded with --seed (default
+# 0), so results are reproducible
+# and independent of --n_jobs.
+# The repeats of a block are
+# predicted as one batch (up to
+# --batch_rows rows) and scored
+# with MSE, R2 and MAE at once;
+# MSE is saved to
+# sl_fpi_results_df and
+# model_fpi_results_df, R2 and MAE
+# to the same names with _r2 and
+# _mae before _df.
+#
+# By default every block gets
+# --n_repeats 20 permutations.
+# With --tolerance <SE>, blocks get
+# rounds of --n_repeats (default 5)
+# until the standard error of their
+# MSE ratio is below the tolerance
+# for all models, up to
+# --max_repeats (default 100). The
+# repeats used per block are saved
+# to fpi_repeats_df.
+#
+# For large data sets, --subsample_ci
+# <half width> runs FPI on a
+# target-stratified subset of the
+# rows, sized from a pilot run
+# (--pilot_rows, default 1000) so
+# that each block's MSE ratio is
+# known to +/- the half width
+# (--confidence, default 0.95;
+# --max_rows caps the subset). The
+# intervals achieved are saved to
+# sl_fpi_ci_df and model_fpi_ci_df.
+#
+# Ensemble FPI: with --model_dirs
+# "./ml_models/sl_*" (instead of
+# --model_dir) the correlation
+# groups and the data are computed
+# once (from the first instance)
+# and all instances' models are
+# permuted in one parallel run.
+# The per-instance columns (job id
+# = position in the list written
+# to fpi_instances) and the mean
+# and std over the instances
+# (sl_fpi_ensemble_df,
+# model_fpi_ensemble_df) are saved
+# to --output_dir.
 #========================
 
 # Dependencies
@@ -35,14 +90,552 @@ import pickle
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.metrics import mean_squared_error
-from sklearn.utils import shuffle
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from sklearn.preprocessing import MaxAbsScaler
+from scipy import stats
 import seaborn as sns
 import igraph as ig
+import os
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from stacking import StackedPredictor
+from ensemble_predict import expand_model_dirs
+
+#==========================================================
+# FPI functions
+#==========================================================
+
+#----------------------------------------------------------
+# Scores of each repeat, vectorized over the rows of Y
+# (n_repeats, n_samples). They are all computed from the same
+# predictions.
+def mse_scores(y, Y):
+    return np.mean((Y - y)**2, axis=1)
+
+def mae_scores(y, Y):
+    return np.mean(np.abs(Y - y), axis=1)
+
+def r2_scores(y, Y):
+    return 1.0 - np.sum((Y - y)**2, axis=1)/np.sum((y - np.mean(y))**2)
+
+SCORERS = {'mse': mse_scores, 'r2': r2_scores, 'mae': mae_scores}
+
+def vectorized_scorer(scoring_func):
+    # Score each row of Y with a scoring_func(y_true, y_pred).
+    return lambda y, Y: np.array([scoring_func(y, row) for row in Y])
+
+#----------------------------------------------------------
+# Each task scores all models on a batch of repeats of one block:
+# the repeats are stacked into one array so every model predicts
+# once per batch. The rows of a block are permuted with a
+# generator seeded by the seed, the repeat and the block's
+# columns (not its position, since the order of the groups can
+# change between runs), so the results do not depend on the
+# batching or on how the tasks are spread over workers
+# (--n_jobs, --prefer processes|threads).
+def block_permutation(seed, columns, repeat, n_rows):
+    return np.random.default_rng([seed, repeat] + sorted(int(column) for column in columns)).permutation(n_rows)
+
+# State of an FPI worker, set once per worker by init_fpi_worker
+# so that the models and data are not sent with every task. X is
+# the contiguous float32 base array; each worker thread keeps one
+# working buffer of tiled copies of X (see working_buffer).
+_fpi_state = None
+
+def init_fpi_worker(models, X, y, blocks, scorers, seed, model_dir=None):
+    global _fpi_state
+    if model_dir is not None and model_dir not in sys.path:
+        # Needed to unpickle the SuperLearner conf module.
+        sys.path.append(model_dir)
+    _fpi_state = {
+        'models': models,
+        'X': X,
+        'y': y,
+        'blocks': blocks,
+        'scorers': scorers,
+        'seed': seed,
+        'local': threading.local()}
+
+def working_buffer(state, n_copies):
+    # n_copies stacked copies of X from this thread's buffer, which
+    # is allocated once (grown if needed) and reused by all tasks.
+    # Tasks permute block columns in place and restore them, so
+    # the buffer always holds copies of X between tasks.
+    X = state['X']
+    buffer = getattr(state['local'], 'buffer', None)
+    if buffer is None or buffer.shape[0] < n_copies*X.shape[0]:
+        buffer = np.tile(X, (n_copies, 1))
+        state['local'].buffer = buffer
+    return buffer[:n_copies*X.shape[0]]
+
+def predict_models(models, X):
+    # {name: predictions} of all models. The stacked prediction is
+    # a linear blend of the base learner predictions, so a
+    # StackedPredictor's learner predictions are reused for any of
+    # its learners that are also scored on their own.
+    predictions = {}
+    learner_predictions = {}
+    for name, model in models.items():
+        if isinstance(model, StackedPredictor):
+            predictions[name], P = model.predict_learners(X)
+            for jj, ii in enumerate(model.active):
+                learner_predictions[id(model.stacked.estimators_[ii])] = P[:, jj]
+    for name, model in models.items():
+        if name not in predictions:
+            if id(model) in learner_predictions:
+                predictions[name] = learner_predictions[id(model)]
+            else:
+                predictions[name] = model.predict(X)
+    return predictions
+
+def fpi_task(task):
+    # {scorer: {model name: scores of the repeats}} with one block
+    # permuted (block_index -1: no permutation, the base scores).
+    block_index, repeats = task
+    state = _fpi_state
+    X = state['X']
+    n_rows = X.shape[0]
+    if block_index >= 0:
+        # Only the block's columns are written: each repeat's slice
+        # of the buffer gets the rows of X in permuted order.
+        columns = state['blocks'][block_index]
+        perms = [block_permutation(state['seed'], columns, repeat, n_rows) for repeat in repeats]
+        X = working_buffer(state, len(repeats))
+        for kk, perm in enumerate(perms):
+            X[kk*n_rows:(kk+1)*n_rows, columns] = state['X'][np.ix_(perm, columns)]
+    predictions = predict_models(state['models'], X)
+    if block_index >= 0:
+        for kk in range(len(repeats)):
+            X[kk*n_rows:(kk+1)*n_rows, columns] = state['X'][:, columns]
+    return {scorer: {name: scorer_func(state['y'], np.reshape(Y, (len(repeats), n_rows)))
+                     for name, Y in predictions.items()}
+            for scorer, scorer_func in state['scorers'].items()}
+
+def repeat_tasks(block_index, start, stop, batch):
+    # Tasks for repeats start..stop-1 of a block, batch repeats each.
+    return [(block_index, list(range(first, min(first+batch, stop))))
+            for first in range(start, stop, batch)]
+
+def run_fpi(permutation_feature_blocks_str, models, X, y, scorers=None, n_repeats=20, ratio_score=True,
+            seed=0, n_jobs=1, prefer='processes', batch_rows=100000, tolerance=None, max_repeats=100,
+            model_dir=None, verbose=False, return_repeats=False, return_scores=False):
+    # FPI of several models ({name: model}) on the same data, as
+    # {scorer: {name: [(block name, mean, std)]}} in block order.
+    # scorers: {name: f(y, Y) -> score of each row of Y}, by
+    # default SCORERS (MSE, R2 and MAE). Repeats are batched up to
+    # batch_rows rows per predict call.
+    #
+    # With a tolerance, repeats are drawn in rounds of n_repeats
+    # per block until the standard error of the mean (ratio) score
+    # of the first scorer is below tolerance for every model, or
+    # the block has max_repeats repeats. Without it, every block
+    # gets n_repeats. With return_repeats, also returns the
+    # [(block name, repeats used)]. With return_scores, the mean
+    # and std are of the scores themselves (not relative to the
+    # base score), and the base scores {scorer: {name: score}} are
+    # returned after the repeats used.
+    scorers = scorers or SCORERS
+    primary = next(iter(scorers))
+    blocks, block_names = parse_permutation_feature_blocks(
+        permutation_feature_blocks_str, X.columns)
+    column_idx = {v: k for k, v in enumerate(X.columns)}
+    block_columns = [np.array([column_idx[name] for name in block]) for block in blocks]
+    X = np.ascontiguousarray(X.values, dtype=np.float32)
+    y = np.asarray(y)
+    if tolerance is None:
+        max_repeats = n_repeats
+
+    batch = max(1, min(n_repeats, batch_rows//X.shape[0]))
+    initargs = (models, X, y, block_columns, scorers, seed, model_dir)
+    pool = None
+    if n_jobs <= 1 or prefer == 'threads':
+        init_fpi_worker(*initargs)
+    if n_jobs > 1:
+        if prefer == 'threads':
+            pool = ThreadPoolExecutor(max_workers=n_jobs)
+        else:
+            pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=init_fpi_worker, initargs=initargs)
+
+    # repeat_scores[scorer][name][block]: scores of all repeats so far
+    repeat_scores = {scorer: {name: [[] for block in blocks] for name in models} for scorer in scorers}
+    repeats_used = [0 for block in blocks]
+    active = list(range(len(blocks)))
+    tasks = [(-1, [0])]
+    try:
+        while len(active) > 0:
+            for block_index in active:
+                stop = min(repeats_used[block_index] + n_repeats, max_repeats)
+                tasks += repeat_tasks(block_index, repeats_used[block_index], stop, batch)
+                repeats_used[block_index] = stop
+            if verbose:
+                print('Running '+str(len(tasks))+' FPI tasks on '+str(n_jobs)+' worker(s)')
+            if pool is None:
+                scores = [fpi_task(task) for task in tasks]
+            else:
+                scores = list(pool.map(fpi_task, tasks, chunksize=max(1, len(tasks)//(4*n_jobs))))
+            if tasks[0][0] == -1:
+                base_scores = {scorer: {name: scores[0][scorer][name][0] for name in models} for scorer in scorers}
+                tasks, scores = tasks[1:], scores[1:]
+            for (block_index, repeats), task_scores in zip(tasks, scores):
+                for scorer in scorers:
+                    for name in models:
+                        repeat_scores[scorer][name][block_index].extend(task_scores[scorer][name])
+
+            # Blocks that need more repeats
+            still_active = []
+            for block_index in active:
+                if repeats_used[block_index] >= max_repeats:
+                    continue
+                for name in models:
+                    block_repeat_scores = repeat_scores[primary][name][block_index]
+                    standard_error = np.std(block_repeat_scores, ddof=1)/np.sqrt(len(block_repeat_scores))
+                    if ratio_score:
+                        standard_error = standard_error/abs(base_scores[primary][name])
+                    if not standard_error < tolerance:
+                        still_active.append(block_index)
+                        break
+            active = still_active
+            tasks = []
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    results = {}
+    for scorer in scorers:
+        results[scorer] = {}
+        for name in models:
+            base_score = base_scores[scorer][name]
+            block_scores = list()
+            for block_name, block_repeat_scores in zip(block_names, repeat_scores[scorer][name]):
+                if return_scores:
+                    block_scores.append((block_name, np.mean(block_repeat_scores), np.std(block_repeat_scores)))
+                    continue
+                # Get block score
+                importance_score_mean = np.mean(block_repeat_scores) / base_score if ratio_score else np.mean(block_repeat_scores) - base_score
+                importance_score_std = np.std(block_repeat_scores) / base_score if ratio_score else np.std(block_repeat_scores) - base_score
+                block_scores.append((block_name, importance_score_mean, importance_score_std))
+            results[scorer][name] = block_scores
+
+    # Return output unsorted. For coalescing FPI output from many
+    # runs, we don't want sorting - we'll take the mean over many
+    # models and then sort later.
+    if return_scores:
+        return results, list(zip(block_names, repeats_used)), base_scores
+    if return_repeats:
+        return results, list(zip(block_names, repeats_used))
+    return results
+
+#----------------------------------------------------------
+def permute_importance(permutation_feature_blocks_str, model, X, y, scoring_func, n_repeats=20, ratio_score=True, verbose=False, seed=0,
+                       tolerance=None, max_repeats=100):
+    # FPI of a single model with scoring_func(y_true, y_pred), see
+    # run_fpi.
+    return run_fpi(permutation_feature_blocks_str, {'model': model}, X, y, {'score': vectorized_scorer(scoring_func)},
+                   n_repeats=n_repeats, ratio_score=ratio_score, seed=seed, tolerance=tolerance,
+                   max_repeats=max_repeats, verbose=verbose)['score']['model']
+
+#----------------------------------------------------------
+# Subsampled FPI for large data sets. The rows are drawn
+# stratified on the target (equal shares of each quantile bin of
+# y), so a small subset keeps the range of the target and the
+# error of the ratios is lower than with a plain random subset.
+# The subset is dealt into folds that each get the same mix of
+# bins. FPI runs on each fold, and the permuted and base errors
+# are pooled over the folds before taking their ratio: a mean of
+# the fold ratios is biased upwards by the folds with a small,
+# noisy base error. The confidence interval is the jackknife
+# over the folds (leaving out one fold at a time), since the
+# repeat spread alone does not include the choice of rows.
+def stratified_folds(y, n_rows, n_folds=5, n_strata=10, seed=0):
+    # Row positions of n_rows rows (at most all rows) drawn without
+    # replacement from n_strata quantile bins of y in proportion to
+    # their size, as n_folds folds.
+    y = np.asarray(y, dtype=np.float64)
+    n_rows = min(int(n_rows), len(y))
+    rng = np.random.default_rng([seed, n_rows])
+    edges = np.quantile(y, np.linspace(0, 1, n_strata+1)[1:-1])
+    strata = np.searchsorted(edges, y, side='right')
+    # Largest remainder allocation of n_rows over the bins
+    quota = np.bincount(strata, minlength=n_strata)*n_rows/len(y)
+    take = np.floor(quota).astype(int)
+    take[np.argsort(take - quota, kind='stable')[:n_rows - take.sum()]] += 1
+    rows = np.concatenate([rng.permutation(np.flatnonzero(strata == stratum))[:take[stratum]]
+                           for stratum in range(n_strata)])
+    return [np.sort(rows[fold::n_folds]) for fold in range(n_folds)]
+
+def fold_fpi(permutation_feature_blocks_str, models, X, y, folds, confidence=0.95, **fpi_kwargs):
+    # run_fpi on each fold. Returns the results in the run_fpi
+    # format for all the fold rows together (the scores are
+    # row-weighted means over the folds; the std assumes
+    # independent repeats in each fold), the jackknife intervals
+    # {scorer: {name: [(block name, low, high)]}} with a t
+    # quantile, and the [(block name, most repeats used in a
+    # fold)].
+    y = np.asarray(y)
+    ratio_score = fpi_kwargs.get('ratio_score', True)
+    fold_results = []
+    fold_base_scores = []
+    fold_repeats = []
+    for fold in folds:
+        result, repeats_used, base_scores = run_fpi(
+            permutation_feature_blocks_str, models, X.iloc[fold], y[fold],
+            return_scores=True, **fpi_kwargs)
+        fold_results.append(result)
+        fold_base_scores.append(base_scores)
+        fold_repeats.append([repeats for block_name, repeats in repeats_used])
+    block_names = [block_name for block_name, repeats in repeats_used]
+    n_folds = len(folds)
+    fold_rows = np.array([len(fold) for fold in folds], dtype=np.float64)
+    # Row weights of all folds, and of all folds but one (rows)
+    weights = fold_rows/fold_rows.sum()
+    leave_one_out = (1.0 - np.eye(n_folds))*fold_rows
+    leave_one_out /= leave_one_out.sum(axis=1, keepdims=True)
+    t_value = stats.t.ppf(0.5 + confidence/2, n_folds - 1)
+
+    def importance(permuted, base):
+        return permuted/base[..., None] if ratio_score else permuted - base[..., None]
+
+    results = {}
+    intervals = {}
+    for scorer in fold_results[0]:
+        results[scorer] = {}
+        intervals[scorer] = {}
+        for name in models:
+            # (n_folds, n_blocks, [mean, std]) and (n_folds,)
+            scores = np.array([[block[1:] for block in result[scorer][name]] for result in fold_results])
+            base = np.array([base_scores[scorer][name] for base_scores in fold_base_scores])
+            pooled_base = weights @ base
+            estimate = importance(weights @ scores[:, :, 0], pooled_base)
+            std = np.sqrt((weights**2) @ scores[:, :, 1]**2)
+            std = std/abs(pooled_base) if ratio_score else std
+            jackknife = importance(leave_one_out @ scores[:, :, 0], leave_one_out @ base)
+            half_width = t_value*np.sqrt((n_folds - 1)/n_folds*
+                                         np.sum((jackknife - jackknife.mean(axis=0))**2, axis=0))
+            results[scorer][name] = list(zip(block_names, estimate, std))
+            intervals[scorer][name] = list(zip(block_names, estimate - half_width, estimate + half_width))
+    return results, intervals, list(zip(block_names, np.max(fold_repeats, axis=0)))
+
+def subsample_fpi(permutation_feature_blocks_str, models, X, y, half_width, pilot_rows=1000,
+                  n_folds=5, n_strata=10, confidence=0.95, max_rows=None, precision_models=None,
+                  seed=0, verbose=False, **fpi_kwargs):
+    # FPI on a target-stratified subset of the rows, sized so that
+    # the confidence interval of every block's ratio (first
+    # scorer) is at most +/- half_width for precision_models
+    # (default: all models).
+    #
+    # A pilot run on pilot_rows rows gives the interval half width
+    # h of each block; since it shrinks as 1/sqrt(rows), the subset
+    # needs pilot_rows*(h/half_width)**2 rows for the widest block
+    # (at least pilot_rows, at most max_rows or all rows). Returns
+    # fold_fpi's output and the number of rows used.
+    precision_models = precision_models or list(models)
+    max_rows = min(max_rows or len(y), len(y))
+    pilot_rows = min(pilot_rows, max_rows)
+    fpi_kwargs['seed'] = seed
+    pilot, pilot_intervals, pilot_repeats = fold_fpi(
+        permutation_feature_blocks_str, models, X, y,
+        stratified_folds(y, pilot_rows, n_folds, n_strata, seed), confidence, **fpi_kwargs)
+
+    scorer = next(iter(pilot_intervals))
+    pilot_width = max((high - low)/2 for name in precision_models
+                      for block_name, low, high in pilot_intervals[scorer][name])
+    n_rows = int(np.clip(np.ceil(pilot_rows*(pilot_width/half_width)**2), pilot_rows, max_rows))
+    if verbose:
+        print('Pilot FPI on '+str(pilot_rows)+' rows: widest interval +/-'+str(pilot_width)+
+              ', subset of '+str(n_rows)+' rows for +/-'+str(half_width))
+    if n_rows == pilot_rows:
+        return pilot, pilot_intervals, pilot_repeats, n_rows
+    # The subset is drawn independently of the pilot rows.
+    results, intervals, repeats_used = fold_fpi(
+        permutation_feature_blocks_str, models, X, y,
+        stratified_folds(y, n_rows, n_folds, n_strata, seed + 1), confidence, **fpi_kwargs)
+    return results, intervals, repeats_used, n_rows
+
+#----------------------------------------------------------
+def weighted_models(superlearner_var, min_weight=0.1):
+    # Names of the submodels with a stacking weight above
+    # min_weight. This only works for the scipy.optimize.nnls
+    # stacking regressor, not the sklearn stacking regressors.
+    sl_weights = superlearner_var.final_estimator_.weights_
+    return [model for model, weight in zip(superlearner_var.named_estimators_.keys(), sl_weights)
+            if weight > min_weight]
+
+def ensemble_fpi(results_df, models, job_list):
+    # Mean and standard deviation over the jobs of the
+    # Avg_Ratio<model><job_id> columns of results_df, for each
+    # model (only the jobs that include the model).
+    ensemble_df = pd.DataFrame(index=results_df.index)
+    for model in models:
+        columns = [column for column in ['Avg_Ratio'+model+str(job_id) for job_id in job_list]
+                   if column in results_df.columns]
+        ensemble_df['Avg_Ratio'+model] = results_df[columns].mean(axis=1)
+        ensemble_df['Std_Ratio'+model] = results_df[columns].std(axis=1, ddof=0)
+        ensemble_df['N_Instances'+model] = len(columns)
+    return ensemble_df
+
+#----------------------------------------------------------
+def parse_permutation_feature_blocks(
+    permutation_feature_blocks_str, df_column_index):
+    
+    blocks = [
+        [bl_item.strip() for bl_item in bl.strip().split(',')]
+        for bl in permutation_feature_blocks_str.strip().split(';')
+    ]  if permutation_feature_blocks_str else list()
+
+    column_idx = {v: k for k, v in enumerate(df_column_index)}
+    blocks_ = list()
+    blocks_names = list()
+    explicit_blocks = set()
+    for bl in blocks:
+        parsed_block = list()
+        for bl_item in bl:
+            if ':' in bl_item:
+                start_col, end_col = bl_item.split(':')
+                parsed_block.extend(
+                    list(df_column_index[column_idx[start_col]:column_idx[end_col] + 1]))
+            else:
+                parsed_block.append(bl_item)
+        blocks_.append(parsed_block)
+        blocks_names.append(','.join(bl))
+        explicit_blocks = explicit_blocks.union(set(parsed_block))
+
+    for singleton in [name for name in df_column_index if name not in explicit_blocks]:
+        blocks_.append([singleton])
+        blocks_names.append(singleton)
+    return blocks_, blocks_names
+
+#----------------------------------------------------------
+# FPI only works if correlated features are permuted together.
+# Otherwise, correlated features permuted independently
+# will dilute the impact of that feature since the ML model
+# will still get some information from the unpermuted feature.
+#
+# --- Conventions ---
+# Within each group of features, the feature names are separated by commas.
+# The groups of features are separated by semi-colons.
+# Colons can be used for contiguous feature grouping, but this currently
+# ignored because need to come up with a reliable way to generalize processing
+# this case since it assumes the same feature names throughout.
+#
+# Inputs: Takes a list of feature names and a correlation heatmap between features
+# (One could just pass a .csv file and compute the correlation internally, but keep
+# separate for now to enable plotting and debugging.)
+def correlated_feature_groups(
+    feature_corr,
+    corr_cutoff=0.4,
+    merge_groups=False,
+    onehot_list=[],
+    verbose=False):
+
+    # Groups of features (as lists of column indices) and the group
+    # membership of every feature, for group_correlated_features
+    # and for plotting the correlation graph.
+    #
+    # Feature pairs with |correlation| >= corr_cutoff are the edges
+    # of a graph, joined in order of decreasing correlation with a
+    # union-find over the features. With merge_groups the groups are
+    # the connected components (single linkage). Without it, an
+    # edge between two features that are both already in (different)
+    # groups is skipped, so existing groups are never merged.
+    #
+    # For one-hot features, we want to ensure all one-of-k streams
+    # are all permuted together, so all the features that match a
+    # one-hot prefix start out in one group. Later, if one (or more)
+    # of the one-hot streams correlates with another feature, those
+    # features can be joined, but all the streams from a one-hot
+    # feature will be carried as a block.
+    feature_names_str = list(feature_corr.columns)
+    n_features = len(feature_names_str)
+    parent = np.arange(n_features)
+    size = np.ones(n_features, dtype=int)
+
+    def find(ii):
+        while parent[ii] != ii:
+            parent[ii] = parent[parent[ii]]
+            ii = parent[ii]
+        return ii
+
+    def union(ii, jj):
+        ii, jj = find(ii), find(jj)
+        if ii == jj:
+            return
+        if size[ii] < size[jj]:
+            ii, jj = jj, ii
+        parent[jj] = ii
+        size[ii] += size[jj]
+
+    onehot_features = set()
+    for prefix in onehot_list:
+        prefix_match = [ii for ii, name in enumerate(feature_names_str) if prefix in name]
+        if verbose:
+            print('One-hot group for prefix '+prefix+': '+str([feature_names_str[ii] for ii in prefix_match]))
+        for ii in prefix_match:
+            union(prefix_match[0], ii)
+        onehot_features.update(prefix_match)
+
+    # Edges of the upper triangle (no self correlations, but
+    # allowing for 1.0 correlations elsewhere, e.g. duplicate
+    # features), strongest first.
+    abs_corr = np.abs(np.nan_to_num(feature_corr.values))
+    rows, cols = np.triu_indices(n_features, k=1)
+    strong = abs_corr[rows, cols] >= corr_cutoff
+    rows, cols = rows[strong], cols[strong]
+    order = np.argsort(-abs_corr[rows, cols], kind='stable')
+    if verbose:
+        print('Found '+str(len(order))+' correlations >= '+str(corr_cutoff))
+    for ii, jj in zip(rows[order], cols[order]):
+        if not merge_groups:
+            root_ii, root_jj = find(ii), find(jj)
+            if root_ii != root_jj and size[root_ii] > 1 and size[root_jj] > 1:
+                continue
+        union(ii, jj)
+
+    # Groups in the order of their first feature, features in
+    # column order. Features without a group are permuted
+    # independently and are not included (one-hot groups are kept
+    # even with a single feature).
+    roots = np.array([find(ii) for ii in range(n_features)])
+    groups = {}
+    for ii, root in enumerate(roots):
+        groups.setdefault(root, []).append(ii)
+    groups = [group for group in groups.values()
+              if len(group) > 1 or group[0] in onehot_features]
+    membership = np.unique(roots, return_inverse=True)[1]
+    return groups, membership
+
+def group_correlated_features(
+    feature_corr,
+    corr_cutoff=0.4,
+    merge_groups=False,
+    onehot_list=[],
+    verbose=False,
+    return_membership=False):
+
+    # permute_str for the groups of correlated_feature_groups;
+    # with return_membership, also the group membership of every
+    # feature (e.g. for plotting).
+    groups, membership = correlated_feature_groups(
+        feature_corr,
+        corr_cutoff=corr_cutoff,
+        merge_groups=merge_groups,
+        onehot_list=onehot_list,
+        verbose=verbose)
+
+    # Concatenate the groups to feature_groups_str.
+    feature_names_str = feature_corr.columns
+    feature_groups_str = ';'.join(','.join(feature_names_str[ii] for ii in group) for group in groups)
+
+    # Print summary
+    print('Started with '+str(len(feature_names_str))+' features.')
+    print('Finishing with '+str(sum(len(group) for group in groups))+' features in '+str(len(groups))+' groups.')
+
+    if return_membership:
+        return feature_groups_str, membership
+    return feature_groups_str
+
 
 #=======================================
 # Main execution
@@ -69,7 +662,18 @@ if __name__ == '__main__':
     #===========================================================
     # Load the SuperLearner models
     #===========================================================
-    model_dir = args.model_dir
+    # With --model_dirs (comma separated dirs and/or glob patterns)
+    # FPI runs on all the instances at once; the data and the
+    # feature groups are taken from the first one, and the
+    # results go to --output_dir (default: the parent directory of
+    # the first instance).
+    if getattr(args, 'model_dirs', None):
+        model_dirs = expand_model_dirs(args.model_dirs)
+        output_dir = getattr(args, 'output_dir', None) or os.path.dirname(os.path.normpath(model_dirs[0])) or '.'
+    else:
+        model_dirs = [args.model_dir]
+        output_dir = args.model_dir
+    model_dir = model_dirs[0]
     predict_var = args.predict_var
 
     sys.path.append(model_dir)
@@ -90,14 +694,7 @@ if __name__ == '__main__':
 
     # Use the weights to get a list of the models 
     # that have been included in the SuperLearner
-    sl_models = []
-    mm = 0
-    for model in list_models:
-        #print(model)
-        sl_weights[mm]
-        if ( sl_weights[mm] > 0.1 ):
-            sl_models.append(model)
-        mm = mm + 1
+    sl_models = weighted_models(superlearner[predict_var])
     
     # The following only works for the scipy.optimize.nnls
     # stacking regressor, not the sklearn stacking regressors.
@@ -141,361 +738,6 @@ if __name__ == '__main__':
     tmp_df = pd.read_csv(predict_output_file, dtype={'Sample_ID': str})
     Y_predict = tmp_df[predict_var]
     
-    #==========================================================
-    # FPI functions
-    #==========================================================
-
-    #----------------------------------------------------------
-    def permute_importance(permutation_feature_blocks_str, model, X, y, scoring_func, n_repeats=20, ratio_score=True, verbose=False):
-
-        base_preds = model.predict(X.values)
-        base_score = scoring_func(y, base_preds)
-
-        blocks, block_names = parse_permutation_feature_blocks(
-            permutation_feature_blocks_str, X.columns)
-        block_scores = list()
-        for block, block_name in zip(blocks, block_names):
-            block_df = X.copy()
-            repeat_scores = list()
-            for i_repeat in range(n_repeats):
-                if verbose:
-                    print('For block '+block[0]+' iteration '+str(i_repeat))
-                block_df[block] = shuffle(block_df[block]).values
-                repeat_preds = model.predict(block_df.values)
-                repeat_scores.append(scoring_func(y, repeat_preds))
-
-            # Get block score
-            importance_score_mean = np.mean(repeat_scores) / base_score if ratio_score else np.mean(repeat_scores) - base_score
-            importance_score_std = np.std(repeat_scores) / base_score if ratio_score else np.std(repeat_scores) - base_score
-            block_scores.append((block_name, importance_score_mean, importance_score_std))
-
-        # Return output sorted by the mean ratio of change (second column)
-        # For coalescing FPI output from many runs, we don't want this
-        # sorting - just return the scores unsorted and we'll take the mean
-        # over many models and then sort later.
-        #return sorted(block_scores, key=lambda r: r[1], reverse=True)
-        return block_scores
-    
-    #----------------------------------------------------------
-    def parse_permutation_feature_blocks(
-        permutation_feature_blocks_str, df_column_index):
-        
-        blocks = [
-            [bl_item.strip() for bl_item in bl.strip().split(',')]
-            for bl in permutation_feature_blocks_str.strip().split(';')
-        ]  if permutation_feature_blocks_str else list()
-
-        column_idx = {v: k for k, v in enumerate(df_column_index)}
-        blocks_ = list()
-        blocks_names = list()
-        explicit_blocks = set()
-        for bl in blocks:
-            parsed_block = list()
-            for bl_item in bl:
-                if ':' in bl_item:
-                    start_col, end_col = bl_item.split(':')
-                    parsed_block.extend(
-                        list(df_column_index[column_idx[start_col]:column_idx[end_col] + 1]))
-                else:
-                    parsed_block.append(bl_item)
-            blocks_.append(parsed_block)
-            blocks_names.append(','.join(bl))
-            explicit_blocks = explicit_blocks.union(set(parsed_block))
-
-        for singleton in set(df_column_index) - explicit_blocks:
-            blocks_.append([singleton])
-            blocks_names.append(singleton)
-        return blocks_, blocks_names
-    
-    #----------------------------------------------------------
-    # FPI only works if correlated features are permuted together.
-    # Otherwise, correlated features permuted independently
-    # will dilute the impact of that feature since the ML model
-    # will still get some information from the unpermuted feature.
-    #
-    # --- Conventions ---
-    # Within each group of features, the feature names are separated by commas.
-    # The groups of features are separated by semi-colons.
-    # Colons can be used for contiguous feature grouping, but this currently
-    # ignored because need to come up with a reliable way to generalize processing
-    # this case since it assumes the same feature names throughout.
-    #
-    # Inputs: Takes a list of feature names and a correlation heatmap between features
-    # (One could just pass a .csv file and compute the correlation internally, but keep
-    # separate for now to enable plotting and debugging.)
-    def group_correlated_features(
-        feature_corr,
-        corr_cutoff=0.4,
-        merge_groups=False,
-        onehot_list=[],
-        verbose=False):
-
-        # Take absolute value of the correlations.
-        abs_corr = np.abs(feature_corr)
-
-        # First get rid of diagonal (but allowing for 1.0 correlations 
-        # elsewhere, e.g. duplicate features)
-        feature_names_str = feature_corr.columns
-        for name in feature_names_str:
-            abs_corr.loc[name,name] = 0
-
-        # Initialize tracker for highest correlation detected
-        current_highest_corr = 1.0
-
-        # Initialize list of groups
-        # (Simple approach, ignoring one-hot features)
-        feature_groups_list = []
-
-        # For one-hot features, we want to ensure all one-of-k streams
-        # are all permuted together.  This means that we pre-populate
-        # the feature_groups_list with the user specified one-hot 
-        # features.  These features are identified by their prefix.
-        # If a prefix is in the list, a new group is created and
-        # all features in the list that match the prefix
-        # are automatically included in the group.  Later, if one
-        # (or more) of the one-hot streams in each one-hot feature
-        # correlates with another feature, those features can be
-        # merged, but all the streams from a one-hot feature will
-        # be carried as a block.
-        for prefix in onehot_list:
-
-            if verbose:
-                print('Finding one-hot features based on given prefix: '+prefix)
-            # Create a new group for elements found with this prefix.
-            prefix_match = [s for s in feature_names_str if prefix in s]
-
-            jj = 0
-            for feature in prefix_match:
-                if jj == 0:
-                    if verbose:
-                        print('Creating one-hot group for feature: '+feature)
-                    # Create the group with first feature
-                    feature_groups_list.append(feature)
-                    jj = 1
-                else:
-                    if verbose:
-                        print('Appending to one-hot group: '+feature)
-                    feature_groups_list[-1] = feature_groups_list[-1]+','+feature
-
-        # Initialize a counter to track number of times doing this
-        ii = 1
-
-        while current_highest_corr >= corr_cutoff :
-
-            # Scalar highest correlation in DF, could be duplicated
-            current_highest_corr = abs_corr.max().max()
-
-            # Get locations of current_highest_corr, DF True at current_highest_corr
-            bool_current_highest_corr = abs_corr==current_highest_corr
-
-            # Get DF of NaN except 1's at locations of current_highest_corr
-            loc_current_highest_corr = abs_corr[bool_current_highest_corr]/current_highest_corr
-
-            # Count number of highest correlations in DF.  Divide by
-            # two because the corr DF is symmetric.
-            num_highest_corr = np.nansum(loc_current_highest_corr)/2
-
-            if verbose:
-                print('Found highest correlation: '+str(current_highest_corr)+' with '+str(num_highest_corr)+' instances, iteration '+str(ii))
-
-            # Find the features involved in this correlation
-            features_in_corr = []
-            index_current_highest_corr = np.where(bool_current_highest_corr)
-            for jj in index_current_highest_corr :
-                for kk in jj :
-                    features_in_corr.append(abs_corr.index[kk])
-
-            # Get a unique list of features in correlation
-            features_in_corr = list(set(features_in_corr))
-            features_in_corr_group_id = np.full(np.shape(features_in_corr),np.nan)
-
-            # Check if any features_in_corr are already assigned in a group
-            for fid,feature in enumerate(features_in_corr) :
-                # Search for this feature in feature_groups_list
-                for gid,group in enumerate(feature_groups_list):
-                    for feature_in_group in group.split(','):
-                        if (feature == feature_in_group):
-                            features_in_corr_group_id[fid] = gid
-
-            if verbose:
-                print('Found correlation:-----------------------------------------------')
-                print(features_in_corr)
-                print('Starting gids:---------------------------------------------------')
-                print(features_in_corr_group_id)
-                print('Starting feature list:-------------------------------------------')
-                print(feature_groups_list)
-
-            if np.nansum(np.isfinite(features_in_corr_group_id)) == 0:
-                if verbose:
-                    print('No features already in group.')
-                # None of the features in this corr are in a grouping so
-                # make a new group with all features.
-                for fid,feature in enumerate(features_in_corr):
-                    if fid == 0:
-                        # Create group for first feature
-                        if verbose:
-                            print('Creating new group----------------------------<===')
-                        feature_groups_list.append(feature)
-                    else:
-                        # Add features to the group
-                        feature_groups_list[-1] = feature_groups_list[-1]+','+feature
-
-            elif np.nansum(np.isfinite(features_in_corr_group_id)) == 1:
-                if verbose:
-                    print('Exactly one feature already in group.')
-                # Exactly one of the features is already in a group so
-                # Add the other features (with group id == NaN) to that group.
-                # Find the group id of the ONE feature already in a group:
-                gid = int(np.nansum(features_in_corr_group_id))
-                for fid,feature in enumerate(features_in_corr):
-                    if np.isnan(features_in_corr_group_id[fid]):
-                        feature_groups_list[gid] = feature_groups_list[gid]+','+feature
-            else:
-                # There is some combination of at least two 
-                # features in existing groups and some other
-                # feaures may or may not be in groups.  Some
-                # of the features could already be in the same
-                # group.  For cases when there there always exactly
-                # one correlation pair detected, then no new groups
-                # are created with merge_groups=False because the
-                # two correlated features already belong to different
-                # groups.
-                if np.all(features_in_corr_group_id == features_in_corr_group_id[0]):
-                    # Special case when all features detected are 
-                    # already assigned to the same group.
-                    if verbose:
-                        print('All features already in same group. Do nothing.')
-                elif merge_groups:
-                    if verbose:
-                        print('Merge all groups/new features for this correlation.')
-                    # Merge any groups associated with any feature detected here.
-                    jj = 0
-                    gid_merged = []
-                    for fid,feature in enumerate(features_in_corr):
-                        gid = features_in_corr_group_id[fid]
-                        if verbose:
-                            print('For feature: '+feature+' with gid: '+str(gid))
-                        if (jj == 0):
-                            # Always create a new group for the supergroup we're
-                            # about to build.
-                            if verbose:
-                                print('Creating new group----------------------------<===')
-                            if np.isnan(gid):
-                                # The first feature does not have a group, so create
-                                # the new supergroup with just it.
-                                if verbose:
-                                    print('New group is feature: '+feature)
-                                feature_groups_list.append(feature)
-                            else:
-                                # Convert gid to int now that we know that gid is not NaN
-                                gid = int(gid)
-
-                                # The first feature has a group, so create the new supergroup
-                                # as a duplicate of the first feature's group.
-                                if verbose:
-                                    print('New group is duplicate group: '+feature_groups_list[gid])
-                                feature_groups_list.append(feature_groups_list[gid])
-
-                                # Keep track of which groups have already been merged.
-                                gid_merged.append(gid)
-                            jj = 1
-                        else:
-                            # The new supergroup exists, so append group/feature names
-                            # if it hasn't been appended before.
-                            if np.isnan(gid):
-                                # Feature with no group, append to supergroup
-                                if verbose:
-                                    print('Feature with no group -> simple append')
-                                    print('Appending feature: '+feature+' to group: '+feature_groups_list[-1])
-                                feature_groups_list[-1] = feature_groups_list[-1]+','+feature
-                            else:
-                                # Convert gid to int now that we know that gid is not NaN
-                                gid = int(gid)
-
-                                if gid in gid_merged:
-                                    # Feature with a group but group has already been merged.
-                                    if verbose:
-                                        print('Group already appended, skip this feature.')
-                                else:
-                                    # Feature with a group, group has not already 
-                                    # been appended.  Append now.
-                                    if verbose:
-                                        print('Group not already appended.')
-                                        print('Appending group: '+feature_groups_list[gid]+' to group: '+feature_groups_list[-1])
-                                    feature_groups_list[-1] = feature_groups_list[-1]+','+feature_groups_list[gid]
-                                    gid_merged.append(gid)
-                    # Now that we are done creating the new supergroup, clean up
-                    # by deleting the existing groups that have been merged into
-                    # the supergroup.  Note that removal of merged groups MUST
-                    # proceed in sorted, high GID to low GID because the length
-                    # of the list is changed with pop operations, so the GIDs are
-                    # reset.  Also add list(set()) inside to ensure that if there
-                    # are duplicate groups being merged, there is only one group
-                    # delete operation.
-                    if verbose:
-                        print('Delete merged groups.')
-                        print(gid_merged)
-                        print(list(set(gid_merged)))
-                    for gid in sorted(list(set(gid_merged)), reverse=True):
-                        if verbose:
-                            print('Deleting merged group '+feature_groups_list[gid]+'----------------------<===')
-                        feature_groups_list.pop(gid)
-
-                else:
-                    if verbose:
-                        print('Leave existing groups, create new group for extra features.')
-                    # Leave any existing groups separate. Any features not 
-                    # associated with a group initiate their own group
-                    jj = 0
-                    for fid,feature in enumerate(features_in_corr):
-                        if np.isnan(features_in_corr_group_id[fid]):
-                            # Add this feature to new group
-                            if jj == 0:
-                                # First need to create the new group
-                                if verbose:
-                                    print('Creating new group '+feature+'----------------------------<===')
-                                feature_groups_list.append(feature)
-                                jj = 1
-                            else:
-                                # Add features to the new group
-                                feature_groups_list[-1] = feature_groups_list[-1]+','+feature
-
-            # Move to the next highest correlation
-            abs_corr[abs_corr==current_highest_corr] = 0
-            ii = ii + 1
-            # Scalar highest correlation in DF, duplicated to prevent
-            # last correlation which may be less than cutoff from
-            # getting merged with a group.
-            current_highest_corr = abs_corr.max().max()
-            
-        # Any remaining features are permuted independently and so
-        # by default do not need to be included in the group lists.
-
-        # Concatenate feature_groups_list to feature_groups_str.
-        jj = 0
-        ff = 0
-        ff_list = []
-        for group in feature_groups_list:
-            if jj == 0:
-                feature_groups_str = group
-                jj = 1
-            else:
-                feature_groups_str = feature_groups_str+";"+group
-
-            # Count features and check for duplicates
-            for feature in group.split(','):
-                ff = ff + 1
-                for feature_already_seen in ff_list:
-                    if feature == feature_already_seen:
-                        print('WARNING: Duplicate feature detected: '+str(feature)+' '+str(ff))
-                ff_list.append(feature)
-
-        # Print summary
-        print('Started with '+str(len(feature_names_str))+' features.')
-        print('Finishing with '+str(ff)+' features in '+str(len(feature_groups_list))+' groups.')
-
-        return feature_groups_str
-    
     #===========================================================
     # Step 1: Compute correlations between all inputs and plot. 
     #===========================================================
@@ -514,7 +756,7 @@ if __name__ == '__main__':
     # the absolute value since we treat negative and positive correlations as the same.
     fig, ax = plt.subplots(figsize=(15,6))
     n, bins, patches = ax.hist(np.reshape(np.tril(np.abs(corr)),-1), 20, density=False, facecolor='g', alpha=0.75, align='mid', histtype='stepfilled')
-    plt.savefig(model_dir+'/sl_fpi_correlation_hist.png')
+    plt.savefig(output_dir+'/sl_fpi_correlation_hist.png')
 
     # Step 3: Which features should be grouped together?
     # Data that are inherently linked (i.e. one-hot and categorical features)?
@@ -524,8 +766,40 @@ if __name__ == '__main__':
     hot_spots = corr[np.abs(corr) >= corr_cutoff]
     fig, ax = plt.subplots(figsize=(15,15))
     sns.heatmap(ax=ax, data=np.abs(hot_spots), xticklabels=short_names, yticklabels=short_names, cmap=sns.diverging_palette(220, 10, as_cmap=True,n=3))
-    plt.savefig(model_dir+'/sl_fpi_correlation_heatmap.png')    
+    plt.savefig(output_dir+'/sl_fpi_correlation_heatmap.png')    
+    
+    #---Automatically detect any one-hot features---
+    # 1) Get names of one-hot features
+    one_hot_all_list = list(all_df.filter(like='_-1hot-_').columns)
+    
+    # 2) Loop over all elements in list, and split based on
+    # _-1hot-_
+    tmp_list = []
+    for feature in one_hot_all_list:
+        tmp_list.append(feature.split('_-1hot-_')[0])
     
+    # 3) Keep unique values in a fixed order.
+    # List will be empty if there are no _-1hot-_ flagged values.
+    one_hot_feature_list = sorted(set(tmp_list))
+    if len(one_hot_feature_list) == 0:
+        print('Did not detect any one-hot features.')
+    else:
+        print('Dectected one-hot features:')
+        print(one_hot_feature_list)
+
+    #---Automatically find correlated features---
+    # The groups and the components plotted below come from the
+    # same union-find pass over the thresholded correlations.
+    permute_str, membership = group_correlated_features(
+        corr,
+        corr_cutoff=corr_cutoff,
+        merge_groups=True,
+        onehot_list=one_hot_feature_list,
+        verbose=False,
+        return_membership=True)
+    # Verify that permute_str is always the same
+    print(permute_str)
+
     # Step 4: Visualize the correlations as a graph
     # Based on examples at:
     # https://python.igraph.org/en/stable/tutorials/online_user_actions.html#sphx-glr-tutorials-online-user-actions-py
@@ -542,10 +816,10 @@ if __name__ == '__main__':
         abs_corr.loc[name,name] = 0.0
 
     # Get rid of correlations below the cutoff
-    abs_corr[abs_corr <= corr_cutoff] = 0.0
+    abs_corr[abs_corr < corr_cutoff] = 0.0
 
     g = ig.Graph.Weighted_Adjacency(abs_corr, mode='plus')
-    components = g.connected_components(mode='weak')
+    components = ig.VertexClustering(g, membership=list(membership))
     #layout = g.layout('circle')
     #vertex_size = g.closeness()
     #vertex_size = [0.5 * v**2 if not np.isnan(v) else 0.05 for v in vertex_size]
@@ -564,104 +838,143 @@ if __name__ == '__main__':
         #vertex_size=vertex_size,
         #edge_width=g.es["weight"],
     )
-    plt.savefig(model_dir+'/sl_fpi_correlation_graph.png')
+    plt.savefig(output_dir+'/sl_fpi_correlation_graph.png')
 
     #===========================================================
     # Run FPI
     #===========================================================
 
     # General settings
-    job_list = [jobid]
-    
-    #---Automatically detect any one-hot features---
-    # 1) Get names of one-hot features
-    one_hot_all_list = list(all_df.filter(like='_-1hot-_').columns)
-    
-    # 2) Loop over all elements in list, and split based on
-    # _-1hot-_
-    tmp_list = []
-    for feature in one_hot_all_list:
-        tmp_list.append(feature.split('_-1hot-_')[0])
-    
-    # 3) Convert to a set to retain unique values, then to list for ease of use
-    # List will be empty if there are no _-1hot-_ flagged values.
-    one_hot_feature_list = list(set(tmp_list))
-    if len(one_hot_feature_list) == 0:
-        print('Did not detect any one-hot features.')
-    else:
-        print('Dectected one-hot features:')
-        print(one_hot_feature_list)
-
-    #---Automatically find correlated features---
-    # While the graph visualizer (above) is really nice, it may not work in
-    # all cases 
-    permute_str = group_correlated_features(
-        corr,
-        corr_cutoff=0.5,
-        merge_groups=True,
-        onehot_list=one_hot_feature_list,
-        verbose=False)
-    # Verify that permute_str is always the same
-    print(permute_str)
+    # Each SuperLearner instance is a job; the grouping and the
+    # data above are shared by all of them.
+    job_list = list(range(len(model_dirs)))
 
     #==========================================================
     # Run FPI for stacked model and each individual submodel
     #==========================================================
-    model_fpi_results = list()
-    sl_fpi_results = list()
+    # One list of result frames per scoring function; all are
+    # computed from the same permuted predictions.
+    model_fpi_results = {scorer: list() for scorer in SCORERS}
+    sl_fpi_results = {scorer: list() for scorer in SCORERS}
+
+    # The (model, block, repeat) tasks of the stacked model and all
+    # submodels of all instances run on --n_jobs workers
+    # (processes by default, or --prefer threads). Permutations are
+    # seeded with --seed, so results are the same for any --n_jobs.
+    # Up to --batch_rows permuted rows are predicted together.
+    n_jobs = int(getattr(args, 'n_jobs', None) or 1)
+    prefer = getattr(args, 'prefer', None) or 'processes'
+    seed = int(getattr(args, 'seed', None) or 0)
+    batch_rows = int(getattr(args, 'batch_rows', None) or 100000)
+
+    # Adaptive repeats: with --tolerance, blocks get rounds of
+    # --n_repeats permutations until the standard error of their
+    # MSE ratio is below the tolerance for all models (or they
+    # reach --max_repeats).
+    tolerance = getattr(args, 'tolerance', None)
+    tolerance = float(tolerance) if tolerance else None
+    n_repeats = int(getattr(args, 'n_repeats', None) or (5 if tolerance else 20))
+    max_repeats = int(getattr(args, 'max_repeats', None) or 100)
 
-    i = 0
+    # Models of all jobs, named <job_id>/<model name>.
+    fpi_models = {}
+    job_models = {}
     for job_id in job_list:
         
-        print('Loading model for job: '+str(job_id))
-        sl = pickle.load(open(model_dir+"/"+"SuperLearners.pkl", "rb"))
+        print('Loading model for job: '+str(job_id)+' ('+model_dirs[job_id]+')')
+        if model_dirs[job_id] not in sys.path:
+            sys.path.append(model_dirs[job_id])
+        with open(model_dirs[job_id]+"/"+"SuperLearners.pkl", "rb") as file_object:
+            sl = pickle.load(file_object)
+        job_models[job_id] = weighted_models(sl[predict_var])
 
-        #----------------------------------------------------
-        # FPI for stacked model
-        #----------------------------------------------------
-        model_object = sl[predict_var]
-        
-        print('FPI on stacked ensemble...')
-        result = permute_importance(permute_str, 
-                model_object,
-                all_df, 
-                target_all_df,
-                mean_squared_error)
-        # Convert back to dataframe, consider using MultiIndex
-        # functionality instead of the clunky filter below.
-        result_df = pd.DataFrame(result,
-                                columns=['Feature',
-                                        'Avg_Ratio'+'stack'+str(job_id), 
-                                        'Std_Ratio'+'stack'+str(job_id)]).set_index('Feature')
-        
-        sl_fpi_results.append(result_df)
-        
-        #----------------------------------------------------
-        # FPI for each submodel individually
-        #----------------------------------------------------
-        for model_name in sl_models:
-            model_object = sl[predict_var].named_estimators_[model_name]
+        # Stacked predict engine: skips submodels with zero weight.
+        fpi_models[str(job_id)+'/stack'] = StackedPredictor(sl[predict_var])
+        for model_name in job_models[job_id]:
+            fpi_models[str(job_id)+'/'+model_name] = sl[predict_var].named_estimators_[model_name]
+        print('FPI on stacked ensemble and ML models: '+', '.join(job_models[job_id])+'...')
+
+    # Subsampled FPI: with --subsample_ci <half width>, FPI runs
+    # on a target-stratified subset of the rows that is sized from
+    # a pilot run on --pilot_rows rows (default 1000) so that the
+    # --confidence (default 0.95) interval of each block's MSE
+    # ratio of the stacked model(s) is within +/- the half width
+    # (at most --max_rows rows). The rows are split into --n_folds
+    # (default 5) stratified folds over --n_strata (default 10)
+    # target quantile bins and the intervals are saved to
+    # sl_fpi_ci_df and model_fpi_ci_df.
+    subsample_ci = getattr(args, 'subsample_ci', None)
+    subsample_ci = float(subsample_ci) if subsample_ci else None
+    fpi_kwargs = dict(n_repeats=n_repeats,
+            n_jobs=n_jobs,
+            prefer=prefer,
+            batch_rows=batch_rows,
+            tolerance=tolerance,
+            max_repeats=max_repeats,
+            model_dir=model_dir)
+    intervals = None
+    if subsample_ci is None:
+        results, repeats_used = run_fpi(permute_str,
+            fpi_models,
+            all_df,
+            target_all_df,
+            seed=seed,
+            return_repeats=True,
+            **fpi_kwargs)
+    else:
+        max_rows = getattr(args, 'max_rows', None)
+        results, intervals, repeats_used, n_rows = subsample_fpi(permute_str,
+            fpi_models,
+            all_df,
+            target_all_df,
+            subsample_ci,
+            pilot_rows=int(getattr(args, 'pilot_rows', None) or 1000),
+            n_folds=int(getattr(args, 'n_folds', None) or 5),
+            n_strata=int(getattr(args, 'n_strata', None) or 10),
+            confidence=float(getattr(args, 'confidence', None) or 0.95),
+            max_rows=int(max_rows) if max_rows else None,
+            precision_models=[str(job_id)+'/stack' for job_id in job_list],
+            seed=seed,
+            verbose=True,
+            **fpi_kwargs)
+        print('FPI on a stratified subset of '+str(n_rows)+' of '+str(len(all_df))+' rows')
+    repeats_df = pd.DataFrame(repeats_used,
+                              columns=['Feature', 'Repeats']).set_index('Feature')
+
+    for job_id in job_list:
+        for scorer in SCORERS:
+            #----------------------------------------------------
+            # FPI for stacked model
+            #----------------------------------------------------
+            # Convert back to dataframe, consider using MultiIndex
+            # functionality instead of the clunky filter below.
+            result_df = pd.DataFrame(results[scorer][str(job_id)+'/stack'],
+                                    columns=['Feature',
+                                            'Avg_Ratio'+'stack'+str(job_id), 
+                                            'Std_Ratio'+'stack'+str(job_id)]).set_index('Feature')
             
-            print('FPI on ML model: '+model_name+'...')
-            result = permute_importance(permute_str, 
-                model_object,
-                all_df, 
-                target_all_df,
-                mean_squared_error)
-            result_df = pd.DataFrame(result,
-                columns=['Feature',
-                'Avg_Ratio'+model_name+str(job_id), 
-                'Std_Ratio'+model_name+str(job_id)]).set_index('Feature')
+            sl_fpi_results[scorer].append(result_df)
             
-            model_fpi_results.append(result_df)
+            #----------------------------------------------------
+            # FPI for each submodel individually
+            #----------------------------------------------------
+            for model_name in job_models[job_id]:
+                result_df = pd.DataFrame(results[scorer][str(job_id)+'/'+model_name],
+                    columns=['Feature',
+                    'Avg_Ratio'+model_name+str(job_id), 
+                    'Std_Ratio'+model_name+str(job_id)]).set_index('Feature')
+                
+                model_fpi_results[scorer].append(result_df)
 
     # Merge all dataframes into a single frame with
     # features as the index.
-    sl_fpi_results_df = pd.concat(sl_fpi_results,axis=1)
-    model_fpi_results_df = pd.concat(model_fpi_results,axis=1)
+    sl_fpi_results_df = pd.concat(sl_fpi_results['mse'],axis=1)
+    model_fpi_results_df = pd.concat(model_fpi_results['mse'],axis=1)
 
     # Stacked model results
     print(sl_fpi_results_df)
+    print('Repeats used per block:')
+    print(repeats_df)
 
     # All other model results
     for model in sl_models:
@@ -671,9 +984,46 @@ if __name__ == '__main__':
     #===========================================================
     # Save outfile file
     #===========================================================
-    
-    sl_fpi_results_df.to_csv(f"{model_dir}/sl_fpi_results_df")
-    model_fpi_results_df.to_csv(f"{model_dir}/model_fpi_results_df")
+    # MSE ratios keep the original file names; the other scores
+    # are saved with their name as a suffix. For R2 the ratio is
+    # below 1 for important features.
+    sl_fpi_results_df.to_csv(f"{output_dir}/sl_fpi_results_df")
+    model_fpi_results_df.to_csv(f"{output_dir}/model_fpi_results_df")
+    repeats_df.to_csv(f"{output_dir}/fpi_repeats_df")
+    if intervals is not None:
+        # MSE ratio confidence intervals, in the same layout as
+        # the results.
+        for prefix, names in (('sl', [['stack']]*len(job_list)), ('model', [job_models[job_id] for job_id in job_list])):
+            ci_df = pd.concat([pd.DataFrame(intervals['mse'][str(job_id)+'/'+model_name],
+                                            columns=['Feature',
+                                                     'CI_Low'+model_name+str(job_id),
+                                                     'CI_High'+model_name+str(job_id)]).set_index('Feature')
+                               for job_id in job_list for model_name in names[job_id]], axis=1)
+            ci_df.to_csv(f"{output_dir}/{prefix}_fpi_ci_df")
+            if prefix == 'sl':
+                print('Confidence intervals of the MSE ratios:')
+                print(ci_df)
+    for scorer in SCORERS:
+        if scorer != 'mse':
+            pd.concat(sl_fpi_results[scorer],axis=1).to_csv(f"{output_dir}/sl_fpi_results_{scorer}_df")
+            pd.concat(model_fpi_results[scorer],axis=1).to_csv(f"{output_dir}/model_fpi_results_{scorer}_df")
+
+    # With several instances, also the mean and standard deviation
+    # over the instances of each model's Avg_Ratio.
+    if len(job_list) > 1:
+        with open(f"{output_dir}/fpi_instances", 'w') as file_object:
+            for job_id in job_list:
+                file_object.write(str(job_id)+','+model_dirs[job_id]+'\n')
+        all_models = sorted(set(model_name for job_id in job_list for model_name in job_models[job_id]))
+        for scorer in SCORERS:
+            suffix = '' if scorer == 'mse' else '_'+scorer
+            sl_ensemble_df = ensemble_fpi(pd.concat(sl_fpi_results[scorer],axis=1), ['stack'], job_list)
+            sl_ensemble_df.to_csv(f"{output_dir}/sl_fpi_ensemble{suffix}_df")
+            ensemble_fpi(pd.concat(model_fpi_results[scorer],axis=1), all_models, job_list).to_csv(
+                f"{output_dir}/model_fpi_ensemble{suffix}_df")
+            if scorer == 'mse':
+                print('Ensemble FPI over '+str(len(job_list))+' instances:')
+                print(sl_ensemble_df)
     
     #===========================================================
     # Done!
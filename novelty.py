@@ -0,0 +1,133 @@
+#================================
+# SuperLearner novelty scoring
+#================================
+# Fit, save and apply the input
+# scaler and PCA behind the
+# pca.dist metric of pca.py, so
+# that predict.py can score each
+# prediction site as it goes
+# instead of refitting the PCA
+# over the whole data set.
+#
+# train.py fits the StandardScaler
+# and the first two principal
+# components on the training
+# inputs (the same columns as
+# pca.py, i.e. without Mean_DO)
+# and saves them with the training
+# centroid to <model_dir>/novelty.pkl.
+# pca.dist is the distance of a
+# site from that centroid in the
+# plane of the two components.
+#
+# Unlike pca.py, the PCA is fit on
+# the training data only, so the
+# distances differ slightly from
+# the ones in sl_pca.csv, and the
+# scaled columns are relative to
+# the training data (maximum
+# training pca.dist) rather than
+# to the maximum over the
+# prediction sites; values above 1
+# are sites further out than any
+# training site.
+#
+# A site near the centroid can
+# still be far from every actual
+# training site, so knn.dist adds
+# the mean distance to the nearest
+# KNN_NEIGHBORS training sites in
+# the scaled input space, from a
+# KD-tree over the training sites
+# saved with the PCA.
+#================================
+
+# Dependencies
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.neighbors import KDTree
+from sklearn.preprocessing import StandardScaler
+
+NOVELTY_FILE = 'novelty.pkl'
+
+# Number of principal components used for pca.dist, as in pca.py.
+N_COMPONENTS = 2
+
+# Number of nearest training sites averaged for knn.dist.
+KNN_NEIGHBORS = 5
+
+# Rows per KD-tree query.
+KNN_CHUNK_ROWS = 10000
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def novelty_columns(feature_names):
+    # Indices of the inputs used for the PCA. pca.py drops the
+    # dissolved oxygen inputs, which are mostly missing.
+    return [ii for ii, name in enumerate(feature_names) if 'Mean_DO' not in name]
+
+def build_knn_index(Z_train):
+    return KDTree(np.asarray(Z_train, dtype=np.float64))
+
+def knn_distance(tree, Z, k=KNN_NEIGHBORS, n_jobs=1):
+    # Mean distance of each row of Z to its k nearest indexed
+    # sites. Chunks are queried on n_jobs threads (the tree
+    # query releases the GIL).
+    Z = np.asarray(Z, dtype=np.float64)
+    k = min(k, tree.data.shape[0])
+
+    def query(start):
+        return tree.query(Z[start:start+KNN_CHUNK_ROWS], k=k)[0].mean(axis=1)
+
+    starts = range(0, Z.shape[0], KNN_CHUNK_ROWS)
+    if n_jobs > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            parts = list(pool.map(query, starts))
+    else:
+        parts = [query(start) for start in starts]
+    if len(parts) == 0:
+        return np.zeros(0)
+    return np.concatenate(parts)
+
+def fit_novelty(X, feature_names):
+    index = novelty_columns(feature_names)
+    X = np.asarray(X, dtype=np.float64)[:, index]
+    scaler = StandardScaler().fit(X)
+    pca = PCA(n_components=N_COMPONENTS, svd_solver='full').fit(scaler.transform(X))
+    Z = pca.transform(scaler.transform(X))
+    centroid = Z.mean(0)
+    return {
+        'feature_names': [feature_names[ii] for ii in index],
+        'index': index,
+        'scaler': scaler,
+        'pca': pca,
+        'centroid': centroid,
+        'dist_scale': float(np.max(np.linalg.norm(Z - centroid, axis=1))),
+        'knn_tree': build_knn_index(scaler.transform(X))}
+
+def novelty_scores(novelty, X, n_jobs=1):
+    # {'pca.dist': ..., 'knn.dist': ...} for each row of X (all
+    # num_inputs columns); knn.dist only if the model has a tree.
+    X = np.asarray(X, dtype=np.float64)[:, novelty['index']]
+    X_scaled = novelty['scaler'].transform(X)
+    Z = novelty['pca'].transform(X_scaled)
+    scores = {'pca.dist': np.linalg.norm(Z - novelty['centroid'], axis=1)}
+    if 'knn_tree' in novelty:
+        scores['knn.dist'] = knn_distance(novelty['knn_tree'], X_scaled, n_jobs=n_jobs)
+    return scores
+
+def save_novelty(novelty, model_dir):
+    with open(model_dir+'/'+NOVELTY_FILE, 'wb') as output:
+        pickle.dump(novelty, output, pickle.HIGHEST_PROTOCOL)
+
+def load_novelty(model_dir):
+    path = model_dir+'/'+NOVELTY_FILE
+    if not os.path.isfile(path):
+        raise ValueError(path+' not found, retrain the model to score novelty')
+    with open(path, 'rb') as file_object:
+        return pickle.load(file_object)
@@ -8,22 +8,405 @@
 # error estimate, to rank which
 # data points are the most
 # "important" for training.
+#
+# With --chunk_size <rows>, the
+# prediction sites are streamed
+# instead of loaded at once: the
+# scaler and an IncrementalPCA are
+# fit chunk by chunk and further
+# passes write sl_pca.csv, so memory
+# does not grow with the number of
+# prediction sites. Keeping all
+# components (the default) gives
+# the same distances as the full
+# PCA; --n_components <n> keeps
+# fewer at some loss of accuracy.
+# The diagnostic scatter plots are
+# skipped.
+#
+# The PCA depends only on the
+# training data and the prediction
+# inputs, not on the trained model.
+# With --pca_cache_dir <dir> (shared
+# by the ensemble instances), the
+# distances are cached under a hash
+# of those inputs and of the PCA
+# options (including --chunk_size,
+# the streaming mode): the first
+# instance computes them and the
+# others only merge in their own
+# mean.error for combined.metric.
+# The lock of the computing instance
+# holds its host and PID; a lock
+# whose owner is gone (same host) or
+# older than --pca_cache_timeout
+# seconds (default 21600) is taken
+# over, and waiting longer than
+# --pca_cache_max_wait seconds
+# (default 43200) is an error.
+#
+# With --knn <k>, knn.dist is the
+# mean distance of each site to its
+# k nearest training sites in the
+# scaled input space, a novelty
+# measure that also flags sites
+# near the centroid but far from
+# any actual training site. The
+# KD-tree is saved to sl_pca_knn.pkl
+# and queried in chunks on --n_jobs
+# threads.
 #================================
 
 # Dependencies
 import argparse
+import atexit
+import hashlib
+import os
 import pickle
+import shutil
+import socket
+import time
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.metrics import mean_squared_error
 from sklearn.utils import shuffle
 from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
 from sklearn.preprocessing import StandardScaler
 from sklearn.preprocessing import MaxAbsScaler
 from numpy.testing import assert_array_almost_equal
 import sys
 from pprint import pprint
+from novelty import build_knn_index
+from novelty import knn_distance
+
+# Files kept in the PCA cache besides the distances.
+PCA_CACHE_FILES = ['sl_pca_variance.png', 'sl_pca_scatter.png', 'sl_pca_knn.pkl']
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def prediction_columns(predict_output, predict_var):
+    # {column in sl_predictions.csv: name used here} for the
+    # columns of predict_var. When predict.py predicts several
+    # outputs, the error columns are prefixed with the output name
+    # (<predict_var>.mean.error); the other outputs' columns are
+    # left out.
+    header = pd.read_csv(predict_output, nrows=0).columns
+    prefix = predict_var+'.' if predict_var+'.mean.error' in header else ''
+    return {
+        'Sample_ID': 'Sample_ID',
+        'Sample_Longitude': 'Sample_Longitude',
+        'Sample_Latitude': 'Sample_Latitude',
+        predict_var: predict_var,
+        prefix+'mean.error': 'mean.error',
+        prefix+'predict.error': 'predict.error'}
+
+def iter_predict_chunks(predict_data, predict_output, predict_var, chunk_size):
+    # Aligned chunks of the prediction inputs and predictions,
+    # culled as in the in-memory path: no oxygen columns and no
+    # rows with missing values.
+    columns = prediction_columns(predict_output, predict_var)
+    input_reader = pd.read_csv(predict_data+".csv", chunksize=chunk_size)
+    target_reader = pd.read_csv(predict_output, chunksize=chunk_size, usecols=list(columns))
+    # The index is the row number in the prediction files.
+    for inputs, targets in zip(input_reader, target_reader):
+        predict_all = pd.concat([inputs,targets.rename(columns=columns)],axis=1)
+        predict_all.drop(
+            columns=predict_all.columns[
+                predict_all.columns.str.contains('Mean_DO')],
+            inplace=True)
+        predict_all.dropna(axis=0,how='any',inplace=True)
+        yield predict_all
+
+def partial_fit_batches(model, batches, min_rows):
+    # Feed batches to model.partial_fit, merging any batch with
+    # fewer than min_rows (IncrementalPCA needs at least
+    # n_components rows) into the next one.
+    pending = None
+    for batch in batches:
+        pending = batch if pending is None else np.concatenate((pending, batch), axis=0)
+        if len(pending) >= min_rows:
+            model.partial_fit(pending)
+            pending = None
+    if pending is not None:
+        model.partial_fit(pending)
+    return model
+
+def save_knn_index(model_dir, features, scaler, tree):
+    # The KD-tree over the scaled training sites, with the scaler
+    # and columns needed to query it.
+    with open(model_dir+'/sl_pca_knn.pkl', 'wb') as output:
+        pickle.dump({'features': features, 'scaler': scaler, 'tree': tree}, output, pickle.HIGHEST_PROTOCOL)
+
+def incremental_pca(args, chunk_size, n_components, pca_output, tile_writer=None, dist_file=None, knn=None, n_jobs=1):
+    # Streaming version of the main execution below: the same
+    # columns, the same culling of missing values and the same
+    # distance to the WHONDRS (training) centroid, computed in
+    # passes over chunks of the prediction sites.
+    model_dir = args.model_dir
+    predict_var = args.predict_var
+    predict_output = model_dir+"/sl_predictions.csv"
+
+    # The training data is small enough to hold in memory.
+    training_all = pd.read_csv(args.data)
+    training_all.drop(
+        columns=training_all.columns[
+            np.logical_or(
+                training_all.columns.str.contains('DO'),
+                training_all.columns.str.contains(predict_var))],
+        inplace=True)
+    features = list(training_all.columns)
+    training_fit = training_all.dropna(axis=0,how='any').values
+
+    def predict_features():
+        for predict_all in iter_predict_chunks(args.predict_data, predict_output, predict_var, chunk_size):
+            yield predict_all[features].values
+
+    # Pass 1: scaler (also the largest mean.error)
+    cnsd = StandardScaler()
+    cnsd.partial_fit(training_fit)
+    max_error = -np.inf
+    n_sites = 0
+    for predict_all in iter_predict_chunks(args.predict_data, predict_output, predict_var, chunk_size):
+        cnsd.partial_fit(predict_all[features].values)
+        max_error = max(max_error, predict_all['mean.error'].max())
+        n_sites += len(predict_all)
+    print('Sites after removing NaN: '+str(n_sites))
+
+    # Pass 2: principal components
+    if n_components is None:
+        n_components = len(features)
+    pca = IncrementalPCA(n_components=n_components)
+    partial_fit_batches(pca, [cnsd.transform(training_fit)], n_components)
+    partial_fit_batches(pca, (cnsd.transform(X) for X in predict_features()), n_components)
+
+    fig, ax = plt.subplots()
+    ax.plot(100*pca.explained_variance_ratio_,'b.-')
+    ax.grid()
+    print(np.sum(pca.explained_variance_ratio_))
+    ax.set_xlabel('PCA component ID')
+    ax.set_ylabel('Percent of variance explained')
+    plt.savefig(model_dir+"/sl_pca_variance.png")
+
+    # The WHONDRS centroid, using only the first two components.
+    WHONDRS_centroid = pca.transform(cnsd.transform(training_fit)).mean(0)[0:2]
+
+    def pca_dist(X):
+        return np.linalg.norm(
+            pca.transform(cnsd.transform(X))[:,0:2].astype(float) - WHONDRS_centroid.astype(float),axis=1)
+
+    if knn is not None:
+        knn_tree = build_knn_index(cnsd.transform(training_fit))
+        save_knn_index(model_dir, features, cnsd, knn_tree)
+
+    # Pass 3: largest distance, for scaling
+    max_dist = -np.inf
+    for X in predict_features():
+        if len(X) > 0:
+            max_dist = max(max_dist, np.max(pca_dist(X)))
+
+    # Pass 4: write the output
+    first = True
+    for predict_all in iter_predict_chunks(args.predict_data, predict_output, predict_var, chunk_size):
+        output_df = predict_all[['Sample_ID','Sample_Longitude','Sample_Latitude',predict_var,'mean.error','predict.error']].copy()
+        output_df['pca.dist'] = pca_dist(predict_all[features].values)
+        output_df['mean.error.scaled'] = output_df['mean.error']/max_error
+        output_df['pca.dist.scaled'] = output_df['pca.dist']/max_dist
+        output_df['combined.metric'] = output_df['mean.error.scaled']*output_df['pca.dist.scaled']
+        if knn is not None:
+            output_df['knn.dist'] = knn_distance(knn_tree, cnsd.transform(predict_all[features].values), knn, n_jobs)
+        output_df.to_csv(pca_output,index=False,mode='w' if first else 'a',header=first)
+        if tile_writer is not None:
+            tile_writer.write(output_df)
+        if dist_file is not None:
+            dist_df = output_df[cached_columns(output_df)].copy()
+            dist_df.insert(0, 'row', output_df.index)
+            dist_df.to_csv(dist_file,index=False,mode='w' if first else 'a',header=first)
+        first = False
+
+def cached_columns(output_df):
+    return [column for column in ['Sample_ID','pca.dist','knn.dist'] if column in output_df.columns]
+
+def inputs_hash(paths, *options):
+    # Hash of the contents of the input files and the options
+    # that change the PCA.
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as file_object:
+            for block in iter(lambda: file_object.read(1 << 20), b''):
+                digest.update(block)
+    for option in options:
+        digest.update(str(option).encode())
+    return digest.hexdigest()
+
+class PCACache:
+    # <cache_dir>/<key>/ holds sl_pca_dist.csv (row in the
+    # prediction files, Sample_ID, pca.dist) and the PCA plots.
+    # One instance computes it under <key>.lock while the
+    # others wait; the result is moved into place in one rename
+    # so a partial cache is never read.
+    #
+    # The lock file holds the owner's host and PID. The instances
+    # may run on different nodes of a shared file system, where
+    # file locks are not reliable, so a lock left by a killed
+    # instance is detected instead: its owner is no longer
+    # running (same host only) or it is older than stale_after
+    # seconds. Waiting more than max_wait seconds raises a
+    # TimeoutError. Each owner computes in its own temporary dir,
+    # so an instance that was only slow (and taken over) still
+    # finishes cleanly: the first result moved into place wins.
+    def __init__(self, cache_dir, key, poll_interval=5, stale_after=6*3600, max_wait=12*3600):
+        self.path = cache_dir+'/'+key
+        self.lock_file = self.path+'.lock'
+        self.owner = socket.gethostname()+' '+str(os.getpid())+'\n'
+        self.tmp_dir = self.path+'.tmp.'+socket.gethostname()+'.'+str(os.getpid())
+        self.dist_file = self.tmp_dir+'/sl_pca_dist.csv'
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_wait = max_wait
+        self.locked = False
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def lock_owner(self):
+        # (contents, host, pid, age in seconds) of the lock file,
+        # or None if there is no lock. host and pid are None if the
+        # owner died before writing them.
+        try:
+            with open(self.lock_file) as file_object:
+                contents = file_object.read()
+            age = time.time() - os.path.getmtime(self.lock_file)
+        except FileNotFoundError:
+            return None
+        fields = contents.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            return contents, fields[0], int(fields[1]), age
+        return contents, None, None, age
+
+    def owner_gone(self, owner):
+        # True if the owner ran on this host and is not running.
+        contents, host, pid, age = owner
+        if host != socket.gethostname():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def stale(self, owner):
+        return owner[3] > self.stale_after or self.owner_gone(owner)
+
+    def break_lock(self, owner):
+        # Remove a stale lock. It is first renamed, so only one
+        # waiter removes it; if the lock was taken over in the
+        # meantime (other contents), it is put back.
+        broken = self.lock_file+'.'+socket.gethostname()+'.'+str(os.getpid())
+        try:
+            os.rename(self.lock_file, broken)
+        except FileNotFoundError:
+            return
+        with open(broken) as file_object:
+            if file_object.read() != owner[0]:
+                try:
+                    os.link(broken, self.lock_file)
+                except FileExistsError:
+                    pass
+        os.remove(broken)
+
+    def hit(self):
+        # True once the cached result exists, or False (holding
+        # the lock) if this instance has to compute it.
+        start = time.time()
+        while not os.path.isdir(self.path):
+            try:
+                lock_fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                owner = self.lock_owner()
+                if owner is not None and self.stale(owner):
+                    print('Taking over stale PCA cache lock '+self.lock_file+
+                          ' (owner '+str(owner[1])+' pid '+str(owner[2])+', '+str(int(owner[3]))+' s old)')
+                    if self.owner_gone(owner):
+                        shutil.rmtree(self.path+'.tmp.'+owner[1]+'.'+str(owner[2]), ignore_errors=True)
+                    self.break_lock(owner)
+                    continue
+                if time.time() - start > self.max_wait:
+                    raise TimeoutError('Waited more than '+str(self.max_wait)+' s for '+self.lock_file+
+                                       (' (owner '+str(owner[1])+' pid '+str(owner[2])+')' if owner else '')+
+                                       '; remove it if that instance is no longer running')
+                time.sleep(self.poll_interval)
+                continue
+            os.write(lock_fd, self.owner.encode())
+            os.close(lock_fd)
+            self.locked = True
+            # Released also if this instance fails.
+            atexit.register(self.release)
+            if os.path.isdir(self.path):
+                self.release()
+                return True
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            os.makedirs(self.tmp_dir)
+            return False
+        return True
+
+    def store(self, model_dir):
+        for file_name in PCA_CACHE_FILES:
+            if os.path.isfile(model_dir+'/'+file_name):
+                shutil.copy(model_dir+'/'+file_name, self.tmp_dir)
+        try:
+            os.rename(self.tmp_dir, self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.release()
+
+    def release(self):
+        # Remove the lock, unless it was taken over.
+        if self.locked:
+            owner = self.lock_owner()
+            if owner is not None and owner[0] == self.owner:
+                os.remove(self.lock_file)
+            self.locked = False
+
+def merge_cached_pca(cache, model_dir, predict_var, pca_output, chunk_size, tile_writer=None):
+    # sl_pca.csv from the cached distances and this instance's
+    # predictions and errors.
+    for file_name in PCA_CACHE_FILES:
+        if os.path.isfile(cache.path+'/'+file_name):
+            shutil.copy(cache.path+'/'+file_name, model_dir)
+    dist_df = pd.read_csv(cache.path+'/sl_pca_dist.csv', dtype={'Sample_ID': str})
+    rows = dist_df['row'].values
+    columns = ['Sample_ID','Sample_Longitude','Sample_Latitude',predict_var,'mean.error','predict.error']
+    file_columns = prediction_columns(model_dir+"/sl_predictions.csv", predict_var)
+
+    def cached_chunks():
+        for chunk in pd.read_csv(model_dir+"/sl_predictions.csv", chunksize=chunk_size, usecols=list(file_columns), dtype={'Sample_ID': str}):
+            chunk = chunk.rename(columns=file_columns)
+            keep = slice(np.searchsorted(rows, chunk.index[0]), np.searchsorted(rows, chunk.index[-1], side='right'))
+            output_df = chunk.loc[rows[keep], columns].reset_index(drop=True)
+            for column in cached_columns(dist_df)[1:]:
+                output_df[column] = dist_df[column].values[keep]
+            yield output_df
+
+    max_error = np.nanmax([output_df['mean.error'].max() for output_df in cached_chunks()])
+    max_dist = dist_df['pca.dist'].max()
+    first = True
+    for output_df in cached_chunks():
+        output_df['mean.error.scaled'] = output_df['mean.error']/max_error
+        output_df['pca.dist.scaled'] = output_df['pca.dist']/max_dist
+        output_df['combined.metric'] = output_df['mean.error.scaled']*output_df['pca.dist.scaled']
+        if 'knn.dist' in output_df.columns:
+            # Same column order as when computed.
+            output_df['knn.dist'] = output_df.pop('knn.dist')
+        output_df.to_csv(pca_output,index=False,mode='w' if first else 'a',header=first)
+        if tile_writer is not None:
+            tile_writer.write(output_df)
+        first = False
 
 #=======================================
 # Main execution
@@ -68,6 +451,63 @@ if __name__ == '__main__':
     # value, error metric, PCA dist, normalized
     # error, normalized PCA dist, and combined metric.
     pca_output = model_dir+"/sl_pca.csv"
+
+    # Optionally also write the output as lat/lon tiles with an
+    # index (--tile_deg <degrees>, see tiles.py).
+    tile_writer = None
+    if getattr(args, 'tile_deg', None) is not None:
+        from tiles import TileWriter
+        tile_writer = TileWriter(model_dir+'/sl_pca_tiles', float(args.tile_deg))
+
+    n_components = int(args.n_components) if getattr(args, 'n_components', None) else None
+    knn = int(args.knn) if getattr(args, 'knn', None) else None
+    n_jobs = int(getattr(args, 'n_jobs', None) or 1)
+
+    # Distances shared by the ensemble instances.
+    pca_cache = None
+    if getattr(args, 'pca_cache_dir', None) is not None:
+        # The streaming PCA (--chunk_size) is fit in batches of
+        # chunk_size rows and gives different distances than the
+        # full PCA, so the mode is part of the key.
+        if getattr(args, 'chunk_size', None) is not None:
+            pca_mode = ('incremental', int(args.chunk_size))
+        else:
+            pca_mode = ('full',)
+        key = inputs_hash([train_test_data, predict_data+".csv"], predict_var, n_components, knn, pca_mode)
+        pca_cache = PCACache(args.pca_cache_dir, key,
+                             stale_after=float(getattr(args, 'pca_cache_timeout', None) or 6*3600),
+                             max_wait=float(getattr(args, 'pca_cache_max_wait', None) or 12*3600))
+        if pca_cache.hit():
+            print("Using cached PCA distances from "+pca_cache.path)
+            merge_cached_pca(
+                pca_cache,
+                model_dir,
+                predict_var,
+                pca_output,
+                int(getattr(args, 'chunk_size', None) or 100000),
+                tile_writer)
+            if tile_writer is not None:
+                tile_writer.close()
+            print("Done!")
+            sys.exit()
+
+    # Streaming mode for very large prediction sets.
+    if getattr(args, 'chunk_size', None) is not None:
+        incremental_pca(
+            args,
+            int(args.chunk_size),
+            n_components,
+            pca_output,
+            tile_writer,
+            pca_cache.dist_file if pca_cache is not None else None,
+            knn,
+            n_jobs)
+        if tile_writer is not None:
+            tile_writer.close()
+        if pca_cache is not None:
+            pca_cache.store(model_dir)
+        print("Done!")
+        sys.exit()
     
     #======================================
     # Load files with Pandas and remove NaN
@@ -79,7 +519,8 @@ if __name__ == '__main__':
     # and predict.error for later. This information is only needed
     # for blending the error estimate with the PCA dist metric at the
     # very end.
-    predict_targets = pd.read_csv(predict_output)
+    columns = prediction_columns(predict_output, predict_var)
+    predict_targets = pd.read_csv(predict_output, usecols=list(columns)).rename(columns=columns)
     
     # Check that the same number of sites are in both files
     print('Shapes at start:')
@@ -104,6 +545,9 @@ if __name__ == '__main__':
     
     # 110 missing pH rows, drop whole rows.
     predict_all.dropna(axis=0,how='any',inplace=True)
+
+    # Rows kept, for the PCA cache.
+    predict_rows = predict_all.index.values
     
     # Drop the targets, but keep them later for plotting.
     predict_rr = pd.DataFrame(
@@ -181,6 +625,7 @@ if __name__ == '__main__':
     # We do not want the ID to be part of the PCA,
     # so pull it out now and concatenate it later as needed.
     id_df = pd.DataFrame(data_all.pop('Sample_ID'),columns=pd.Index(['Sample_ID']))
+    features = list(data_all.columns)
 
     # Finally, the training data did not have an ID but it does
     # have quite a few NaN in it.  Overwrite those NaN with mean
@@ -322,6 +767,13 @@ if __name__ == '__main__':
     predict_err['pca.dist.scaled'] = predict_err['pca.dist']/predict_err.max()['pca.dist']
     predict_err['combined.metric'] = predict_err['mean.error.scaled']*predict_err['pca.dist.scaled']
 
+    # Distance to the nearest training sites in the scaled space.
+    if knn is not None:
+        is_training = id_df['Sample_ID'].isnull().values
+        knn_tree = build_knn_index(data_all[is_training])
+        save_knn_index(model_dir, features, cnsd, knn_tree)
+        predict_err['knn.dist'] = knn_distance(knn_tree, data_all[np.logical_not(is_training)], knn, n_jobs)
+
     # Ensure all dataframe indeces are restarted
     id_predict_df.reset_index(drop=True,inplace=True)
     predict_err.reset_index(drop=True,inplace=True)
@@ -337,5 +789,14 @@ if __name__ == '__main__':
 
     # Write to output files
     output_df.to_csv(pca_output,index=False)
+
+    if tile_writer is not None:
+        tile_writer.write(output_df)
+        tile_writer.close()
+    if pca_cache is not None:
+        dist_df = output_df[cached_columns(output_df)].copy()
+        dist_df.insert(0, 'row', predict_rows)
+        dist_df.to_csv(pca_cache.dist_file,index=False)
+        pca_cache.store(model_dir)
     #training_all.to_csv(pca_output.split(".")[0]+"_training.csv",index=False)
 print("Done!")
@@ -19,6 +19,8 @@ from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from sklearn.preprocessing import MaxAbsScaler
 import sys
+from stacking import StackedPredictor
+from stacking import predict_many
 
 
 #=======================================
@@ -57,15 +59,39 @@ if __name__ == '__main__':
     with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
         superlearner = pickle.load(file_object)
 
-    # For a given output variable, list the models:
-    predict_var = args.predict_var
-    print("Submodels within SuperLearner and their weights:")
-    list_models = list(superlearner[predict_var].named_estimators_.keys())
-    print(list_models)
-    
-    # The following only works for the scipy.optimize.nnls
-    # stacking regressor, not the sklearn stacking regressors.
-    print(superlearner[predict_var].final_estimator_.weights_)
+    # Output variables to predict: one name, a comma separated
+    # list, or "all" for every output in SuperLearners.pkl. All
+    # of them are predicted in one pass over the inputs.
+    if args.predict_var == 'all':
+        predict_vars = list(superlearner.keys())
+    else:
+        predict_vars = args.predict_var.split(',')
+    multi_target = len(predict_vars) > 1
+
+    # Stacked predictions skip the submodels with zero weight and
+    # run the others concurrently (--n_jobs threads), optionally
+    # with the compiled submodels (--use_compiled True, see
+    # compile_linear.py and compile_trees.py).
+    use_compiled = str(getattr(args, 'use_compiled', None)) in ('True', 'true')
+    streaming = getattr(args, 'chunk_size', None) is not None
+    stacked_predictors = {}
+    for predict_var in predict_vars:
+        stacked_predictors[predict_var] = StackedPredictor.from_model_dir(
+            model_dir,
+            predict_var,
+            superlearner=superlearner,
+            use_compiled=use_compiled,
+            n_jobs=1 if streaming else int(getattr(args, 'n_jobs', None) or 1))
+
+    # With --novelty True, each site also gets pca.dist and the
+    # combined metric of pca.py, and knn.dist (distance to the
+    # nearest training sites), from the scaler, PCA and KD-tree
+    # saved by train.py (see novelty.py).
+    novelty = None
+    if str(getattr(args, 'novelty', None)) in ('True', 'true'):
+        from novelty import load_novelty
+        from novelty import novelty_scores
+        novelty = load_novelty(model_dir)
 
     #===========================================================
     # Load the train and test data to make plot and estimate
@@ -75,182 +101,304 @@ if __name__ == '__main__':
 
     train_df = pd.read_csv(train_data).astype(np.float32)
     X_train = train_df.values[:, :num_inputs]
-    Y_train = train_df.values[:, num_inputs:]
 
     test_df = pd.read_csv(test_data).astype(np.float32)
     X_test = test_df.values[:, :num_inputs]
-    Y_test = test_df.values[:, num_inputs:]
     
     all_df = pd.concat((train_df,test_df),axis=0)
     X_all = all_df.values[:, :num_inputs]
-    Y_all = all_df.values[:, num_inputs:]
+
+    # Error model of each output, used for the error columns of
+    # the large data set predictions.
+    error_stats = {}
+    train_test_predictions = {}
     
-    #===========================================================
-    # Make some predictions with the testing data
-    #===========================================================
-    Y_hat_train = superlearner[predict_var].predict(X_train)
-    Y_hat_test = superlearner[predict_var].predict(X_test)
-
-    # Compute line of best fit between testing and training targets
-    test_line = np.polynomial.polynomial.Polynomial.fit(
-        np.squeeze(Y_test),
-        np.squeeze(Y_hat_test),1)
-    test_xy = test_line.linspace(n=100,domain=[Y_all.min(),Y_all.max()])
-
-    train_line = np.polynomial.polynomial.Polynomial.fit(
-        np.squeeze(Y_train),
-        np.squeeze(Y_hat_train),1)
-    train_xy = train_line.linspace(n=100,domain=[Y_all.min(),Y_all.max()])
-
-    # Compute some additional statistics
-    # We want to see to what extent we can use
-    # Y_hat_test to predict the error since we'll
-    # be using Y_hat to estimate its own errors.
-    # In this case, this is exactly what
-    # the error in the mean and the predictions,
-    # s_y and s_p, respectively, are getting at.
-    # Equations based on McClave & Dietrich, 
-    # _Statistics_, 6th Ed., pp. 672, 682, 707.
-    n_sample_size = np.size(Y_test)
-    x_bar = np.mean(Y_test)
-    y_bar = np.mean(Y_hat_test)
-    ssxx = np.sum((np.squeeze(Y_test)-np.mean(Y_test))**2)
-    ssyy = np.sum((np.squeeze(Y_hat_test)-np.mean(Y_hat_test))**2)
-    ssxy = np.sum((np.squeeze(Y_hat_test)-np.mean(Y_hat_test))*(np.squeeze(Y_test)-np.mean(Y_test)))
+    for predict_var in predict_vars:
+    
+        # Output files of the evaluation get the output name appended
+        # when predicting several outputs.
+        suffix = '_'+predict_var if multi_target else ''
+        print("Evaluating SuperLearner for output: "+predict_var)
+
+        # For a given output variable, list the models:
+        print("Submodels within SuperLearner and their weights:")
+        list_models = list(superlearner[predict_var].named_estimators_.keys())
+        print(list_models)
     
-    # Root squared errors
-    rse = np.sqrt((np.squeeze(Y_test)-Y_hat_test)**2)
+        # The following only works for the scipy.optimize.nnls
+        # stacking regressor, not the sklearn stacking regressors.
+        print(superlearner[predict_var].final_estimator_.weights_)
+        stacked_predictor = stacked_predictors[predict_var]
 
-    # When trying to predict error based on Y_hat,
-    # the sse_error = sum((error_i - mean(error))^2)
-    # which when expanded algebreically
-    sse_error = ssxx + ssyy - 2.0*ssxy
+        Y_train = train_df[[predict_var]].values
+        Y_test = test_df[[predict_var]].values
+        Y_all = all_df[[predict_var]].values
     
-    # Estimator for the standard error of regression between
-    # true targets and predicted targets.
-    sse = sse_error # Do this if using the test predictions to estimate the error
-    s = np.sqrt(sse/(n_sample_size-2))
+        #===========================================================
+        # Make some predictions with the testing data
+        #===========================================================
+        Y_hat_train = stacked_predictor.predict(X_train)
+        Y_hat_test = stacked_predictor.predict(X_test)
+
+        # Compute line of best fit between testing and training targets
+        test_line = np.polynomial.polynomial.Polynomial.fit(
+            np.squeeze(Y_test),
+            np.squeeze(Y_hat_test),1)
+        test_xy = test_line.linspace(n=100,domain=[Y_all.min(),Y_all.max()])
+
+        train_line = np.polynomial.polynomial.Polynomial.fit(
+            np.squeeze(Y_train),
+            np.squeeze(Y_hat_train),1)
+        train_xy = train_line.linspace(n=100,domain=[Y_all.min(),Y_all.max()])
+
+        # Compute some additional statistics
+        # We want to see to what extent we can use
+        # Y_hat_test to predict the error since we'll
+        # be using Y_hat to estimate its own errors.
+        # In this case, this is exactly what
+        # the error in the mean and the predictions,
+        # s_y and s_p, respectively, are getting at.
+        # Equations based on McClave & Dietrich, 
+        # _Statistics_, 6th Ed., pp. 672, 682, 707.
+        n_sample_size = np.size(Y_test)
+        x_bar = np.mean(Y_test)
+        y_bar = np.mean(Y_hat_test)
+        ssxx = np.sum((np.squeeze(Y_test)-np.mean(Y_test))**2)
+        ssyy = np.sum((np.squeeze(Y_hat_test)-np.mean(Y_hat_test))**2)
+        ssxy = np.sum((np.squeeze(Y_hat_test)-np.mean(Y_hat_test))*(np.squeeze(Y_test)-np.mean(Y_test)))
+    
+        # Root squared errors
+        rse = np.sqrt((np.squeeze(Y_test)-Y_hat_test)**2)
+
+        # When trying to predict error based on Y_hat,
+        # the sse_error = sum((error_i - mean(error))^2)
+        # which when expanded algebreically
+        sse_error = ssxx + ssyy - 2.0*ssxy
+    
+        # Estimator for the standard error of regression between
+        # true targets and predicted targets.
+        sse = sse_error # Do this if using the test predictions to estimate the error
+        s = np.sqrt(sse/(n_sample_size-2))
     
-    # Estimate of the sampling distribution of the predictions
-    # of the mean value of the targets at specific value.
-    # This is nice, but it's very flat -> does not change much
-    # based on Y_test.
-    ssxx = ssyy # (Include this line too for Y_hat_test as a predictor of error, otherwise Y_test is the predictor.)
-    s_y = 2*s*np.sqrt((1/n_sample_size) + ((np.squeeze(Y_test)-np.mean(Y_test))**2)/ssxx)
-    s_p = 2*s*np.sqrt(1+(1/n_sample_size) + ((np.squeeze(Y_test)-np.mean(Y_test))**2)/ssxx)
-
-    fig, ax = plt.subplots()
-    ax.plot(Y_test,rse,'ko')
-    ax.plot(Y_test,s_y,'ro')
-    ax.plot(Y_test,s_p,'co')
-    ax.plot(Y_test,s*np.ones(np.shape(Y_test)),'r.')
-    ax.set_ylabel('Error metric [mg O2/L/h]')
-    ax.set_xlabel('Target respiration rate [mg O2/L/h]')
-    ax.legend(['RSE','Error in mean','Prediction Error','Regression Error'],loc='lower left')
-    ax.grid()
-    plt.savefig(model_dir+'/sl_error.png')
+        # Estimate of the sampling distribution of the predictions
+        # of the mean value of the targets at specific value.
+        # This is nice, but it's very flat -> does not change much
+        # based on Y_test.
+        ssxx = ssyy # (Include this line too for Y_hat_test as a predictor of error, otherwise Y_test is the predictor.)
+        s_y = 2*s*np.sqrt((1/n_sample_size) + ((np.squeeze(Y_test)-np.mean(Y_test))**2)/ssxx)
+        s_p = 2*s*np.sqrt(1+(1/n_sample_size) + ((np.squeeze(Y_test)-np.mean(Y_test))**2)/ssxx)
+
+        fig, ax = plt.subplots()
+        ax.plot(Y_test,rse,'ko')
+        ax.plot(Y_test,s_y,'ro')
+        ax.plot(Y_test,s_p,'co')
+        ax.plot(Y_test,s*np.ones(np.shape(Y_test)),'r.')
+        ax.set_ylabel('Error metric [mg O2/L/h]')
+        ax.set_xlabel('Target respiration rate [mg O2/L/h]')
+        ax.legend(['RSE','Error in mean','Prediction Error','Regression Error'],loc='lower left')
+        ax.grid()
+        plt.savefig(model_dir+'/sl_error'+suffix+'.png')
     
-    # Print out correlations between the various error estimates:
-    print("RSE: "+str(np.mean(rse))+" +/- "+str(np.std(rse)))
-    print("mean.error: "+str(np.mean(s_y))+" +/- "+str(np.std(s_y)))
-    print("predict.error: "+str(np.mean(s_p))+" +/- "+str(np.std(s_p)))
+        # Print out correlations between the various error estimates:
+        print("RSE: "+str(np.mean(rse))+" +/- "+str(np.std(rse)))
+        print("mean.error: "+str(np.mean(s_y))+" +/- "+str(np.std(s_y)))
+        print("predict.error: "+str(np.mean(s_p))+" +/- "+str(np.std(s_p)))
     
-    print("RSE vs mean.error: "+str(np.corrcoef(rse,s_y)))
-    print("RSE vs predict.error: "+str(np.corrcoef(rse,s_p)))
-    # Causes workflow to crash, not very useful, comment out.
-    #print("RSE vs s: "+str(np.corrcoef(rse,s*np.ones(np.shape(Y_test)))))
+        print("RSE vs mean.error: "+str(np.corrcoef(rse,s_y)))
+        print("RSE vs predict.error: "+str(np.corrcoef(rse,s_p)))
+        # Causes workflow to crash, not very useful, comment out.
+        #print("RSE vs s: "+str(np.corrcoef(rse,s*np.ones(np.shape(Y_test)))))
     
-    # Print out data used in plot below so plot can be recreated
-    df_train_scatter_out = pd.DataFrame(data=np.squeeze(Y_train), columns=['target'])
-    df_train_scatter_out['predicted'] = np.squeeze(Y_hat_train)
-    df_train_scatter_out.to_csv(model_dir+'/sl_scatter_train.csv')
+        # Print out data used in plot below so plot can be recreated
+        df_train_scatter_out = pd.DataFrame(data=np.squeeze(Y_train), columns=['target'])
+        df_train_scatter_out['predicted'] = np.squeeze(Y_hat_train)
+        df_train_scatter_out.to_csv(model_dir+'/sl_scatter_train'+suffix+'.csv')
     
-    df_test_scatter_out = pd.DataFrame(data=np.squeeze(Y_test), columns=['target'])
-    df_test_scatter_out['predicted'] = np.squeeze(Y_hat_test)
-    df_test_scatter_out.to_csv(model_dir+'/sl_scatter_test.csv')
-
-    # Evaluate using a high/low split  
-    print("evaluating hold out on a high/low split")
-    threshold = -500
-    ho_metrics = {}
+        df_test_scatter_out = pd.DataFrame(data=np.squeeze(Y_test), columns=['target'])
+        df_test_scatter_out['predicted'] = np.squeeze(Y_hat_test)
+        df_test_scatter_out.to_csv(model_dir+'/sl_scatter_test'+suffix+'.csv')
+
+        # Evaluate using a high/low split  
+        print("evaluating hold out on a high/low split")
+        threshold = -500
+        ho_metrics = {}
     
-    sl_scatter_test_high = np.delete(df_test_scatter_out, np.where(df_test_scatter_out["predicted"] >= threshold)[0], axis=0)
-    sl_scatter_test_low = np.delete(df_test_scatter_out, np.where(df_test_scatter_out["predicted"] < threshold)[0], axis=0)
+        sl_scatter_test_high = np.delete(df_test_scatter_out, np.where(df_test_scatter_out["predicted"] >= threshold)[0], axis=0)
+        sl_scatter_test_low = np.delete(df_test_scatter_out, np.where(df_test_scatter_out["predicted"] < threshold)[0], axis=0)
     
-    sl_scatter_test_high = pd.DataFrame(sl_scatter_test_high, columns = df_test_scatter_out.columns)
-    sl_scatter_test_low = pd.DataFrame(sl_scatter_test_low, columns = df_test_scatter_out.columns)
+        sl_scatter_test_high = pd.DataFrame(sl_scatter_test_high, columns = df_test_scatter_out.columns)
+        sl_scatter_test_low = pd.DataFrame(sl_scatter_test_low, columns = df_test_scatter_out.columns)
 
-    ho_metrics["r2_high"] = sklearn.metrics.r2_score(sl_scatter_test_high["target"], sl_scatter_test_high["predicted"])
-    ho_metrics["r2_low"] = sklearn.metrics.r2_score(sl_scatter_test_low["target"], sl_scatter_test_low["predicted"])
+        ho_metrics["r2_high"] = sklearn.metrics.r2_score(sl_scatter_test_high["target"], sl_scatter_test_high["predicted"])
+        ho_metrics["r2_low"] = sklearn.metrics.r2_score(sl_scatter_test_low["target"], sl_scatter_test_low["predicted"])
 
-    with open(args.model_dir + '/hold-out-metrics-high-low-split.json', 'w') as json_file:
-        json.dump(ho_metrics, json_file, indent = 4)
+        with open(args.model_dir + '/hold-out-metrics-high-low-split'+suffix+'.json', 'w') as json_file:
+            json.dump(ho_metrics, json_file, indent = 4)
     
-    #===========================================================
-    # Make an evaluation plot
-    #===========================================================
-    fig, ax = plt.subplots(figsize=(10,10))
-    ax.plot(Y_train,np.squeeze(Y_hat_train),'ko',markersize=10)
-    ax.plot(Y_test,np.squeeze(Y_hat_test),'ko',markersize=10,fillstyle='none')
-    ax.plot(test_xy[0],test_xy[1],'r-')
-    ax.plot(train_xy[0],train_xy[1],'r--')
-    ax.grid()
-    ax.set_xlabel('Original target values, mg O2/L/h')
-    ax.set_ylabel('Model predictions, mg O2/L/h')
+        #===========================================================
+        # Make an evaluation plot
+        #===========================================================
+        fig, ax = plt.subplots(figsize=(10,10))
+        ax.plot(Y_train,np.squeeze(Y_hat_train),'ko',markersize=10)
+        ax.plot(Y_test,np.squeeze(Y_hat_test),'ko',markersize=10,fillstyle='none')
+        ax.plot(test_xy[0],test_xy[1],'r-')
+        ax.plot(train_xy[0],train_xy[1],'r--')
+        ax.grid()
+        ax.set_xlabel('Original target values, mg O2/L/h')
+        ax.set_ylabel('Model predictions, mg O2/L/h')
     
-    # Predict and metric with the individual models
-    # (The same thing can be achieved with built in:
-    # superlearner[predict_var].transform(X)
-    # but done explicitly here.)
-    for model_name in list_models:
-        model_object = superlearner[predict_var].named_estimators_[model_name]
-        Y_hat_train_mod = model_object.predict(X_train)
-        Y_hat_test_mod = model_object.predict(X_test)
+        # Predict and metric with the individual models
+        # (The same thing can be achieved with built in:
+        # superlearner[predict_var].transform(X)
+        # but done explicitly here.)
+        for model_name in list_models:
+            model_object = superlearner[predict_var].named_estimators_[model_name]
+            Y_hat_train_mod = model_object.predict(X_train)
+            Y_hat_test_mod = model_object.predict(X_test)
         
-        # Color coded dots
-        ax.plot(np.concatenate((Y_train,Y_test),axis=0),
-                np.concatenate((np.squeeze(Y_hat_train_mod),np.squeeze(Y_hat_test_mod)),axis=0),
-                '.',markersize=5)
+            # Color coded dots
+            ax.plot(np.concatenate((Y_train,Y_test),axis=0),
+                    np.concatenate((np.squeeze(Y_hat_train_mod),np.squeeze(Y_hat_test_mod)),axis=0),
+                    '.',markersize=5)
     
-    # One-to-one line
-    ax.plot(Y_all,Y_all,'k')
+        # One-to-one line
+        ax.plot(Y_all,Y_all,'k')
 
-    # Set zoom
-    #ax.set_xlim([-45,0])
-    #ax.set_ylim([-45,0])
+        # Set zoom
+        #ax.set_xlim([-45,0])
+        #ax.set_ylim([-45,0])
 
-    # Legend
-    ax.legend(['Stacked TRAIN','Stacked TEST','TEST corr','TRAIN corr']+list_models+['one-to-one'])
+        # Legend
+        ax.legend(['Stacked TRAIN','Stacked TEST','TEST corr','TRAIN corr']+list_models+['one-to-one'])
 
-    # Save figure to file
-    plt.savefig(model_dir+'/sl_scatter.png')
+        # Save figure to file
+        plt.savefig(model_dir+'/sl_scatter'+suffix+'.png')
+        plt.close('all')
+
+        error_stats[predict_var] = (s, n_sample_size, ssxx, np.mean(Y_test))
+        train_test_predictions[predict_var] = np.concatenate((np.ravel(Y_hat_train), np.ravel(Y_hat_test)))
 
     #===========================================================
     # Make predictions with a large data set
     #===========================================================
-    predict_df = pd.read_csv(predict_data_csv).astype(np.float32)
-    predict_df.fillna(predict_df.mean(),inplace=True)
-    X = predict_df.values
-    
-    Y_predict = superlearner[predict_var].predict(X)
     
+    # Optional fast path: use a surrogate distilled from the
+    # ensemble (distill.py) instead of the full SuperLearner.
+    surrogate_path = getattr(args, 'surrogate', None)
+    if surrogate_path is not None:
+        if multi_target:
+            raise ValueError('--surrogate predicts a single output, use one --predict_var')
+        from distill import load_surrogate
+        # The surrogate takes the inputs by position, so the columns
+        # of the prediction inputs must be the ones it was
+        # distilled with.
+        surrogate = load_surrogate(surrogate_path, predict_vars[0],
+                                   feature_names=pd.read_csv(predict_data_csv, nrows=0).columns)
+        print("Using surrogate "+surrogate_path+" with hold out fidelity R2 "+str(surrogate['fidelity']['r2']))
+
     # Estimate the error based on the training data
-    Y_hat_error = 2*s*np.sqrt((1/n_sample_size) + ((np.squeeze(Y_predict)-np.mean(Y_test))**2)/ssxx)
-    Y_hat_pred_error = 2*s*np.sqrt(1+(1/n_sample_size) + ((np.squeeze(Y_predict)-np.mean(Y_test))**2)/ssxx)
+    def error_columns(predict_var, Y_predict):
+        s, n_sample_size, ssxx, mean_test = error_stats[predict_var]
+        Y_hat_error = 2*s*np.sqrt((1/n_sample_size) + ((np.squeeze(Y_predict)-mean_test)**2)/ssxx)
+        Y_hat_pred_error = 2*s*np.sqrt(1+(1/n_sample_size) + ((np.squeeze(Y_predict)-mean_test)**2)/ssxx)
+        return Y_hat_error, Y_hat_pred_error
+
+    # The scaled error and distance are relative to the largest
+    # values over the training and testing data, so that they
+    # are the same for every chunk of prediction sites.
+    error_scales = {}
+    if novelty is not None:
+        for predict_var in predict_vars:
+            error_scales[predict_var] = np.max(error_columns(predict_var, train_test_predictions[predict_var])[0])
+
+    # Prediction and error columns of each output; the error
+    # columns are prefixed with the output name when predicting
+    # several outputs. scores adds the novelty columns.
+    def add_output_columns(output_df, Y_predicts, scores=None):
+        for predict_var in predict_vars:
+            Y_hat_error, Y_hat_pred_error = error_columns(predict_var, Y_predicts[predict_var])
+            prefix = predict_var+'.' if multi_target else ''
+            output_df[predict_var] = pd.Series(Y_predicts[predict_var])
+            output_df[prefix+'mean.error'] = pd.Series(Y_hat_error)
+            output_df[prefix+'predict.error'] = pd.Series(Y_hat_pred_error)
+        if scores is not None:
+            output_df['pca.dist'] = pd.Series(scores['pca.dist'])
+            output_df['pca.dist.scaled'] = pd.Series(scores['pca.dist']/novelty['dist_scale'])
+            for predict_var in predict_vars:
+                prefix = predict_var+'.' if multi_target else ''
+                output_df[prefix+'mean.error.scaled'] = output_df[prefix+'mean.error']/error_scales[predict_var]
+                output_df[prefix+'combined.metric'] = output_df[prefix+'mean.error.scaled']*output_df['pca.dist.scaled']
+            if 'knn.dist' in scores:
+                output_df['knn.dist'] = pd.Series(scores['knn.dist'])
+        return output_df
+
+    # Optionally also write the output as lat/lon tiles with an
+    # index (--tile_deg <degrees>, see tiles.py) so that regions
+    # can be read or updated without the whole file.
+    tile_writer = None
+    if getattr(args, 'tile_deg', None) is not None:
+        from tiles import TileWriter
+        tile_writer = TileWriter(model_dir+'/sl_predictions_tiles', float(args.tile_deg))
+
+    if streaming:
+        #===========================================================
+        # Streaming mode: read the inputs and .ixy rows in aligned
+        # chunks, predict them on a pool of workers and append the
+        # results to the output file in order.
+        #===========================================================
+        import stream
+        chunk_size = int(args.chunk_size)
+        n_jobs = int(getattr(args, 'n_jobs', None) or 1)
+        if n_jobs < 0:
+            n_jobs = stream.default_n_jobs()
+        print("Streaming predictions in chunks of "+str(chunk_size)+" rows on "+str(n_jobs)+" worker(s)")
+
+        fill_values = stream.column_means(predict_data_csv, chunk_size)
+        chunks = stream.iter_chunks(predict_data_csv, predict_data_ixy, chunk_size, fill_values)
+        # The novelty scores are cheap, so they are computed here
+        # and only the distances are kept with each chunk.
+        chunks = ((X, (output_df, novelty_scores(novelty, X) if novelty is not None else None))
+                  for X, output_df in chunks)
+        results = stream.ordered_map(
+            stream.predict_chunk,
+            chunks,
+            n_jobs=n_jobs,
+            initializer=stream.init_superlearner_worker,
+            initargs=(model_dir, predict_vars, surrogate_path, use_compiled))
+
+        first = True
+        for Y_predicts, (output_df, scores) in results:
+            add_output_columns(output_df, Y_predicts, scores)
+            stream.append_csv(output_df, predict_output_file, first)
+            if tile_writer is not None:
+                tile_writer.write(output_df)
+            first = False
+    else:
+        predict_df = pd.read_csv(predict_data_csv).astype(np.float32)
+        predict_df.fillna(predict_df.mean(),inplace=True)
+        X = predict_df.values
     
-    #===========================================================
-    # Write output file
-    #===========================================================
+        if surrogate_path is not None:
+            Y_predicts = {predict_vars[0]: surrogate['model'].predict(X)}
+        else:
+            Y_predicts = predict_many(stacked_predictors, X)
     
-    # Put the predictions with lon lat data separated beforehand.
-    output_df = pd.read_csv(predict_data_ixy)
-        
-    output_df[predict_var] = pd.Series(Y_predict)
-    output_df['mean.error'] = pd.Series(Y_hat_error)
-    output_df['predict.error'] = pd.Series(Y_hat_pred_error)
-    output_df.to_csv(
-        predict_output_file,
-        index=False,
-        na_rep='NaN')
+        #===========================================================
+        # Write output file
+        #===========================================================
+    
+        # Put the predictions with lon lat data separated beforehand.
+        output_df = pd.read_csv(predict_data_ixy)
+        scores = novelty_scores(novelty, X, int(getattr(args, 'n_jobs', None) or 1)) if novelty is not None else None
+        add_output_columns(output_df, Y_predicts, scores)
+        output_df.to_csv(
+            predict_output_file,
+            index=False,
+            na_rep='NaN')
+        if tile_writer is not None:
+            tile_writer.write(output_df)
+
+    if tile_writer is not None:
+        tile_writer.close()
 
 print("Done!")
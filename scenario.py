@@ -0,0 +1,318 @@
+#================================
+# SuperLearner scenarios
+#================================
+# Evaluate what-if scenarios,
+# e.g. +1 deg C Mean_Temp_Deg_C or
+# scaled land use *_pc_cse, for
+# all prediction sites in one
+# batched pass.
+#
+# Scenarios are declared in a JSON
+# file as column perturbations:
+# {"scenarios": [
+#   {"name": "warmer",
+#    "perturb": [{"columns": ["Mean_Temp_Deg_C"], "add": 1.0}]},
+#   {"name": "less_crops",
+#    "perturb": [{"columns": ["crp_pc_cse"], "scale": 0.5},
+#                {"columns": ["*_pc_cse"], "clip": [0, 100]}]}
+# ]}
+# Each perturbation applies one of
+# "add", "scale", "set" or "clip"
+# to the listed columns (shell
+# style patterns are expanded),
+# in the order given.
+#
+# The inputs are read once, in
+# chunks. For every chunk, each
+# stacked submodel is evaluated on
+# the baseline and all scenarios
+# stacked into one batch, except
+# that a submodel that does not
+# use any of the columns perturbed
+# by a scenario (e.g. a lasso with
+# a zero coefficient there) reuses
+# its baseline predictions for
+# that scenario.
+#
+# The output is one table with a
+# row per site and a column per
+# scenario (plus the difference
+# from the baseline with
+# --delta True).
+#
+# Command line execution:
+# python -m scenario
+# --model_dir ./model_dir
+# --predict_var <target name>
+# --predict_data ./path/to/predict_data
+# --scenarios ./scenarios.json
+# (optional) --output_file <model_dir>/sl_scenarios.csv
+# (optional) --delta True
+# (optional) --chunk_size 20000
+# (optional) --n_jobs 1
+# (optional) --use_compiled True
+#================================
+
+# Dependencies
+import argparse
+import fnmatch
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.preprocessing import MaxAbsScaler
+from sklearn.preprocessing import RobustScaler
+from sklearn.preprocessing import PowerTransformer
+from sklearn.preprocessing import QuantileTransformer
+from sklearn.preprocessing import PolynomialFeatures
+import pandas as pd
+import stream
+from compile_linear import CompiledLinearBlend
+from compile_linear import CompiledPolynomial
+from compile_linear import unwrap_learner
+from compile_trees import FlatForest
+from stacking import SharedInputLearner
+from stacking import StackedPredictor
+from stacking import shared_inputs
+from stacking import predict_learner
+
+# Input transforms that act on each column separately.
+PER_FEATURE_TRANSFORMS = (StandardScaler, MinMaxScaler, MaxAbsScaler, RobustScaler,
+                          PowerTransformer, QuantileTransformer)
+
+BASELINE = 'baseline'
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def load_scenarios(path, columns):
+    # Read the scenario file and resolve the column patterns.
+    # Returns a list of (name, [(column indices, op, value)]).
+    with open(path) as file_object:
+        spec = json.load(file_object)
+    scenarios = []
+    for scenario in spec['scenarios']:
+        if scenario['name'] == BASELINE:
+            raise ValueError('Scenario name "'+BASELINE+'" is reserved')
+        perturbations = []
+        for perturb in scenario['perturb']:
+            patterns = perturb['columns']
+            if isinstance(patterns, str):
+                patterns = [patterns]
+            index = [ii for ii, column in enumerate(columns)
+                     if any(fnmatch.fnmatchcase(column, pattern) for pattern in patterns)]
+            if len(index) == 0:
+                raise ValueError('Scenario '+scenario['name']+': no columns match '+str(patterns))
+            ops = [op for op in ('add', 'scale', 'set', 'clip') if op in perturb]
+            if len(ops) != 1:
+                raise ValueError('Scenario '+scenario['name']+': give one of add, scale, set or clip')
+            perturbations.append((np.array(index), ops[0], perturb[ops[0]]))
+        scenarios.append((scenario['name'], perturbations))
+    return scenarios
+
+def apply_scenario(X, perturbations):
+    X = X.copy()
+    for index, op, value in perturbations:
+        if op == 'add':
+            X[:, index] += value
+        elif op == 'scale':
+            X[:, index] *= value
+        elif op == 'set':
+            X[:, index] = value
+        else:
+            X[:, index] = np.clip(X[:, index], value[0], value[1])
+    return X
+
+def perturbed_columns(perturbations, n_features):
+    mask = np.zeros(n_features, dtype=bool)
+    for index, _, _ in perturbations:
+        mask[index] = True
+    return mask
+
+def core_features(core, n_features):
+    # Columns of its own input that a fitted core estimator uses,
+    # or None if it may use all of them.
+    if hasattr(core, 'get_booster'):
+        mask = np.zeros(n_features, dtype=bool)
+        for name in core.get_booster().get_score(importance_type='weight'):
+            mask[int(name[1:])] = True
+        return mask
+    trees = None
+    if hasattr(core, 'tree_'):
+        trees = [core]
+    elif hasattr(core, 'estimators_') and all(hasattr(tree, 'tree_') for tree in np.ravel(core.estimators_)):
+        trees = np.ravel(core.estimators_)
+    if trees is not None:
+        mask = np.zeros(n_features, dtype=bool)
+        for tree in trees:
+            mask[tree.tree_.feature[tree.tree_.feature >= 0]] = True
+        return mask
+    if hasattr(core, 'coef_'):
+        return np.ravel(core.coef_) != 0.0
+    return None
+
+def learner_features(model, n_features):
+    # Boolean mask of the input columns that a (possibly compiled)
+    # submodel depends on, or None if unknown (all columns).
+    if isinstance(model, FlatForest):
+        # Leaves have infinite thresholds; per-column input ops
+        # keep the column order.
+        mask = np.zeros(n_features, dtype=bool)
+        mask[np.asarray(model.feature)[np.isfinite(np.asarray(model.threshold))]] = True
+        return mask
+    if isinstance(model, CompiledPolynomial):
+        mask = np.zeros(n_features + 1, dtype=bool)
+        mask[np.ravel(model.index)] = True
+        return mask[:n_features]
+    if isinstance(model, CompiledLinearBlend):
+        masks = [learner_features(part, n_features) for _, part in model.parts]
+        return np.any(masks, axis=0)
+    if isinstance(model, SharedInputLearner):
+        steps, core = model.steps, model.final
+    else:
+        steps, core, _ = unwrap_learner(model)
+    n_core = core.n_features_in_ if hasattr(core, 'n_features_in_') else n_features
+    mask = core_features(core, n_core)
+    if mask is None:
+        return None
+    # Map back through the input transforms.
+    for step in reversed(steps):
+        if isinstance(step, PolynomialFeatures):
+            mask = np.any(step.powers_[mask] > 0, axis=0)
+        elif not isinstance(step, PER_FEATURE_TRANSFORMS):
+            return None
+    return mask
+
+class ScenarioPredictor:
+    # Evaluate a StackedPredictor for the baseline and all
+    # scenarios of a chunk, sharing baseline submodel predictions
+    # where a submodel does not see the perturbed columns.
+    def __init__(self, predictor, scenarios, n_features, n_jobs=1):
+        self.predictor = predictor
+        self.scenarios = scenarios
+        self.n_jobs = n_jobs
+        touched = [perturbed_columns(perturbations, n_features) for _, perturbations in scenarios]
+
+        # The compiled blend enters the stack with weight 1.
+        self.models = list(predictor.models)
+        self.weights = list(predictor.weights[predictor.active]) if predictor.linear else []
+        if predictor.blend is not None:
+            self.models.append(predictor.blend)
+            self.weights.append(1.0)
+        self.weights = np.array(self.weights)
+
+        # needs[j][s]: submodel j must be evaluated for scenario s
+        self.needs = []
+        for model in self.models:
+            features = learner_features(model, n_features)
+            self.needs.append(tuple(features is None or bool(np.any(features & mask)) for mask in touched))
+        self.n_shared = sum(not need for needs in self.needs for need in needs)
+
+    def predict(self, X):
+        # {scenario name: predictions}, baseline included.
+        X_list = [X] + [apply_scenario(X, perturbations) for _, perturbations in self.scenarios]
+        names = [BASELINE] + [name for name, _ in self.scenarios]
+        predictor = self.predictor
+        if not predictor.linear:
+            Y = predictor.predict(np.concatenate(X_list, axis=0))
+            return dict(zip(names, np.split(Y, len(X_list))))
+
+        # Submodels that need the same scenarios get the same batch
+        # (baseline + those scenarios), so transformed inputs are
+        # shared within the batch.
+        groups = {}
+        for jj, need in enumerate(self.needs):
+            groups.setdefault(need, []).append(jj)
+        jobs = []
+        for need, members in groups.items():
+            X_batch = np.concatenate([X_list[0]] + [Xs for Xs, needed in zip(X_list[1:], need) if needed], axis=0)
+            inputs = shared_inputs([self.models[jj] for jj in members], X_batch)
+            jobs += [(jj, X_batch, inputs) for jj in members]
+
+        def run(job):
+            jj, X_batch, inputs = job
+            return jj, predict_learner(self.models[jj], X_batch, inputs)
+
+        if self.n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+                results = list(pool.map(run, jobs))
+        else:
+            results = [run(job) for job in jobs]
+
+        # P[s] holds the submodel predictions for scenario s; a
+        # scenario that was not evaluated takes the baseline.
+        P = np.empty((len(X_list), X.shape[0], len(self.models)))
+        for jj, Y in results:
+            Y = np.split(Y, 1 + sum(self.needs[jj]))
+            kk = 0
+            for ss in range(len(X_list)):
+                if ss == 0 or self.needs[jj][ss - 1]:
+                    P[ss, :, jj] = Y[kk]
+                    kk += 1
+                else:
+                    P[ss, :, jj] = Y[0]
+
+        out = {}
+        for ss, name in enumerate(names):
+            Y = P[ss] @ self.weights + predictor.intercept
+            if predictor.passthrough:
+                Y = Y + X_list[ss] @ predictor.passthrough_weights
+            out[name] = Y
+        return out
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner scenario arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    predict_var = args.predict_var
+    predict_data_csv = args.predict_data+'.csv'
+    predict_data_ixy = args.predict_data+'.ixy'
+    output_file = getattr(args, 'output_file', None) or model_dir+'/sl_scenarios.csv'
+    delta = str(getattr(args, 'delta', None)) in ('True', 'true')
+    chunk_size = int(getattr(args, 'chunk_size', None) or 20000)
+    n_jobs = int(getattr(args, 'n_jobs', None) or 1)
+    use_compiled = str(getattr(args, 'use_compiled', None)) in ('True', 'true')
+
+    sys.path.append(model_dir)
+    predictor = StackedPredictor.from_model_dir(model_dir, predict_var, use_compiled=use_compiled)
+
+    columns = list(pd.read_csv(predict_data_csv, nrows=0).columns)
+    scenarios = load_scenarios(args.scenarios, columns)
+    scenario_predictor = ScenarioPredictor(predictor, scenarios, len(columns), n_jobs=n_jobs)
+    print('Evaluating '+str(len(scenarios))+' scenarios plus the baseline; '+
+          str(scenario_predictor.n_shared)+' (submodel, scenario) evaluations reuse the baseline')
+
+    #===========================================================
+    # One pass over the inputs for all scenarios
+    #===========================================================
+    fill_values = stream.column_means(predict_data_csv, chunk_size)
+    first = True
+    for X, output_df in stream.iter_chunks(predict_data_csv, predict_data_ixy, chunk_size, fill_values):
+        Y = scenario_predictor.predict(X)
+        output_df[predict_var+'.'+BASELINE] = Y[BASELINE]
+        for name, _ in scenarios:
+            output_df[predict_var+'.'+name] = Y[name]
+            if delta:
+                output_df[predict_var+'.'+name+'.delta'] = Y[name] - Y[BASELINE]
+        stream.append_csv(output_df, output_file, first)
+        first = False
+
+    print("Done!")
@@ -0,0 +1,175 @@
+#================================
+# SuperLearner site selection
+#================================
+# Pick the next batch of sites to
+# sample (ModEx) from the ranking
+# written by pca.py: the top
+# --budget sites by combined.metric
+# (or any other --metric column),
+# skipping sites within --min_dist
+# of a site already picked so the
+# batch is not a cluster of
+# redundant neighbors.
+#
+# sl_pca.csv is read in chunks and
+# only a pool of the best
+# --pool_factor x budget sites is
+# kept, so there is no full sort.
+# The pool is then walked in score
+# order, keeping each site that is
+# far enough from the ones already
+# kept, so distances are only
+# computed against the batch.
+#
+# Distances (--space):
+# + geo: great circle distance
+#   between sites, --min_dist in km
+# + inputs: distance between the
+#   sites' inputs, standardized with
+#   the scaler of the KD-tree index
+#   written by pca.py --knn
+#   (sl_pca_knn.pkl), --min_dist in
+#   standard deviations; needs
+#   --predict_data
+#
+# Command line execution:
+# python -m select_sites
+# --model_dir ./model_dir
+# --budget 50
+# (optional) --metric combined.metric
+# (optional) --space geo
+# (optional) --min_dist 100
+# (optional) --predict_data ./path/to/predict_data
+# (optional) --input_file <model_dir>/sl_pca.csv
+# (optional) --output_file <model_dir>/sl_selected_sites.csv
+# (optional) --pool_factor 20
+# (optional) --chunk_size 100000
+#================================
+
+# Dependencies
+import argparse
+import pickle
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def top_candidates(csv_path, metric, pool_size, chunk_size):
+    # The pool_size rows with the largest metric (ties in file
+    # order), reading csv_path in chunks.
+    pool = None
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size, dtype={'Sample_ID': str}):
+        chunk = chunk[np.isfinite(chunk[metric].values)]
+        if len(chunk) > pool_size:
+            keep = np.argpartition(-chunk[metric].values, pool_size - 1)[:pool_size]
+            chunk = chunk.iloc[np.sort(keep)]
+        pool = chunk if pool is None else pd.concat([pool, chunk], axis=0)
+        if len(pool) > pool_size:
+            pool = pool.sort_values(metric, ascending=False, kind='mergesort').iloc[:pool_size]
+    if pool is None:
+        return pd.DataFrame()
+    return pool.sort_values(metric, ascending=False, kind='mergesort')
+
+def geo_coordinates(pool):
+    # Latitude and longitude in radians.
+    return np.radians(pool[['Sample_Latitude', 'Sample_Longitude']].values.astype(np.float64))
+
+def geo_distance(point, points):
+    # Great circle (haversine) distances in km.
+    dlat = points[:, 0] - point[0]
+    dlon = points[:, 1] - point[1]
+    a = np.sin(dlat/2)**2 + np.cos(point[0])*np.cos(points[:, 0])*np.sin(dlon/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def input_coordinates(pool, predict_data, knn_index, chunk_size):
+    # Standardized inputs of the pool sites, found by Sample_ID in
+    # the prediction inputs (read in chunks).
+    wanted = set(pool['Sample_ID'])
+    found = {}
+    csv_reader = pd.read_csv(predict_data+'.csv', chunksize=chunk_size)
+    ixy_reader = pd.read_csv(predict_data+'.ixy', chunksize=chunk_size, dtype={'Sample_ID': str})
+    for inputs, ixy in zip(csv_reader, ixy_reader):
+        hit = ixy['Sample_ID'].isin(wanted).values
+        if hit.any():
+            values = inputs.loc[hit, knn_index['features']].values
+            for sample_id, row in zip(ixy['Sample_ID'].values[hit], values):
+                found[sample_id] = row
+    return knn_index['scaler'].transform(np.array([found[sample_id] for sample_id in pool['Sample_ID']]))
+
+def input_distance(point, points):
+    return np.linalg.norm(points - point, axis=1)
+
+def select_diverse(scores, coordinates, distance, budget, min_dist):
+    # Greedy selection in score order (scores already sorted):
+    # keep a site if it is at least min_dist from every site kept
+    # so far. Returns the positions of the kept sites.
+    selected = []
+    for ii in range(len(scores)):
+        if len(selected) == budget:
+            break
+        if min_dist > 0 and len(selected) > 0:
+            if np.min(distance(coordinates[ii], coordinates[selected])) < min_dist:
+                continue
+        selected.append(ii)
+    return selected
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner site selection arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    budget = int(args.budget)
+    metric = getattr(args, 'metric', None) or 'combined.metric'
+    space = getattr(args, 'space', None) or 'geo'
+    min_dist = float(getattr(args, 'min_dist', None) or 0)
+    input_file = getattr(args, 'input_file', None) or model_dir+'/sl_pca.csv'
+    output_file = getattr(args, 'output_file', None) or model_dir+'/sl_selected_sites.csv'
+    pool_factor = int(getattr(args, 'pool_factor', None) or 20)
+    chunk_size = int(getattr(args, 'chunk_size', None) or 100000)
+
+    #===========================================================
+    # Best candidates, then a diverse batch among them
+    #===========================================================
+    pool = top_candidates(input_file, metric, budget*pool_factor, chunk_size)
+    print('Candidate pool: '+str(len(pool))+' sites')
+
+    if space == 'geo':
+        coordinates = geo_coordinates(pool)
+        distance = geo_distance
+    elif space == 'inputs':
+        with open(model_dir+'/sl_pca_knn.pkl', 'rb') as file_object:
+            knn_index = pickle.load(file_object)
+        coordinates = input_coordinates(pool, args.predict_data, knn_index, chunk_size)
+        distance = input_distance
+    else:
+        raise ValueError('--space must be geo or inputs')
+
+    selected = select_diverse(pool[metric].values, coordinates, distance, budget, min_dist)
+    if len(selected) < budget:
+        print('WARNING: only '+str(len(selected))+' sites in the pool are '+str(min_dist)+
+              ' apart; increase --pool_factor or decrease --min_dist')
+
+    output_df = pool.iloc[selected].copy()
+    output_df.insert(0, 'rank', np.arange(1, len(selected) + 1))
+    output_df.to_csv(output_file, index=False, na_rep='NaN')
+    print('Selected '+str(len(selected))+' sites')
+
+    print("Done!")
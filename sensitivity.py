@@ -0,0 +1,324 @@
+#================================
+# SuperLearner global sensitivity
+#================================
+# Variance-based (Sobol) or
+# elementary effects (Morris)
+# sensitivity indices of the
+# stacked model and of each base
+# learner, alongside the FPI
+# ratios of fpi.py.
+#
+# Factors are the feature groups
+# of fpi.py (one-hot features and
+# features correlated above
+# --corr_cutoff, default 0.5, are
+# one factor), so the design never
+# sets correlated or one-hot
+# columns independently of each
+# other. Each factor is a number u
+# in [0, 1] that is mapped to the
+# train + test inputs:
+# + a single continuous feature:
+#   the u quantile of its values
+# + a group (or a binary feature):
+#   the values of one site, with
+#   the sites ordered along the
+#   first principal component of
+#   the group (standardized), so
+#   nearby u are similar sites
+# so every design point is within
+# the feature ranges of the data
+# and the factors follow the
+# distribution of the data.
+#
+# Designs (--method):
+# + sobol: Saltelli design with
+#   --n_samples (rounded up to a
+#   power of 2) scrambled Sobol
+#   points, N (k + 2) evaluations
+#   for k factors; first order
+#   (S1, Saltelli 2010) and total
+#   (ST, Jansen) indices with
+#   bootstrap --confidence
+#   intervals
+# + morris: --n_trajectories
+#   trajectories on an --n_levels
+#   grid, r (k + 1) evaluations;
+#   mu, mu_star and sigma of the
+#   elementary effects (per unit of
+#   u) with a bootstrap interval
+#   on mu_star
+#
+# The design rows are evaluated in
+# chunks of --chunk_size rows on
+# --n_jobs worker processes
+# (stream.py). Each chunk is
+# predicted once: the stacked
+# prediction is computed from the
+# base learner predictions, which
+# are analyzed with the same
+# design rows.
+#
+# Outputs (in model_dir):
+# sl_sensitivity_sobol.csv or
+# sl_sensitivity_morris.csv: one
+# row per factor, with columns
+# <index><model> for the stack and
+# each base learner (e.g. S1stack,
+# S1_Confstack, STetr, ...)
+#
+# Command line execution:
+# python -m sensitivity
+# --model_dir ./model_dir
+# --num_inputs 25
+# --predict_var <target name>
+# (optional) --method sobol
+# (optional) --n_samples 1024
+# (optional) --n_trajectories 20
+# (optional) --n_levels 4
+# (optional) --n_bootstrap 100
+# (optional) --confidence 0.95
+# (optional) --corr_cutoff 0.5
+# (optional) --seed 0
+# (optional) --chunk_size 100000
+# (optional) --n_jobs 1
+#================================
+
+# Dependencies
+import argparse
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.stats import qmc
+import stream
+from fpi import group_correlated_features
+from fpi import parse_permutation_feature_blocks
+from stacking import StackedPredictor
+
+#=======================================
+# Supporting functions
+#=======================================
+
+class FactorSpace:
+    # Maps factors u in [0, 1] (one per group of columns) to inputs,
+    # see the header. X: the data (n_sites, n_features), groups:
+    # lists of column indices.
+    def __init__(self, X, groups):
+        X = np.asarray(X, dtype=np.float64)
+        self.n_features = X.shape[1]
+        self.groups = [np.asarray(group) for group in groups]
+        self.values = []
+        self.continuous = []
+        for group in self.groups:
+            values = X[:, group]
+            continuous = len(group) == 1 and len(np.unique(values)) > 2
+            if continuous:
+                values = np.sort(values[:, 0])
+            elif len(group) > 1:
+                scale = np.std(values, axis=0)
+                scaled = (values - np.mean(values, axis=0))/np.where(scale > 0, scale, 1.0)
+                first_component = np.linalg.svd(scaled, full_matrices=False)[2][0]
+                values = values[np.argsort(scaled @ first_component, kind='stable')]
+            else:
+                values = np.sort(values, axis=0)
+            self.values.append(values)
+            self.continuous.append(continuous)
+
+    def to_inputs(self, U):
+        # Inputs (n_rows, n_features) for factors U (n_rows, n_groups).
+        X = np.empty((U.shape[0], self.n_features), dtype=np.float32)
+        for kk, (group, values) in enumerate(zip(self.groups, self.values)):
+            n = values.shape[0]
+            if self.continuous[kk]:
+                X[:, group[0]] = np.interp(U[:, kk]*(n - 1), np.arange(n), values)
+            else:
+                X[:, group] = values[np.minimum((U[:, kk]*n).astype(int), n - 1)]
+        return X
+
+#---------------------------------------
+# Sobol indices from a Saltelli design:
+# rows [A; B; AB_1; ...; AB_k], N each,
+# where AB_i is A with factor i from B.
+def saltelli_design(n_factors, n_samples, seed=0):
+    # (A, B), scrambled Sobol points with n_samples rounded up to
+    # a power of 2.
+    points = qmc.Sobol(d=2*n_factors, scramble=True, seed=seed).random_base2(
+        m=int(np.ceil(np.log2(max(n_samples, 2)))))
+    return points[:, :n_factors], points[:, n_factors:]
+
+def saltelli_rows(A, B, start, stop):
+    # Rows start..stop-1 of the design, so that it can be
+    # evaluated in chunks without building all of it.
+    rows = np.arange(start, stop)
+    block = rows//A.shape[0]
+    sample = rows % A.shape[0]
+    U = A[sample]
+    U[block == 1] = B[sample[block == 1]]
+    mixed = np.flatnonzero(block >= 2)
+    U[mixed, block[mixed] - 2] = B[sample[mixed], block[mixed] - 2]
+    return U
+
+def sobol_indices(y, n_factors, n_bootstrap=100, confidence=0.95, seed=0):
+    # S1, S1 interval half width, ST and ST interval half width of
+    # each factor, from the model outputs y of the design rows.
+    # The intervals are normal intervals of the bootstrap over the
+    # N samples.
+    y = np.reshape(y, (n_factors + 2, -1))
+    f_A, f_B, f_AB = y[0], y[1], y[2:]
+    n_samples = f_A.shape[0]
+    resamples = np.vstack((np.arange(n_samples), np.random.default_rng(seed).integers(
+        0, n_samples, size=(n_bootstrap, n_samples))))
+    # (n_bootstrap + 1, N); the first row is the estimate itself
+    A, B = f_A[resamples], f_B[resamples]
+    variance = np.var(np.hstack((A, B)), axis=1, ddof=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        S1 = np.array([np.mean(B*(f_AB[ii][resamples] - A), axis=1)/variance for ii in range(n_factors)])
+        ST = np.array([0.5*np.mean((A - f_AB[ii][resamples])**2, axis=1)/variance for ii in range(n_factors)])
+    z_value = stats.norm.ppf(0.5 + confidence/2)
+    return S1[:, 0], z_value*np.std(S1[:, 1:], axis=1), ST[:, 0], z_value*np.std(ST[:, 1:], axis=1)
+
+#---------------------------------------
+# Morris elementary effects: each
+# trajectory starts on the grid and
+# moves the factors one at a time, in a
+# random order, by +/- delta.
+def morris_design(n_factors, n_trajectories, n_levels=4, seed=0):
+    # Design rows (n_trajectories*(n_factors + 1), n_factors), the
+    # factor moved at each step (n_trajectories, n_factors), the
+    # direction of each factor's step and delta.
+    rng = np.random.default_rng(seed)
+    delta = n_levels/(2.0*(n_levels - 1))
+    # Start levels that leave room for one step of delta
+    n_start = int(np.floor((1.0 - delta)*(n_levels - 1) + 1e-9)) + 1
+    start = rng.integers(0, n_start, size=(n_trajectories, n_factors))/(n_levels - 1)
+    direction = rng.choice([-1.0, 1.0], size=(n_trajectories, n_factors))
+    start = start + delta*(direction < 0)
+    order = np.argsort(rng.random((n_trajectories, n_factors)), axis=1)
+    U = np.empty((n_trajectories, n_factors + 1, n_factors))
+    U[:, 0] = start
+    for step in range(n_factors):
+        U[:, step + 1] = U[:, step]
+        moved = order[:, step]
+        U[np.arange(n_trajectories), step + 1, moved] += delta*direction[np.arange(n_trajectories), moved]
+    return np.clip(U.reshape(-1, n_factors), 0.0, 1.0), order, direction, delta
+
+def morris_indices(y, order, direction, delta, n_bootstrap=100, confidence=0.95, seed=0):
+    # mu, mu_star, sigma and the mu_star interval half width
+    # (bootstrap over the trajectories) of each factor.
+    n_trajectories, n_factors = order.shape
+    y = np.reshape(y, (n_trajectories, n_factors + 1))
+    trajectories = np.arange(n_trajectories)[:, None]
+    effects = np.empty((n_trajectories, n_factors))
+    effects[trajectories, order] = np.diff(y, axis=1)/delta*direction[trajectories, order]
+    resamples = np.random.default_rng(seed).integers(0, n_trajectories, size=(n_bootstrap, n_trajectories))
+    mu_star_resampled = np.mean(np.abs(effects[resamples]), axis=1)
+    z_value = stats.norm.ppf(0.5 + confidence/2)
+    return (np.mean(effects, axis=0), np.mean(np.abs(effects), axis=0), np.std(effects, axis=0, ddof=1),
+            z_value*np.std(mu_star_resampled, axis=0))
+
+def evaluate_design(design_rows, n_rows, space, model_dir, predict_var, n_outputs, chunk_size, n_jobs=1):
+    # Outputs (n_outputs, n_rows) of the stacked model and its base
+    # learners (stream.predict_learners_chunk) for the design rows
+    # design_rows(start, stop), in chunks on n_jobs workers.
+    outputs = np.empty((n_outputs, n_rows))
+    chunks = ((space.to_inputs(design_rows(start, min(start + chunk_size, n_rows))), start)
+              for start in range(0, n_rows, chunk_size))
+    for Y, start in stream.ordered_map(stream.predict_learners_chunk, chunks, n_jobs=n_jobs,
+                                       initializer=stream.init_learners_worker,
+                                       initargs=(model_dir, predict_var)):
+        outputs[:, start:start + Y.shape[1]] = Y
+        print('Evaluated '+str(start + Y.shape[1])+' of '+str(n_rows)+' design rows')
+    return outputs
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner sensitivity arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    predict_var = args.predict_var
+    num_inputs = int(args.num_inputs)
+    method = getattr(args, 'method', None) or 'sobol'
+    n_samples = int(getattr(args, 'n_samples', None) or 1024)
+    n_trajectories = int(getattr(args, 'n_trajectories', None) or 20)
+    n_levels = int(getattr(args, 'n_levels', None) or 4)
+    n_bootstrap = int(getattr(args, 'n_bootstrap', None) or 100)
+    confidence = float(getattr(args, 'confidence', None) or 0.95)
+    corr_cutoff = float(getattr(args, 'corr_cutoff', None) or 0.5)
+    seed = int(getattr(args, 'seed', None) or 0)
+    chunk_size = int(getattr(args, 'chunk_size', None) or 100000)
+    n_jobs = int(getattr(args, 'n_jobs', None) or 1)
+    if n_jobs < 0:
+        n_jobs = stream.default_n_jobs()
+
+    sys.path.append(model_dir)
+    with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+        superlearner = pickle.load(file_object)
+    predictor = StackedPredictor(superlearner[predict_var])
+    output_names = ['stack'] + [predictor.names[ii] for ii in predictor.active]
+
+    #===========================================================
+    # Factors: the feature groups of fpi.py over the train + test
+    # inputs
+    #===========================================================
+    all_df = pd.concat((pd.read_csv(model_dir+'/train.csv'), pd.read_csv(model_dir+'/test.csv')),
+                       axis=0).iloc[:, :num_inputs].astype(np.float64)
+    one_hot_feature_list = sorted(set(feature.split('_-1hot-_')[0]
+                                      for feature in all_df.filter(like='_-1hot-_').columns))
+    permute_str = group_correlated_features(
+        all_df.corr(),
+        corr_cutoff=corr_cutoff,
+        merge_groups=True,
+        onehot_list=one_hot_feature_list,
+        verbose=False)
+    blocks, block_names = parse_permutation_feature_blocks(permute_str, all_df.columns)
+    column_idx = {name: ii for ii, name in enumerate(all_df.columns)}
+    space = FactorSpace(all_df.values, [[column_idx[name] for name in block] for block in blocks])
+    n_factors = len(blocks)
+    print(str(n_factors)+' factors: '+'; '.join(block_names))
+
+    #===========================================================
+    # Design, evaluation and indices
+    #===========================================================
+    if method == 'sobol':
+        A, B = saltelli_design(n_factors, n_samples, seed)
+        n_rows = A.shape[0]*(n_factors + 2)
+        print('Saltelli design: N = '+str(A.shape[0])+', '+str(n_rows)+' evaluations')
+        outputs = evaluate_design(lambda start, stop: saltelli_rows(A, B, start, stop), n_rows, space,
+                                  model_dir, predict_var, len(output_names), chunk_size, n_jobs)
+        index_names = ['S1', 'S1_Conf', 'ST', 'ST_Conf']
+        indices = [sobol_indices(y, n_factors, n_bootstrap, confidence, seed) for y in outputs]
+    elif method == 'morris':
+        U, order, direction, delta = morris_design(n_factors, n_trajectories, n_levels, seed)
+        print('Morris design: '+str(n_trajectories)+' trajectories, '+str(U.shape[0])+' evaluations')
+        outputs = evaluate_design(lambda start, stop: U[start:stop], U.shape[0], space,
+                                  model_dir, predict_var, len(output_names), chunk_size, n_jobs)
+        index_names = ['Mu', 'Mu_Star', 'Sigma', 'Mu_Star_Conf']
+        indices = [morris_indices(y, order, direction, delta, n_bootstrap, confidence, seed) for y in outputs]
+    else:
+        raise ValueError('--method must be sobol or morris')
+
+    sensitivity_df = pd.DataFrame(index=pd.Index(block_names, name='Feature'))
+    for name, output_indices in zip(output_names, indices):
+        for index_name, values in zip(index_names, output_indices):
+            sensitivity_df[index_name+name] = values
+    sensitivity_df = sensitivity_df.sort_values(index_names[1 if method == 'morris' else 2]+'stack', ascending=False)
+    print(sensitivity_df[[index_name+'stack' for index_name in index_names]])
+    sensitivity_df.to_csv(model_dir+'/sl_sensitivity_'+method+'.csv')
+
+    print("Done!")
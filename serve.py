@@ -0,0 +1,354 @@
+#================================
+# SuperLearner prediction server
+#================================
+# Keep trained SuperLearners in
+# memory and answer prediction
+# requests over local HTTP, for
+# interactive use (notebooks,
+# ad-hoc site queries) without
+# re-running predict.py.
+#
+# Requests that arrive together
+# are coalesced into one batch per
+# output variable (micro-batching),
+# so many small concurrent queries
+# cost about one model call. The
+# batches are predicted with
+# sklearn's input validation
+# turned off (the server checks
+# and imputes the inputs itself).
+# The model is reloaded when
+# SuperLearners.pkl changes or,
+# if --model_dir is a pattern such
+# as "ml_models/sl_*", when a newer
+# matching model dir appears.
+#
+# Command line execution:
+# python -m serve
+# --model_dir ./model_dir
+# --num_inputs 25
+# (optional) --host 127.0.0.1
+# (optional) --port 8765
+# (optional) --max_batch 4096
+# (optional) --max_wait_ms 5
+# (optional) --reload_interval 2
+# (optional) --n_jobs 1 (threads per batch)
+#
+# Requests:
+# GET  /info
+# POST /predict
+#   {"predict_var": <target name>,  (optional if only one)
+#    "rows": [[x1, ..., xn], ...] or [{"<feature>": x, ...}, ...]}
+# -> {"predict_var": ..., "model_dir": ..., "predictions": [...]}
+# Missing values (null) are filled with the training means.
+#================================
+
+# Dependencies
+import argparse
+import glob
+import json
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import sklearn
+from stacking import StackedPredictor
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def latest_model_dir(spec):
+    # spec is a model dir, or a glob pattern of model dirs of
+    # which the most recently trained one is used.
+    if not glob.has_magic(spec):
+        return spec
+    candidates = [path for path in glob.glob(spec) if os.path.isfile(path+'/SuperLearners.pkl')]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=lambda path: os.path.getmtime(path+'/SuperLearners.pkl'))
+
+class LoadedModel:
+    # One loaded model dir: SuperLearners, feature names and the
+    # training means used to fill missing inputs.
+    def __init__(self, model_dir, num_inputs, n_jobs=None):
+        self.model_dir = model_dir
+        self.mtime = os.path.getmtime(model_dir+'/SuperLearners.pkl')
+        if model_dir not in sys.path:
+            sys.path.append(model_dir)
+        with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+            self.superlearner = pickle.load(file_object)
+        self.predictors = {predict_var: StackedPredictor(stacked, n_jobs=n_jobs)
+                           for predict_var, stacked in self.superlearner.items()}
+        all_df = pd.concat(
+            (pd.read_csv(model_dir+'/train.csv'),
+             pd.read_csv(model_dir+'/test.csv')),axis=0).astype(np.float32)
+        self.feature_names = list(all_df.columns[:num_inputs])
+        self.fill_values = all_df.iloc[:, :num_inputs].mean().values.astype(np.float32)
+        self.loaded_at = time.time()
+        # Requests in flight, and whether a newer model replaced
+        # this one (see ModelStore.acquire/release).
+        self.users = 0
+        self.retired = False
+
+    def close(self):
+        # Shut down the predictors' thread pools.
+        for predictor in self.predictors.values():
+            predictor.close()
+
+    def rows_to_array(self, rows):
+        # Feature rows as a float32 array with NaNs filled.
+        if len(rows) > 0 and isinstance(rows[0], dict):
+            rows = [[row.get(name) for name in self.feature_names] for row in rows]
+        X = np.array(rows, dtype=np.float64).astype(np.float32)
+        if X.ndim != 2 or X.shape[1] != len(self.feature_names):
+            raise ValueError('Expected rows of '+str(len(self.feature_names))+' features')
+        if not np.all(np.isfinite(X[np.logical_not(np.isnan(X))])):
+            raise ValueError('Inputs must be finite')
+        missing = np.isnan(X)
+        if missing.any():
+            X[missing] = np.broadcast_to(self.fill_values, X.shape)[missing]
+        return X
+
+class ModelStore:
+    # Holds the current LoadedModel and swaps in a new one when
+    # the model dir changes. Requests keep using the model they
+    # started with; a replaced model is closed once the last of
+    # them is done.
+    def __init__(self, spec, num_inputs, n_jobs=None):
+        self.spec = spec
+        self.num_inputs = num_inputs
+        self.n_jobs = n_jobs
+        self.lock = threading.Lock()
+        model_dir = latest_model_dir(spec)
+        if model_dir is None:
+            raise ValueError('No trained model dir matches '+spec)
+        self.model = LoadedModel(model_dir, num_inputs, n_jobs)
+
+    def current(self):
+        with self.lock:
+            return self.model
+
+    def acquire(self):
+        # The current model, held until release(model).
+        with self.lock:
+            self.model.users += 1
+            return self.model
+
+    def release(self, model):
+        with self.lock:
+            model.users -= 1
+            idle = model.retired and model.users == 0
+        if idle:
+            model.close()
+
+    def check_reload(self):
+        model_dir = latest_model_dir(self.spec)
+        if model_dir is None:
+            return
+        try:
+            mtime = os.path.getmtime(model_dir+'/SuperLearners.pkl')
+        except OSError:
+            return
+        model = self.current()
+        if model_dir == model.model_dir and mtime == model.mtime:
+            return
+        # The pickle may still be being written; wait until it
+        # stops changing before loading.
+        time.sleep(0.5)
+        if os.path.getmtime(model_dir+'/SuperLearners.pkl') != mtime:
+            return
+        try:
+            new_model = LoadedModel(model_dir, self.num_inputs, self.n_jobs)
+        except Exception as error:
+            print('Reload of '+model_dir+' failed: '+str(error), flush=True)
+            return
+        with self.lock:
+            old_model, self.model = self.model, new_model
+            old_model.retired = True
+            idle = old_model.users == 0
+        if idle:
+            old_model.close()
+        print('Reloaded model from '+model_dir, flush=True)
+
+    def watch(self, interval):
+        while True:
+            time.sleep(interval)
+            self.check_reload()
+
+class PredictionServer(ThreadingHTTPServer):
+    # Room for many concurrent clients waiting to be accepted.
+    request_queue_size = 128
+
+class PendingRequest:
+    def __init__(self, model, predict_var, X):
+        self.model = model
+        self.predict_var = predict_var
+        self.X = X
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class MicroBatcher:
+    # Collects pending requests for up to max_wait seconds (or
+    # max_batch rows) and predicts them together, one model call
+    # per (model, output variable).
+    def __init__(self, max_batch, max_wait):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+
+    def submit(self, request):
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            n_rows = len(batch[0].X)
+            deadline = time.perf_counter() + self.max_wait
+            while n_rows < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_rows += len(request.X)
+            self.predict_batch(batch)
+
+    def predict_batch(self, batch):
+        groups = {}
+        for request in batch:
+            groups.setdefault((id(request.model), request.predict_var), []).append(request)
+        for requests in groups.values():
+            model = requests[0].model
+            predict_var = requests[0].predict_var
+            try:
+                X = np.concatenate([request.X for request in requests], axis=0)
+                # Inputs were checked and imputed when the request was
+                # parsed, so skip sklearn's per-call validation.
+                with sklearn.config_context(assume_finite=True, skip_parameter_validation=True):
+                    Y = np.atleast_1d(np.squeeze(model.predictors[predict_var].predict(X)))
+                start = 0
+                for request in requests:
+                    request.result = Y[start:start+len(request.X)]
+                    start += len(request.X)
+            except Exception as error:
+                for request in requests:
+                    request.error = error
+            for request in requests:
+                request.done.set()
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    store = None
+    batcher = None
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/info':
+            self.send_json(404, {'error': 'unknown path '+self.path})
+            return
+        model = self.store.current()
+        self.send_json(200, {
+            'model_dir': model.model_dir,
+            'predict_vars': list(model.superlearner.keys()),
+            'feature_names': model.feature_names,
+            'loaded_at': model.loaded_at})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'unknown path '+self.path})
+            return
+        model = self.store.acquire()
+        try:
+            self.predict(model)
+        finally:
+            self.store.release(model)
+
+    def predict(self, model):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            predict_vars = list(model.superlearner.keys())
+            predict_var = request.get('predict_var')
+            if predict_var is None and len(predict_vars) == 1:
+                predict_var = predict_vars[0]
+            if predict_var not in predict_vars:
+                raise ValueError('predict_var must be one of '+str(predict_vars))
+            X = model.rows_to_array(request['rows'])
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        try:
+            Y = self.batcher.submit(PendingRequest(model, predict_var, X))
+        except Exception as error:
+            self.send_json(500, {'error': str(error)})
+            return
+        self.send_json(200, {
+            'predict_var': predict_var,
+            'model_dir': model.model_dir,
+            'predictions': Y.tolist()})
+
+    def log_message(self, format, *args):
+        # Keep stdout for reloads and errors.
+        pass
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner serve arguments...")
+    parser = argparse.ArgumentParser()
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    host = getattr(args, 'host', None) or '127.0.0.1'
+    port = int(getattr(args, 'port', None) or 8765)
+    max_batch = int(getattr(args, 'max_batch', None) or 4096)
+    max_wait = float(getattr(args, 'max_wait_ms', None) or 5)/1000.0
+    reload_interval = float(getattr(args, 'reload_interval', None) or 2)
+
+    n_jobs = int(getattr(args, 'n_jobs', None) or 1)
+    store = ModelStore(args.model_dir, int(args.num_inputs), n_jobs)
+    batcher = MicroBatcher(max_batch, max_wait)
+    PredictionHandler.store = store
+    PredictionHandler.batcher = batcher
+
+    threading.Thread(target=batcher.run, daemon=True).start()
+    threading.Thread(target=store.watch, args=(reload_interval,), daemon=True).start()
+
+    server = PredictionServer((host, port), PredictionHandler)
+    print('Serving '+store.current().model_dir+' on http://'+host+':'+str(port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print("Done!")
@@ -0,0 +1,285 @@
+#================================
+# SuperLearner stacked predict
+#================================
+# Predict with a fitted
+# StackingRegressor (one entry of
+# SuperLearners.pkl) by fanning
+# the base learners out over a
+# pool of workers.
+#
+# StackingRegressor.predict runs
+# the base learners one after
+# another and then the final
+# estimator. Here:
+# + the final estimator is folded
+#   into weights w and intercept c
+#   (NNLS weights_, a positive
+#   LinearRegression, or a Pipeline
+#   of affine scalers + linear
+#   model), so the stack is
+#   y = P @ w + c with P the base
+#   learner predictions,
+# + learners with zero weight are
+#   not evaluated at all,
+# + the remaining learners run
+#   concurrently (threads by
+#   default: xgb, sklearn trees and
+#   BLAS release the GIL), and
+# + optionally, the compiled forms
+#   from compile_linear.py and
+#   compile_trees.py are used in
+#   place of the original learners.
+# Learners whose fitted input
+# transforms (scalers, polynomial
+# features) are identical, e.g.
+# StandardScalers fit on the same
+# training data, share one
+# transformed copy of the inputs,
+# also across the outputs of a
+# multi-target SuperLearner
+# (predict_many).
+# Final estimators that are not
+# linear fall back to evaluating
+# all learners and calling the
+# final estimator.
+#================================
+
+# Dependencies
+import hashlib
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import joblib
+import sklearn
+from sklearn.utils.parallel import Parallel
+from sklearn.utils.parallel import delayed
+from sklearn.compose import TransformedTargetRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.metrics import r2_score
+from compile_linear import LINEAR_MODELS
+from compile_linear import compose_affine
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def final_linear_map(final_estimator, n_learners):
+    # Return (w, c) such that final_estimator.predict(P) equals
+    # P @ w + c, or None if the final estimator is not linear.
+    weights = getattr(final_estimator, 'weights_', None)
+    if weights is not None:
+        return np.asarray(weights, dtype=np.float64), 0.0
+
+    steps = []
+    core = final_estimator
+    if isinstance(final_estimator, Pipeline):
+        steps = [step for _, step in final_estimator.steps if step not in (None, 'passthrough')]
+        core = steps.pop()
+    if not isinstance(core, LINEAR_MODELS):
+        return None
+    affine = compose_affine(steps, n_learners)
+    if affine is None:
+        return None
+    a, b = affine
+    coef = np.ravel(core.coef_).astype(np.float64)
+    intercept = float(np.ravel(core.intercept_)[0]) if np.ndim(core.intercept_) else float(core.intercept_)
+    return a*coef, intercept + np.dot(b, coef)
+
+class SharedInputLearner:
+    # A fitted [TransformedTargetRegressor of a] Pipeline split into
+    # its input transforms and the rest, so that the transformed
+    # inputs can be shared; key identifies the fitted transforms.
+    def __init__(self, model):
+        self.transformer = None
+        if isinstance(model, TransformedTargetRegressor):
+            self.transformer = model.transformer_
+            model = model.regressor_
+        self.steps = [step for _, step in model.steps[:-1] if step not in (None, 'passthrough')]
+        self.final = model.steps[-1][1]
+        self.key = hashlib.sha1(pickle.dumps(self.steps, protocol=4)).hexdigest()
+
+    def transform(self, X):
+        for step in self.steps:
+            X = step.transform(X)
+        return X
+
+    def predict_from(self, Z):
+        # Same operations as Pipeline.predict and
+        # TransformedTargetRegressor.predict after the transforms.
+        pred = self.final.predict(Z)
+        if self.transformer is not None:
+            if pred.ndim == 1:
+                pred = pred.reshape(-1, 1)
+            pred = self.transformer.inverse_transform(pred)
+        return np.ravel(pred)
+
+    def predict(self, X):
+        return self.predict_from(self.transform(X))
+
+def shareable(model):
+    # Wrap the learner as a SharedInputLearner if it is a Pipeline
+    # (possibly inside a TransformedTargetRegressor) with at least
+    # one input transform.
+    regressor = model.regressor_ if isinstance(model, TransformedTargetRegressor) else model
+    if isinstance(regressor, Pipeline) and len(regressor.steps) > 1:
+        return SharedInputLearner(model)
+    return model
+
+def shared_inputs(models, X):
+    # Transformed inputs for the transform keys used by more than
+    # one learner. Keys used once are transformed inside the
+    # learner's own task, so that large intermediates (polynomial
+    # features) are not all held at once.
+    keys = [model.key for model in models if isinstance(model, SharedInputLearner)]
+    inputs = {}
+    for model in models:
+        if isinstance(model, SharedInputLearner) and model.key not in inputs and keys.count(model.key) > 1:
+            inputs[model.key] = model.transform(X)
+    return inputs
+
+def predict_learner(model, X, inputs):
+    if isinstance(model, SharedInputLearner) and model.key in inputs:
+        return model.predict_from(inputs[model.key])
+    return np.ravel(model.predict(X))
+
+def predict_many(predictors, X):
+    # Predict several outputs ({name: StackedPredictor or any
+    # model}) in one pass, sharing input transforms across the
+    # outputs.
+    stacked = {name: predictor for name, predictor in predictors.items()
+               if isinstance(predictor, StackedPredictor)}
+    inputs = shared_inputs([model for predictor in stacked.values() for model in predictor.models], X)
+    return {name: predictor.predict(X, inputs) if name in stacked else np.ravel(predictor.predict(X))
+            for name, predictor in predictors.items()}
+
+class StackedPredictor:
+    # Drop-in replacement for stacked.predict(X) (and .score).
+    # n_jobs: number of concurrent learners (None or 1 runs them
+    #   in turn, -1 uses all cores)
+    # prefer: 'threads' (a persistent thread pool) or 'processes'
+    #   (joblib's loky pool; the learners are sent to the workers
+    #   on each call, so only worth it for large batches)
+    # compiled: optional dict {name: object with .predict(X)}
+    #   used in place of the original learners, and an optional
+    #   'blend' of already weighted learners (compile_linear.py).
+    def __init__(self, stacked, n_jobs=None, prefer='threads', compiled=None):
+        self.stacked = stacked
+        self.names = [name for name, est in stacked.estimators if est != 'drop']
+        self.n_jobs = joblib.effective_n_jobs(n_jobs) if n_jobs not in (None, 1) else 1
+        self.prefer = prefer
+        self.pool = None
+
+        compiled = dict(compiled or {})
+        blend = compiled.pop('blend', None)
+        self.passthrough = stacked.passthrough
+        linear_map = final_linear_map(stacked.final_estimator_, len(self.names) + (
+            stacked.n_features_in_ if stacked.passthrough else 0))
+        self.linear = linear_map is not None
+        if self.linear:
+            weights, self.intercept = linear_map
+            self.weights = weights[:len(self.names)]
+            self.passthrough_weights = weights[len(self.names):]
+            active = [ii for ii in range(len(self.names)) if self.weights[ii] != 0.0]
+        else:
+            active = list(range(len(self.names)))
+
+        # Learners already folded into the weighted blend are
+        # replaced by a single evaluation with weight 1.
+        self.blend = None
+        if self.linear and blend is not None and set(blend.names) <= set(self.names[ii] for ii in active):
+            self.blend = blend
+            active = [ii for ii in active if self.names[ii] not in blend.names]
+
+        self.active = active
+        self.models = [compiled.get(self.names[ii], shareable(stacked.estimators_[ii])) for ii in active]
+
+    @classmethod
+    def from_model_dir(cls, model_dir, predict_var, superlearner=None, use_compiled=False, **kwargs):
+        # Build the predictor for predict_var from a model dir,
+        # picking up compiled_linear.pkl and compiled_trees/ if
+        # use_compiled is set and they exist. The stacked model
+        # saved with compiled_trees/ holds everything but the tree
+        # learners, so SuperLearners.pkl is then not loaded unless
+        # superlearner is given.
+        compiled = {}
+        stacked = superlearner[predict_var] if superlearner is not None else None
+        if use_compiled:
+            linear_pkl = model_dir+'/compiled_linear.pkl'
+            if os.path.isfile(linear_pkl):
+                with open(linear_pkl, 'rb') as file_object:
+                    compiled_linear = pickle.load(file_object).get(predict_var)
+                if compiled_linear is not None:
+                    compiled.update(compiled_linear['learners'])
+                    if compiled_linear['blend'] is not None:
+                        compiled['blend'] = compiled_linear['blend']
+            trees_dir = model_dir+'/compiled_trees/'+predict_var
+            if os.path.isdir(trees_dir):
+                from compile_trees import load_superlearner_trees, load_stripped_stacked
+                compiled.update(load_superlearner_trees(trees_dir))
+                if stacked is None:
+                    stacked = load_stripped_stacked(trees_dir)
+        if stacked is None:
+            with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+                stacked = pickle.load(file_object)[predict_var]
+        return cls(stacked, compiled=compiled, **kwargs)
+
+    def _map(self, X, inputs):
+        # Predictions of the active learners, in order.
+        if self.n_jobs == 1 or len(self.models) <= 1:
+            return [predict_learner(model, X, inputs) for model in self.models]
+        # sklearn's config (e.g. a config_context of the caller) is
+        # thread-local, so it is passed on to the workers.
+        if self.prefer == 'processes':
+            return Parallel(n_jobs=self.n_jobs)(
+                delayed(predict_learner)(model, X, inputs) for model in self.models)
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.n_jobs)
+        config = sklearn.get_config()
+        def predict_with_config(model):
+            with sklearn.config_context(**config):
+                return predict_learner(model, X, inputs)
+        return list(self.pool.map(predict_with_config, self.models))
+
+    def transform(self, X, inputs=None):
+        # Base learner predictions (n_samples, n_active). inputs
+        # holds transformed inputs already computed (predict_many).
+        if inputs is None:
+            inputs = shared_inputs(self.models, X)
+        predictions = self._map(X, inputs)
+        if len(predictions) == 0:
+            return np.zeros((X.shape[0], 0))
+        return np.column_stack(predictions)
+
+    def predict_learners(self, X, inputs=None):
+        # Stacked predictions and the base learner predictions they
+        # are made from (n_samples, n_active), e.g. to score the
+        # learners on the same inputs without evaluating them again.
+        X = np.asarray(X)
+        P = self.transform(X, inputs)
+        if not self.linear:
+            final_inputs = np.hstack((P, X)) if self.passthrough else P
+            return self.stacked.final_estimator_.predict(final_inputs), P
+
+        Y = P @ self.weights[self.active] + self.intercept
+        if self.blend is not None:
+            Y = Y + self.blend.predict(X)
+        if self.passthrough:
+            Y = Y + X @ self.passthrough_weights
+        return Y, P
+
+    def predict(self, X, inputs=None):
+        return self.predict_learners(X, inputs)[0]
+
+    def score(self, X, y):
+        return r2_score(y, self.predict(X))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
@@ -0,0 +1,157 @@
+#================================
+# SuperLearner streaming helpers
+#================================
+# Read large prediction inputs in
+# chunks, predict the chunks on a
+# pool of worker processes and
+# write the results as they come
+# back, in order. Only a bounded
+# number of chunks is in memory at
+# any time, and reading/writing in
+# the main process overlaps with
+# the predictions in the workers.
+#
+# Used by predict.py, ensemble_predict.py and
+# sensitivity.py with
+# --chunk_size <rows> and
+# (optional) --n_jobs <workers>
+#================================
+
+# Dependencies
+import itertools
+import os
+import pickle
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from stacking import StackedPredictor
+from stacking import predict_many
+
+# Chunks in flight per worker; bounds memory while keeping the
+# workers busy.
+CHUNKS_PER_WORKER = 2
+
+# Model used by the predict functions in each worker process.
+_worker_model = None
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def column_means(csv_path, chunk_size):
+    # First pass over the inputs for the per-column means used to
+    # impute NaNs (the same as pandas DataFrame.mean, which skips
+    # NaN), without holding the whole file in memory.
+    total = None
+    count = None
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        values = chunk.values.astype(np.float64)
+        chunk_total = np.nansum(values, axis=0)
+        chunk_count = np.sum(np.logical_not(np.isnan(values)), axis=0)
+        if total is None:
+            total, count = chunk_total, chunk_count
+        else:
+            total += chunk_total
+            count += chunk_count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total/count).astype(np.float32)
+
+def iter_chunks(csv_path, ixy_path, chunk_size, fill_values=None):
+    # Yield aligned (X, ixy_df) chunks of the prediction inputs and
+    # their Sample_ID/lon/lat rows, with NaNs replaced by fill_values.
+    csv_reader = pd.read_csv(csv_path, chunksize=chunk_size)
+    ixy_reader = pd.read_csv(ixy_path, chunksize=chunk_size)
+    # zip_longest, so that a file that is longer by whole chunks
+    # is caught too (its extra chunks pair with None).
+    for csv_chunk, ixy_chunk in itertools.zip_longest(csv_reader, ixy_reader):
+        if csv_chunk is None or ixy_chunk is None or len(csv_chunk) != len(ixy_chunk):
+            raise ValueError(csv_path+' and '+ixy_path+' have different numbers of rows')
+        X = csv_chunk.values.astype(np.float32)
+        if fill_values is not None:
+            missing = np.isnan(X)
+            if missing.any():
+                X[missing] = np.broadcast_to(fill_values, X.shape)[missing]
+        yield X, ixy_chunk.reset_index(drop=True)
+
+def ordered_map(func, items, n_jobs=1, initializer=None, initargs=()):
+    # Apply func to each (payload, context) item, yielding
+    # (result, context) in input order. Only payloads are sent to
+    # the workers; at most CHUNKS_PER_WORKER*n_jobs are in flight.
+    if n_jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for payload, context in items:
+            yield func(payload), context
+        return
+
+    max_pending = CHUNKS_PER_WORKER*n_jobs
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for payload, context in items:
+            pending.append((pool.submit(func, payload), context))
+            if len(pending) >= max_pending:
+                future, context = pending.popleft()
+                yield future.result(), context
+        while pending:
+            future, context = pending.popleft()
+            yield future.result(), context
+
+def append_csv(df, path, first):
+    # Write the header with the first chunk, then append.
+    df.to_csv(path, index=False, na_rep='NaN', mode='w' if first else 'a', header=first)
+
+def init_superlearner_worker(model_dir, predict_vars, surrogate=None, use_compiled=False):
+    # Load the model once per worker process, rather than
+    # pickling it with every chunk.
+    global _worker_model
+    if surrogate is not None:
+        from distill import load_surrogate
+        _worker_model = {predict_vars[0]: load_surrogate(surrogate, predict_vars[0])['model']}
+        return
+    sys.path.append(model_dir)
+    # Compiled model dirs are loaded without SuperLearners.pkl.
+    superlearner = None
+    if not use_compiled:
+        with open(model_dir+"/"+'SuperLearners.pkl','rb') as file_object:
+            superlearner = pickle.load(file_object)
+    _worker_model = {predict_var: StackedPredictor.from_model_dir(
+        model_dir, predict_var, superlearner=superlearner, use_compiled=use_compiled)
+        for predict_var in predict_vars}
+
+def predict_chunk(X):
+    # {output name: predictions}; all outputs in one pass.
+    return predict_many(_worker_model, X)
+
+def init_ensemble_worker(model_dirs, predict_var):
+    # As init_superlearner_worker, for all SuperLearner instances.
+    global _worker_model
+    _worker_model = []
+    for model_dir in model_dirs:
+        sys.path.append(model_dir)
+        _worker_model.append(StackedPredictor.from_model_dir(model_dir, predict_var))
+
+def predict_ensemble_chunk(X):
+    # One row per instance, one column per site.
+    return np.stack([np.squeeze(model.predict(X)) for model in _worker_model])
+
+def init_learners_worker(model_dir, predict_var):
+    # As init_superlearner_worker, for one output predicted with
+    # its base learner predictions.
+    global _worker_model
+    sys.path.append(model_dir)
+    _worker_model = StackedPredictor.from_model_dir(model_dir, predict_var)
+
+def predict_learners_chunk(X):
+    # One row for the stacked prediction, then one per active
+    # base learner, one column per site.
+    Y, P = _worker_model.predict_learners(X)
+    return np.vstack((np.ravel(Y), P.T))
+
+def default_n_jobs():
+    # Cores available to this process (respects affinity masks
+    # set by batch schedulers).
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
@@ -0,0 +1,203 @@
+#================================
+# SuperLearner tiled outputs
+#================================
+# Write site tables (e.g.
+# sl_predictions.csv, sl_pca.csv)
+# as a grid of lat/lon tiles plus
+# a small index, so that map
+# tooling can read a region (or
+# update part of a map) by
+# touching only the tiles it
+# covers instead of the whole
+# file.
+#
+# <tile_dir>/index.json holds the
+# tile size, the columns and, for
+# each tile, its file, bounds and
+# number of rows. Tile files are
+# CSVs with the same columns as
+# the flat file; sites with a
+# missing lon/lat go to tile_nan.
+#
+# predict.py and pca.py write
+# tiles next to their flat output
+# with --tile_deg <degrees>.
+#
+# Command line execution:
+# Tile an existing flat file:
+# python -m tiles
+# --input_file ./model_dir/sl_predictions.csv
+# --tile_dir ./model_dir/sl_predictions_tiles
+# --tile_deg 5
+#
+# Extract a region:
+# python -m tiles
+# --tile_dir ./model_dir/sl_predictions_tiles
+# --lon_min -125 --lon_max -100
+# --lat_min 30 --lat_max 50
+# --output_file ./region.csv
+#================================
+
+# Dependencies
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+LON_COLUMN = 'Sample_Longitude'
+LAT_COLUMN = 'Sample_Latitude'
+INDEX_FILE = 'index.json'
+NAN_TILE = 'nan'
+
+#=======================================
+# Supporting functions
+#=======================================
+
+def tile_keys(lon, lat, tile_deg):
+    # Tile key of each site: "<lat row>_<lon column>" counted from
+    # (-90, -180), or NAN_TILE without coordinates.
+    ilat = np.floor((np.asarray(lat, dtype=np.float64) + 90.0)/tile_deg)
+    ilon = np.floor((np.asarray(lon, dtype=np.float64) + 180.0)/tile_deg)
+    missing = np.logical_or(np.isnan(ilat), np.isnan(ilon))
+    keys = np.full(len(ilat), NAN_TILE, dtype=object)
+    ok = np.logical_not(missing)
+    keys[ok] = [str(int(a))+'_'+str(int(b)) for a, b in zip(ilat[ok], ilon[ok])]
+    return keys
+
+def tile_bounds(key, tile_deg):
+    if key == NAN_TILE:
+        return None
+    ilat, ilon = (int(part) for part in key.split('_'))
+    return {'lat_min': ilat*tile_deg - 90.0, 'lat_max': (ilat + 1)*tile_deg - 90.0,
+            'lon_min': ilon*tile_deg - 180.0, 'lon_max': (ilon + 1)*tile_deg - 180.0}
+
+def load_index(tile_dir):
+    with open(tile_dir+'/'+INDEX_FILE) as file_object:
+        return json.load(file_object)
+
+def save_index(tile_dir, index):
+    # Write then rename so that readers never see a partial index.
+    tmp_file = tile_dir+'/'+INDEX_FILE+'.tmp'
+    with open(tmp_file, 'w') as file_object:
+        json.dump(index, file_object, indent = 4)
+    os.replace(tmp_file, tile_dir+'/'+INDEX_FILE)
+
+class TileWriter:
+    # Append chunks of a site table to tile files; the index is
+    # written by close().
+    def __init__(self, tile_dir, tile_deg):
+        self.tile_dir = tile_dir
+        self.tile_deg = float(tile_deg)
+        self.tiles = {}
+        self.columns = None
+        os.makedirs(tile_dir, exist_ok=True)
+        # Start from an empty tile set.
+        if os.path.isfile(tile_dir+'/'+INDEX_FILE):
+            for tile in load_index(tile_dir)['tiles'].values():
+                if os.path.isfile(tile_dir+'/'+tile['file']):
+                    os.remove(tile_dir+'/'+tile['file'])
+            os.remove(tile_dir+'/'+INDEX_FILE)
+
+    def write(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+        keys = tile_keys(df[LON_COLUMN].values, df[LAT_COLUMN].values, self.tile_deg)
+        for key, tile_df in df.groupby(keys, sort=False):
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = {'file': 'tile_'+key+'.csv', 'n_rows': 0}
+                bounds = tile_bounds(key, self.tile_deg)
+                if bounds is not None:
+                    tile.update(bounds)
+                self.tiles[key] = tile
+            tile_df.to_csv(self.tile_dir+'/'+tile['file'], index=False, na_rep='NaN',
+                           mode='a' if tile['n_rows'] > 0 else 'w', header=tile['n_rows'] == 0)
+            tile['n_rows'] += len(tile_df)
+
+    def close(self):
+        save_index(self.tile_dir, {
+            'tile_deg': self.tile_deg,
+            'columns': self.columns,
+            'tiles': self.tiles})
+
+def tiles_in_region(index, lon_min, lon_max, lat_min, lat_max):
+    # Keys of the tiles that overlap the region.
+    return [key for key, tile in index['tiles'].items()
+            if key != NAN_TILE and
+            tile['lon_min'] <= lon_max and tile['lon_max'] >= lon_min and
+            tile['lat_min'] <= lat_max and tile['lat_max'] >= lat_min]
+
+def read_region(tile_dir, lon_min, lon_max, lat_min, lat_max):
+    # Rows inside the region, reading only the overlapping tiles.
+    index = load_index(tile_dir)
+    frames = []
+    for key in tiles_in_region(index, lon_min, lon_max, lat_min, lat_max):
+        tile_df = pd.read_csv(tile_dir+'/'+index['tiles'][key]['file'], dtype={'Sample_ID': str})
+        inside = ((tile_df[LON_COLUMN] >= lon_min) & (tile_df[LON_COLUMN] <= lon_max) &
+                  (tile_df[LAT_COLUMN] >= lat_min) & (tile_df[LAT_COLUMN] <= lat_max))
+        frames.append(tile_df[inside])
+    if len(frames) == 0:
+        return pd.DataFrame(columns=index['columns'])
+    return pd.concat(frames, axis=0, ignore_index=True)
+
+def update_tiles(tile_dir, df, key_column='Sample_ID'):
+    # Replace (or add) the rows of df, matched on key_column,
+    # rewriting only the tiles that df touches.
+    index = load_index(tile_dir)
+    tile_deg = index['tile_deg']
+    keys = tile_keys(df[LON_COLUMN].values, df[LAT_COLUMN].values, tile_deg)
+    for key, new_df in df.groupby(keys, sort=False):
+        tile = index['tiles'].get(key)
+        if tile is None:
+            tile = {'file': 'tile_'+key+'.csv', 'n_rows': 0}
+            bounds = tile_bounds(key, tile_deg)
+            if bounds is not None:
+                tile.update(bounds)
+            index['tiles'][key] = tile
+            tile_df = new_df
+        else:
+            old_df = pd.read_csv(tile_dir+'/'+tile['file'], dtype={key_column: str})
+            old_df = old_df[np.logical_not(old_df[key_column].isin(new_df[key_column].astype(str)))]
+            tile_df = pd.concat([old_df, new_df], axis=0, ignore_index=True)
+        tmp_file = tile_dir+'/'+tile['file']+'.tmp'
+        tile_df.to_csv(tmp_file, index=False, na_rep='NaN')
+        os.replace(tmp_file, tile_dir+'/'+tile['file'])
+        tile['n_rows'] = len(tile_df)
+    save_index(tile_dir, index)
+
+#=======================================
+# Main execution
+#=======================================
+if __name__ == '__main__':
+
+    #===========================
+    # Command line inputs
+    #===========================
+    print("Parsing SuperLearner tiles arguments...")
+    parser = argparse.ArgumentParser()
+    # Declared up front so that negative bounds are read as values.
+    for bound in ['--lon_min', '--lon_max', '--lat_min', '--lat_max']:
+        parser.add_argument(bound, type=float)
+    parsed, unknown = parser.parse_known_args()
+    for arg in unknown:
+        if arg.startswith(("-", "--")):
+            parser.add_argument(arg)
+            print(arg)
+
+    args = parser.parse_args()
+
+    tile_dir = args.tile_dir
+
+    if getattr(args, 'input_file', None) is None:
+        region_df = read_region(tile_dir, args.lon_min, args.lon_max, args.lat_min, args.lat_max)
+        print('Found '+str(len(region_df))+' sites in region')
+        region_df.to_csv(args.output_file, index=False, na_rep='NaN')
+    else:
+        writer = TileWriter(tile_dir, args.tile_deg)
+        for chunk in pd.read_csv(args.input_file, chunksize=100000, dtype={'Sample_ID': str}):
+            writer.write(chunk)
+        writer.close()
+        print('Wrote '+str(len(writer.tiles))+' tiles to '+tile_dir)
+
+    print("Done!")
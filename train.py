@@ -53,6 +53,13 @@ import random
 # For data plots
 import matplotlib.pyplot as plt
 
+# Stacked predictions with the base learners run concurrently
+from stacking import StackedPredictor
+
+# Input scaler/PCA for scoring novelty (pca.dist) at prediction time
+from novelty import fit_novelty
+from novelty import save_novelty
+
 #=======================================
 # Supporting functions
 #=======================================
@@ -346,6 +353,10 @@ if __name__ == '__main__':
 
     with open(args.model_dir + '/SuperLearners.pkl', 'wb') as output:
         pickle.dump(SuperLearners, output, pickle.HIGHEST_PROTOCOL)
+
+    # Save the input scaler, PCA and training centroid so that
+    # predict.py --novelty True can add pca.dist for each site.
+    save_novelty(fit_novelty(X, inames), args.model_dir)
     
     #================================================================
     # Cross_val_score:
@@ -373,13 +384,22 @@ if __name__ == '__main__':
         print('Statistics of the cross-validation metrics:')
 
 
+    #===========================================================
+    # Scores use the stacked predict engine: learners with zero
+    # weight are skipped and the others run on n_jobs threads.
+    stacked_predictors = {}
+    def predictor(oname):
+        if oname not in stacked_predictors:
+            stacked_predictors[oname] = StackedPredictor(SuperLearners[oname], n_jobs=int(args.n_jobs))
+        return stacked_predictors[oname]
+
     #===========================================================
     # Evaluate SuperLearners on test set:
     ho_metrics = {}
     for oi, oname in enumerate(onames):
         print('Evaluating estimator for output: ' + oname, flush = True)
         with joblib.parallel_backend(args.backend, **backend_params):
-            ho_metrics[oname] = SuperLearners[oname].score(X_test, Y_test[:, oi])
+            ho_metrics[oname] = predictor(oname).score(X_test, Y_test[:, oi])
 
     # Evaluate SuperLearners on the test(holdout) set with a high/low respiration rate split:
     try: 
@@ -396,8 +416,8 @@ if __name__ == '__main__':
         for oi, oname in enumerate(onames):
             print('Evaluating estimator on holdout(test) high/low set for output: ' + oname, flush = True)
             with joblib.parallel_backend(args.backend, **backend_params):
-                ho_metrics[f"{oname}_high"] = SuperLearners[oname].score(X_test_high, Y_test_high[:, oi])
-                ho_metrics[f"{oname}_low"] = SuperLearners[oname].score(X_test_low, Y_test_low[:, oi])
+                ho_metrics[f"{oname}_high"] = predictor(oname).score(X_test_high, Y_test_high[:, oi])
+                ho_metrics[f"{oname}_low"] = predictor(oname).score(X_test_low, Y_test_low[:, oi])
     except Exception as e :
         print(f"Evaluating the SuperLearner on a test(holdout) set with a high and low respiration rate split failed: {e}")
 
@@ -412,7 +432,7 @@ if __name__ == '__main__':
     for oi, oname in enumerate(onames):
         print('Evaluating estimator for output: ' + oname, flush = True)
         with joblib.parallel_backend(args.backend, **backend_params):
-            ho_metrics[oname] = SuperLearners[oname].score(X_train, Y_train[:, oi])
+            ho_metrics[oname] = predictor(oname).score(X_train, Y_train[:, oi])
 
     print('Classical metrics:', flush = True)
     print(json.dumps(ho_metrics, indent = 4), flush = True)